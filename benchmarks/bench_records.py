@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Compare the memory held by inventories of raw boto response dicts against
+# compact records, and the number of live allocations backing them.
+#
+# Usage: python benchmarks/bench_records.py [COUNT]
+#
+# The package is imported from the checkout the script is in.
+
+from __future__ import print_function, unicode_literals
+
+import gc
+import os.path
+import sys
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# Use the package from this checkout, without needing to install it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from ebs_snatcher.records import Snapshot, Volume  # noqa: E402
+
+
+def boto_volume(i):
+    return {
+        'VolumeId': 'vol-{:017x}'.format(i),
+        'Size': 100,
+        'SnapshotId': 'snap-{:017x}'.format(i),
+        'AvailabilityZone': 'us-east-1' + 'abc'[i % 3],
+        'State': 'in-use' if i % 2 else 'available',
+        'CreateTime': datetime(2020, 1, 1, tzinfo=timezone.utc),
+        'Attachments': [{
+            'AttachTime': datetime(2020, 1, 1, tzinfo=timezone.utc),
+            'Device': '/dev/sdf',
+            'InstanceId': 'i-{:017x}'.format(i),
+            'State': 'attached',
+            'VolumeId': 'vol-{:017x}'.format(i),
+            'DeleteOnTermination': False
+        }] if i % 2 else [],
+        'Encrypted': False,
+        'VolumeType': 'gp2',
+        'Iops': 300,
+        'MultiAttachEnabled': False,
+        'Tags': [{'Key': 'role', 'Value': 'db'},
+                 {'Key': 'cluster', 'Value': 'main'}]
+    }
+
+
+def boto_snapshot(i):
+    return {
+        'SnapshotId': 'snap-{:017x}'.format(i),
+        'VolumeId': 'vol-{:017x}'.format(i),
+        'VolumeSize': 100,
+        'StartTime': (datetime(2020, 1, 1, tzinfo=timezone.utc) +
+                      timedelta(minutes=i)),
+        'State': 'completed',
+        'Progress': '100%',
+        'OwnerId': '123456789012',
+        'Description': 'Created by CreateImage for vol-{:017x}'.format(i),
+        'Encrypted': False,
+        'StorageTier': 'standard',
+        'Tags': [{'Key': 'role', 'Value': 'db'}]
+    }
+
+
+def measure(name, build, count):
+    # Build the raw responses first, such that only the memory held by the
+    # final inventory is measured (as if pages were discarded after parsing)
+    gc.collect()
+    tracemalloc.start()
+    items = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    print('{:<18} {:>8.1f} MiB {:>10} blocks'.format(
+        name, current / (1024.0 * 1024), blocks))
+    del items
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('{} items each'.format(count))
+
+    measure('volume dicts', lambda n: [boto_volume(i) for i in range(n)],
+            count)
+    measure('volume records',
+            lambda n: [Volume.from_boto(boto_volume(i)) for i in range(n)],
+            count)
+    measure('snapshot dicts', lambda n: [boto_snapshot(i) for i in range(n)],
+            count)
+    measure('snapshot records',
+            lambda n: [Snapshot.from_boto(boto_snapshot(i))
+                       for i in range(n)],
+            count)
+
+
+if __name__ == '__main__':
+    main()
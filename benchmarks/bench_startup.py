@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Measure the time taken to import the entry point modules, as reported by
+# `python -X importtime` (Python 3.7+) in fresh interpreters, and list the
+# slowest imports below them. Exits with status 1 if the median of any module
+# is over the budget.
+#
+# Usage: python benchmarks/bench_startup.py [--runs N] [--budget MS]
+#                                           [MODULE...]
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os.path
+import subprocess
+import sys
+from collections import defaultdict
+
+
+# Modules are imported from the checkout the script is in
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = ['ebs_snatcher.main', 'ebs_snatcher.fleet',
+                   'ebs_snatcher.daemon', 'ebs_snatcher.plan',
+                   'ebs_snatcher.profiles']
+
+
+def import_times(module):
+    # Map of module name to (self, cumulative) microseconds
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT_DIR)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('Failed to import {}: {}'.format(
+            module, err.decode('utf-8')))
+
+    times = {}
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(module, runs, top):
+    totals = []
+    own_times = defaultdict(list)
+    for _ in range(runs):
+        times = import_times(module)
+        totals.append(times[module][1])
+        for name, (own, _) in times.items():
+            own_times[name].append(own)
+
+    total = median(totals) / 1000.0
+    print('{:<24} {:>8.1f} ms'.format(module, total))
+
+    slowest = sorted(own_times.items(), key=lambda item: -median(item[1]))
+    for name, values in slowest[:top]:
+        print('    {:<40} {:>8.1f} ms'.format(name, median(values) / 1000.0))
+
+    return total
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--runs', type=int, default=5)
+    argp.add_argument('--top', type=int, default=5)
+    argp.add_argument('--budget', type=float, default=None, metavar='MS')
+    argp.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    args = argp.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        total = measure(module, args.runs, args.top)
+        if args.budget is not None and total > args.budget:
+            over_budget.append(module)
+
+    if over_budget:
+        print('Over budget of {} ms: {}'.format(
+            args.budget, ', '.join(over_budget)))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
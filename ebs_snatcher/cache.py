@@ -0,0 +1,134 @@
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+
+
+CACHE_SUFFIX = '.json.z'
+# Changed whenever the format of cached values changes, such that old entries
+# are not used
+CACHE_VERSION = 4
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+logger = logging.getLogger('ebs-snatcher.cache')
+
+
+def _encode(obj):
+    # boto responses contain timezone-aware datetimes, which JSON can't
+    # represent. Store them as UTC timestamps instead.
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return {'$ts': (obj - EPOCH).total_seconds()}
+
+    raise TypeError('Can not serialize {!r}'.format(obj))
+
+
+def _decode(obj):
+    if len(obj) == 1 and '$ts' in obj:
+        return datetime.fromtimestamp(obj['$ts'], timezone.utc)
+
+    return obj
+
+
+def dumps(value):
+    data = json.dumps(value, default=_encode, separators=(',', ':'),
+                      sort_keys=True)
+    return zlib.compress(data.encode('utf-8'))
+
+
+def loads(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'),
+                      object_hook=_decode)
+
+
+class InventoryCache(object):
+    def __init__(self, path, ttl, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+
+    def _entry_path(self, kind, key):
+        digest = hashlib.sha1(dumps([CACHE_VERSION, kind, key])).hexdigest()
+        return os.path.join(self.path, '{}-{}{}'.format(kind, digest,
+                                                        CACHE_SUFFIX))
+
+    def get(self, kind, key):
+        # Returns a (found, value) tuple, such that cached None values can be
+        # told apart from misses.
+        entry_path = self._entry_path(kind, key)
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = loads(f.read())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('Failed to read cache entry %s: %s',
+                               entry_path, e)
+            return False, None
+        except (ValueError, zlib.error) as e:
+            logger.warning('Ignoring corrupt cache entry %s: %s',
+                           entry_path, e)
+            return False, None
+
+        if self.clock() - entry['time'] > self.ttl:
+            return False, None
+
+        logger.debug('Using cached %s from %s', kind, entry_path)
+        return True, entry['value']
+
+    def put(self, kind, key, value):
+        # Other processes sharing the cache may create the directory at the
+        # same time
+        os.makedirs(self.path, exist_ok=True)
+
+        data = dumps({'time': self.clock(), 'value': value})
+
+        # Write to a temporary file and rename it, such that readers never
+        # see partially written entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._entry_path(kind, key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def get_or_load(self, kind, key, load):
+        found, value = self.get(kind, key)
+        if not found:
+            value = load()
+            # The cache only saves lookups, so failing to fill it must not
+            # fail them
+            try:
+                self.put(kind, key, value)
+            except (IOError, OSError) as e:
+                logger.warning('Failed to write %s to cache in %s: %s',
+                               kind, self.path, e)
+
+        return value
+
+    def invalidate(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        logger.debug('Invalidating inventory cache in %s', self.path)
+        for name in names:
+            if name.endswith(CACHE_SUFFIX):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
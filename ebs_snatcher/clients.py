@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from . import timing
+
+
+# Same as botocore
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+logger = logging.getLogger('ebs-snatcher.clients')
+
+
+class ClientPool(object):
+    # Lazily built boto3 clients, keyed by service, region and credentials
+    # profile. Clients are thread-safe once built, so a single pool can be
+    # shared by all worker threads, reusing their HTTPS connections. Sessions
+    # are not, so building clients is serialized. All calls made by the
+    # clients go through the rate limiter, if any.
+    #
+    # boto3 is only imported when the first client is built, as it takes
+    # longer than everything else put together, and many invocations (such
+    # as `--help`, invalid arguments, or plans) never make any API calls.
+
+    def __init__(self, profile=None, max_pool_connections=None,
+                 rate_limiter=None, session_factory=None):
+        self.session_factory = session_factory
+
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = {}
+        self.configure(profile, max_pool_connections, rate_limiter)
+
+    def configure(self, profile=None, max_pool_connections=None,
+                  rate_limiter=None):
+        # Change the defaults used for new clients, dropping any clients built
+        # with the previous ones
+        with self._lock:
+            self.profile = profile
+            self.max_pool_connections = max_pool_connections
+            self.rate_limiter = rate_limiter
+            self._sessions.clear()
+            self._clients.clear()
+
+    def _session(self, profile):
+        session = self._sessions.get(profile)
+        if session is None:
+            session_factory = self.session_factory
+            if session_factory is None:
+                import boto3.session
+                session_factory = boto3.session.Session
+
+            session = session_factory(profile_name=profile)
+            self._sessions[profile] = session
+
+        return session
+
+    def get(self, service, region=None, profile=None):
+        profile = profile or self.profile
+        key = (service, region, profile)
+
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                logger.debug('Creating %s client for region %s, profile %s',
+                             service, region or 'default',
+                             profile or 'default')
+
+                options = {}
+                if self.max_pool_connections:
+                    options['max_pool_connections'] = \
+                        self.max_pool_connections
+                if self.rate_limiter:
+                    # Throttled calls are retried with backoff, on top of
+                    # the adaptive rate limit
+                    options['retries'] = {
+                        'mode': 'standard',
+                        'max_attempts': self.rate_limiter.max_attempts}
+
+                config = None
+                if options:
+                    from botocore.config import Config
+                    config = Config(**options)
+
+                client = self._session(profile).client(
+                    service, region_name=region, config=config)
+                timing.register(client)
+                if self.rate_limiter:
+                    self.rate_limiter.register(client)
+
+                self._clients[key] = client
+
+        return client
+
+
+default_pool = ClientPool()
+
+
+def configure(profile=None, max_pool_connections=None, rate_limiter=None):
+    default_pool.configure(profile, max_pool_connections, rate_limiter)
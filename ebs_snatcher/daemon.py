@@ -0,0 +1,174 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+
+from .main import (add_volume_args, configure_clients, get_instance_info,
+                   new_resource_state, positive_float)
+from .metrics import RunMetrics
+
+
+logger = logging.getLogger('ebs-snatcher.daemon')
+
+
+def get_args():  # pragma: no cover
+    argp = argparse.ArgumentParser(
+        'ebs-snatcher-daemon',
+        description='Continuously ensure an AWS EBS volume is attached to an '
+                    'instance')
+    argp.add_argument(
+        '--instance-id', metavar='ID', required=True,
+        help='Instance ID to attach volumes to')
+    argp.add_argument(
+        '--socket', metavar='PATH', required=True,
+        help='Path of the UNIX socket to listen for requests on')
+    argp.add_argument(
+        '--check-interval', metavar='SECONDS', type=positive_float,
+        default=60.0,
+        help='Interval between checks that the volume is still attached')
+    add_volume_args(argp)
+
+    return argp.parse_args()
+
+
+class Reconciler(object):
+    def __init__(self, args, rate_limiter=None):
+        self.args = args
+        self.rate_limiter = rate_limiter
+        self.lock = threading.Lock()
+        self.instance_info = None
+        self.last_result = None
+        # Accumulated over all checks
+        self.metrics = RunMetrics() if args.metrics_file else None
+
+    def _ensure(self):
+        if self.instance_info is None:
+            self.instance_info = get_instance_info(self.args)
+
+        resource_state = new_resource_state(self.args, self.instance_info)
+        resource_state.survey()
+        if resource_state.state in ('attached', 'created'):
+            if self.args.volume_count > 1:
+                logger.warning('Not all volumes of the set are attached to '
+                               'the instance anymore, provisioning them again')
+            else:
+                logger.warning('Volume is not attached to the instance '
+                               'anymore, provisioning it again')
+
+            # Refresh the instance info, as its block device mappings are
+            # used to pick the attachment devices, and survey again with it
+            self.instance_info = get_instance_info(self.args)
+            resource_state = new_resource_state(self.args, self.instance_info)
+            resource_state.survey()
+
+        resource_state.converge()
+        if self.args.hydrate:
+            resource_state.hydrate()
+
+        return resource_state
+
+    def _write_metrics(self, resource_state):
+        api_stats = self.rate_limiter and self.rate_limiter.stats()
+        self.metrics.observe_run(resource_state, api_stats)
+        try:
+            self.metrics.write(self.args.metrics_file)
+        except (IOError, OSError):
+            logger.exception('Failed to write metrics to %s',
+                             self.args.metrics_file)
+
+    def ensure(self):
+        with self.lock:
+            resource_state = None
+            try:
+                resource_state = self._ensure()
+                self.last_result = resource_state.to_json()
+            except Exception as e:
+                logger.exception('Failed to ensure volume is attached')
+                self.last_result = {'error_type': type(e).__name__,
+                                    'error': str(e)}
+
+            if self.metrics:
+                self._write_metrics(resource_state)
+
+            return self.last_result
+
+    def status(self):
+        # The result is replaced as a whole at the end of each check, so it can
+        # be read without waiting for a running one
+        return self.last_result
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8').strip()
+        if command == 'ensure':
+            result = self.server.reconciler.ensure()
+        elif command == 'status':
+            result = self.server.reconciler.status()
+        else:
+            result = {'error_type': 'ValueError',
+                      'error': 'Unknown command: {}'.format(command)}
+
+        self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, reconciler):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.reconciler = reconciler
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def run(args, stop_event, rate_limiter=None):
+    reconciler = Reconciler(args, rate_limiter)
+    server = Server(args.socket, reconciler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    logger.info('Listening for requests on %s', args.socket)
+
+    try:
+        while True:
+            reconciler.ensure()
+            if stop_event.wait(args.check_interval):
+                break
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return reconciler
+
+
+def main():  # pragma: no cover
+    logging.basicConfig(level=logging.DEBUG)
+
+    args = get_args()
+    rate_limiter = configure_clients(args)
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+
+    run(args, stop_event, rate_limiter)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
@@ -5,19 +5,41 @@ import logging
 import random
 import os.path
 import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
-import boto3
 from botocore.exceptions import ClientError
 
+from . import clients, watch
+from .records import Snapshot, Volume
 from .util import memoize
+from .waiters import Waiter, WaiterError
 
 
 VOLUME_TYPES = set(['standard', 'gp2', 'io1', 'sc1', 'st1'])
+DEFAULT_VOLUME_TYPE = 'gp2'
+# Maximum number of values the API accepts in a single filter
+MAX_FILTER_VALUES = 200
+# Range of page sizes accepted by DescribeSnapshots
+SNAPSHOT_PAGE_SIZES = (5, 1000)
+# Tag holding the owner and expiry of a claim on an available volume
+CLAIM_TAG = 'ebs-snatcher:claim'
+# Errors from attaching a volume that was taken by someone else
+VOLUME_TAKEN_ERRORS = set(['VolumeInUse', 'IncorrectState'])
 
 logger = logging.getLogger('ebs-snatcher.ebs')
-ec2 = memoize(lambda: boto3.client('ec2'))
-sts = memoize(lambda: boto3.client('sts'))
+
+
+class VolumeTakenError(WaiterError):
+    pass
+
+
+def ec2(region=None):
+    return clients.default_pool.get('ec2', region)
+
+
+def sts():
+    return clients.default_pool.get('sts')
 
 
 @memoize
@@ -25,6 +47,12 @@ def get_account_id():
     return sts().get_caller_identity()['Account']
 
 
+def set_account_id(account_id):
+    # Allow the account ID to be provided from elsewhere (such as the instance
+    # metadata), avoiding the STS call
+    get_account_id.value = account_id
+
+
 def get_instance_info(instance_id):
     logger.debug('Retrieving instance info for ID %s', instance_id)
 
@@ -56,12 +84,7 @@ def find_attached_volumes(id_tags, instance_info, filters=()):
         {'Name': 'attachment.status', 'Values': ['attached', 'attaching']}
     ])
 
-    paginator = ec2().get_paginator('describe_volumes')
-    volumes = []
-    for response in paginator.paginate(Filters=filters, DryRun=False):
-        volumes.extend(response['Volumes'])
-
-    return volumes
+    return list(_describe_volumes(filters))
 
 
 def find_available_volumes(id_tags, instance_info, filters=(), current_az=True):
@@ -72,38 +95,346 @@ def find_available_volumes(id_tags, instance_info, filters=(), current_az=True):
         filters.append({'Name': 'availability-zone',
                         'Values': [availability_zone]})
 
+    volumes = list(_describe_volumes(filters))
+    random.shuffle(volumes)
+    return volumes
+
+
+def _describe_volumes(filters):
     paginator = ec2().get_paginator('describe_volumes')
-    volumes = []
     for response in paginator.paginate(Filters=filters, DryRun=False):
-        volumes.extend(response['Volumes'])
+        for volume in response['Volumes']:
+            yield Volume.from_boto(volume)
 
-    volumes = list(volumes)
-    random.shuffle(volumes)
-    return volumes
 
+def find_volumes(id_tags, instance_info, filters=(), cache=None):
+    # Scan all volumes matching the tags in one pass, and split them locally
+    # into the ones attached to the instance, available in its AZ and
+    # available in other AZs.
+    filters = _filters_with_tags(filters, id_tags)
+    filters.append({'Name': 'status',
+                    'Values': ['creating', 'available', 'in-use']})
+
+    volumes = _describe_volumes(filters)
+    if cache:
+        rows = cache.get_or_load('volumes', filters, lambda: list(volumes))
+        volumes = [Volume.from_row(row) for row in rows]
 
-def find_existing_snapshot(search_tags=(), filters=()):
+    return split_volumes(volumes, instance_info)
+
+
+def attached_instance_ids(volume):
+    return [att.instance_id for att in volume.attachments
+            if att.state in ('attached', 'attaching')]
+
+
+def is_volume_available(volume):
+    return volume.state in ('creating', 'available')
+
+
+def split_volumes(volumes, instance_info):
+    instance_id = instance_info['InstanceId']
+    availability_zone = instance_info['Placement']['AvailabilityZone']
+
+    attached, available, other_az = [], [], []
+    for volume in volumes:
+        if instance_id in attached_instance_ids(volume):
+            attached.append(volume)
+        elif not is_volume_available(volume):
+            continue
+        elif volume.availability_zone == availability_zone:
+            available.append(volume)
+        else:
+            other_az.append(volume)
+
+    random.shuffle(available)
+    random.shuffle(other_az)
+    return attached, available, other_az
+
+
+def find_existing_snapshot(search_tags=(), filters=(), page_size=None,
+                           cache=None, scorer=None, regions=()):
     filters = _filters_with_tags(filters, search_tags)
     filters.append({'Name': 'status', 'Values': ['completed']})
+    regions = remote_regions(regions)
+
+    if cache:
+        key = filters if scorer is None else [filters, scorer.cache_key()]
+        if regions:
+            key = [key, regions]
+
+        return Snapshot.from_row(cache.get_or_load(
+            'snapshot', key,
+            lambda: _find_best_snapshot(filters, page_size, scorer, regions)))
+
+    return _find_best_snapshot(filters, page_size, scorer, regions)
+
 
-    paginator = ec2().get_paginator('describe_snapshots')
-    snapshots = []
+def remote_regions(regions):
+    # Regions other than the current one, which is always searched
+    local_region = ec2().meta.region_name if regions else None
+    return sorted(set(region for region in regions
+                      if region != local_region))
 
+
+def _find_best_snapshot(filters, page_size, scorer, regions=()):
+    def search(region):
+        return _find_best_snapshots(filters, page_size, scorer,
+                                    region=region)
+
+    if scorer:
+        scorer.prepare()
+
+    # Search all regions at once, as each is a separate series of requests.
+    # The current region goes first, such that it wins ties.
+    if regions:
+        with ThreadPoolExecutor(max_workers=len(regions) + 1) as executor:
+            results = list(executor.map(search, [None] + list(regions)))
+    else:
+        results = [search(None)]
+
+    candidates = [best[None] for best in results if best]
+    if not candidates:
+        return None
+
+    score, snapshot = max(candidates, key=lambda candidate: candidate[0])
+    return snapshot
+
+
+def _describe_snapshots(filters, page_size=None, region=None):
+    params = {}
+    if page_size:
+        params['PaginationConfig'] = {'PageSize': page_size}
+
+    paginator = ec2(region).get_paginator('describe_snapshots')
     responses = paginator.paginate(Filters=filters,
                                    RestorableByUserIds=[get_account_id()],
-                                   DryRun=False)
-
+                                   DryRun=False,
+                                   **params)
     for response in responses:
-        snapshots.extend(response['Snapshots'])
+        for snapshot in response['Snapshots']:
+            yield Snapshot.from_boto(snapshot, region)
 
-    try:
-        return max(snapshots, key=lambda snap: snap['StartTime'])
-    except ValueError:
-        return None
+
+def _find_best_snapshots(filters, page_size, scorer, group_by=None,
+                         region=None):
+    if scorer:
+        scorer.prepare()
+
+    return best_snapshots(_describe_snapshots(filters, page_size, region),
+                          scorer, group_by)
+
+
+def best_snapshots(snapshots, scorer=None, group_by=None):
+    # Only keep the best snapshot seen so far (for each group, if grouping),
+    # such that memory usage does not grow with the number of matching
+    # snapshots. Without a scorer, the newest snapshot is the best.
+    best = {}
+    for snapshot in snapshots:
+        group = getattr(snapshot, group_by) if group_by else None
+        keep_best_snapshot(best, group, snapshot, scorer)
+
+    return best
+
+
+def keep_best_snapshot(best, group, snapshot, scorer=None):
+    if scorer:
+        score = scorer.score(snapshot)
+    else:
+        score = snapshot.start_time
+
+    if group not in best or score > best[group][0]:
+        if scorer:
+            snapshot = snapshot._replace(score_reason=scorer.explain(snapshot))
+        best[group] = (score, snapshot)
+
+
+def find_snapshots_by_volume(volume_ids, page_size=None, scorer=None):
+    # Find the best snapshot of each of the volumes, querying many volumes at
+    # once. Returns a dict of volume IDs to (score, snapshot) pairs, such that
+    # snapshots of different volumes can be compared.
+    volume_ids = list(volume_ids)
+    best = {}
+    for i in range(0, len(volume_ids), MAX_FILTER_VALUES):
+        filters = [
+            {'Name': 'volume-id',
+             'Values': volume_ids[i:i + MAX_FILTER_VALUES]},
+            {'Name': 'status', 'Values': ['completed']}
+        ]
+        best.update(_find_best_snapshots(filters, page_size, scorer,
+                                         group_by='volume_id'))
+
+    return best
+
+
+def find_fast_restore_snapshots(availability_zone):
+    filters = [
+        {'Name': 'availability-zone', 'Values': [availability_zone]},
+        {'Name': 'state', 'Values': ['enabled']}
+    ]
+
+    paginator = ec2().get_paginator('describe_fast_snapshot_restores')
+    snapshot_ids = set()
+    for response in paginator.paginate(Filters=filters, DryRun=False):
+        for restore in response['FastSnapshotRestores']:
+            snapshot_ids.add(restore['SnapshotId'])
+
+    return snapshot_ids
+
+
+def wait_snapshot_completed(snapshot_id, waiter, name, timeout=None):
+    def check():
+        try:
+            response = ec2().describe_snapshots(SnapshotIds=[snapshot_id],
+                                                DryRun=False)
+        except ClientError as e:
+            # New snapshots can take a moment to become visible
+            if e.response['Error']['Code'] != 'InvalidSnapshot.NotFound':
+                raise
+
+            return False
+
+        snapshot = response['Snapshots'][0]
+        if snapshot['State'] == 'error':
+            raise WaiterError('Snapshot {} failed: {}'.format(
+                snapshot_id, snapshot.get('StateMessage', 'unknown error')))
+
+        logger.info('Snapshot %s is %s (%s)', snapshot_id, snapshot['State'],
+                    snapshot.get('Progress') or '0%')
+        return snapshot['State'] == 'completed'
+
+    waiter.wait(name, check, timeout)
+
+
+def copy_snapshot(snapshot, kms_key_id=None, waiter=None, timeout=None):
+    # Copy a snapshot from another region to the current one, waiting for it
+    # to complete. The tags are copied too, such that later searches find the
+    # copy in the current region. Tags reserved by AWS can't be set by users,
+    # so they are left out.
+    params = {}
+    if kms_key_id:
+        params['Encrypted'] = True
+        params['KmsKeyId'] = kms_key_id
+    tags = [{'Key': k, 'Value': v} for k, v in snapshot.tags
+            if not k.startswith('aws:')]
+    if tags:
+        params['TagSpecifications'] = [
+            {'ResourceType': 'snapshot', 'Tags': tags}]
+
+    response = ec2().copy_snapshot(
+        SourceRegion=snapshot.region,
+        SourceSnapshotId=snapshot.snapshot_id,
+        Description='Copy of {} from {}'.format(snapshot.snapshot_id,
+                                                snapshot.region),
+        DryRun=False,
+        **params)
+
+    snapshot_id = response['SnapshotId']
+    logger.info('Copying snapshot %s from region %s as %s',
+                snapshot.snapshot_id, snapshot.region, snapshot_id)
+    wait_snapshot_completed(snapshot_id, waiter or Waiter(), 'copy', timeout)
+
+    return snapshot_id
+
+
+def _volume_states(volume_id, filters=None):
+    params = {}
+    if filters:
+        params['Filters'] = filters
+
+    response = ec2().describe_volumes(VolumeIds=[volume_id], DryRun=False,
+                                      **params)
+    return [volume['State'] for volume in response['Volumes']]
+
+
+def _check_volume_state(volume_id, state, filters=None):
+    states = _volume_states(volume_id, filters)
+    if 'deleted' in states and state != 'deleted':
+        raise WaiterError('Volume {} was deleted while waiting for it to be '
+                          '{}'.format(volume_id, state))
+    if 'in-use' in states and state == 'available':
+        raise VolumeTakenError('Volume {} was attached elsewhere while '
+                               'waiting for it to be available'.format(
+                                   volume_id))
+
+    return bool(states) and all(s == state for s in states)
+
+
+def wait_volume_available(volume_id, waiter, name):
+    waiter.wait(name, lambda: _check_volume_state(volume_id, 'available'))
+
+
+def wait_volume_attached(volume_id, waiter, name):
+    filters = [{'Name': 'attachment.status', 'Values': ['attached']}]
+    waiter.wait(name,
+                lambda: _check_volume_state(volume_id, 'in-use', filters))
+
+
+def wait_volume_deleted(volume_id, waiter, name):
+    def check():
+        try:
+            return _check_volume_state(volume_id, 'deleted')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidVolume.NotFound':
+                raise
+
+            return True
+
+    waiter.wait(name, check)
+
+
+def wait_volume_modified(volume_id, waiter, name, start_time=None):
+    # Modified volumes can be used with their new settings once optimizing
+    # starts, which can take much longer to finish. Modifications started
+    # before `start_time` (such as completed earlier ones) are ignored.
+    def check():
+        # Modifications might not be visible yet right after being made
+        try:
+            response = ec2().describe_volumes_modifications(
+                VolumeIds=[volume_id], DryRun=False)
+        except ClientError as e:
+            if e.response['Error']['Code'] != \
+                    'InvalidVolumeModification.NotFound':
+                raise
+
+            return False
+
+        modifications = [m for m in response['VolumesModifications']
+                         if start_time is None or m['StartTime'] >= start_time]
+        if not modifications:
+            return False
+
+        modification = max(modifications, key=lambda m: m['StartTime'])
+        state = modification['ModificationState']
+        if state == 'failed':
+            raise WaiterError('Modification of volume {} failed: {}'.format(
+                volume_id, modification.get('StatusMessage', 'unknown error')))
+
+        logger.info('Modification of volume %s is %s (%d%%)', volume_id,
+                    state, modification.get('Progress', 0))
+        return state in ('optimizing', 'completed')
+
+    waiter.wait(name, check)
+
+
+def modify_volume(volume_id, size=None, volume_type=None, iops=None,
+                  waiter=None):
+    params = {}
+    if size:
+        params['Size'] = size
+    if volume_type:
+        params['VolumeType'] = volume_type
+    if iops:
+        params['Iops'] = iops
+
+    response = ec2().modify_volume(VolumeId=volume_id, DryRun=False, **params)
+    start_time = response.get('VolumeModification', {}).get('StartTime')
+    wait_volume_modified(volume_id, waiter or Waiter(), 'modify', start_time)
 
 
 def create_volume(id_tags, extra_tags, availability_zone, volume_type,
-                  size, iops=None, kms_key_id=None, src_snapshot_id=None):
+                  size, iops=None, kms_key_id=None, src_snapshot_id=None,
+                  waiter=None):
     extra_tags = extra_tags or []
     tags = [{'Key': k, 'Value': v} for k, v in chain(id_tags, extra_tags)]
 
@@ -126,8 +457,8 @@ def create_volume(id_tags, extra_tags, availability_zone, volume_type,
         **params
     )
 
-    waiter = ec2().get_waiter('volume_available')
-    waiter.wait(VolumeIds=[volume['VolumeId']], DryRun=False)
+    volume = Volume.from_boto(volume)
+    wait_volume_available(volume.volume_id, waiter or Waiter(), 'create')
 
     return volume
 
@@ -167,6 +498,27 @@ def next_device_name(dev):
     return '{}{}{}'.format(path or '', prefix, _format_dev_name(dev_index + 1))
 
 
+def _device_slot(dev):
+    # Names with different prefixes can refer to the same attachment point,
+    # such as /dev/sdf and /dev/xvdf, or /dev/sda and /dev/sda1
+    match = re.match(r'(?:/dev/)?(?:sd|xvd)([a-z]+)', dev)
+    return match and match.group(1)
+
+
+def allocate_device_name(device_name, instance_info):
+    used_slots = set()
+    for mapping in instance_info.get('BlockDeviceMappings', []):
+        slot = _device_slot(mapping['DeviceName'])
+        if slot:
+            used_slots.add(slot)
+
+    cur_device = device_name
+    while _device_slot(cur_device) in used_slots:
+        cur_device = next_device_name(cur_device)
+
+    return cur_device
+
+
 def _is_error_for_device_in_use(exc):
     err = exc.response['Error']
     if err['Code'] != 'InvalidParameterValue':
@@ -179,14 +531,17 @@ def _is_error_for_device_in_use(exc):
     return True
 
 
-def attach_volume(volume_id, instance_info, device_name='auto'):
+def attach_volume(volume_id, instance_info, device_name='auto', waiter=None):
     instance_id = instance_info['InstanceId']
+    waiter = waiter or Waiter()
 
     # Wait until volume is available before attaching it
-    waiter = ec2().get_waiter('volume_available')
-    waiter.wait(VolumeIds=[volume_id], DryRun=False)
+    wait_volume_available(volume_id, waiter, 'attach_available')
 
     cur_device = '/dev/sdf' if device_name == 'auto' else device_name
+    # Skip names known to be in use upfront. Names might still be taken in
+    # the meantime, so keep retrying on failures.
+    cur_device = allocate_device_name(cur_device, instance_info)
     while True:
         logger.info('Attaching volume %s to instance %s as device %s',
                     volume_id, instance_id, cur_device)
@@ -206,47 +561,133 @@ def attach_volume(volume_id, instance_info, device_name='auto'):
             break
 
     # Wait until attachment finishes
-    waiter = ec2().get_waiter('volume_in_use')
-    waiter.wait(
-        VolumeIds=[volume_id],
-        Filters=[{'Name': 'attachment.status', 'Values': ['attached']}],
-        DryRun=False)
+    wait_volume_attached(volume_id, waiter, 'attach')
 
     return cur_device
 
 
-def delete_volume(volume_id):
+def is_volume_taken_error(exc):
+    if isinstance(exc, VolumeTakenError):
+        return True
+
+    return (isinstance(exc, ClientError) and
+            exc.response['Error']['Code'] in VOLUME_TAKEN_ERRORS)
+
+
+def _claim_held_by_other(claim, owner, now):
+    claim_owner, _, expiry = claim.rpartition(' ')
+    try:
+        expiry = float(expiry)
+    except ValueError:
+        # Malformed claims are ignored
+        return False
+
+    return claim_owner != owner and expiry > now
+
+
+def _read_claim(volume_id):
+    # Return whether the volume is still available, and its current claim
+    try:
+        response = ec2().describe_volumes(VolumeIds=[volume_id],
+                                          DryRun=False)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidVolume.NotFound':
+            raise
+
+        return False, None
+
+    volumes = [Volume.from_boto(v) for v in response['Volumes']]
+    if not volumes or not is_volume_available(volumes[0]):
+        return False, None
+
+    return True, dict(volumes[0].tags).get(CLAIM_TAG)
+
+
+def claim_volume(volume_id, owner, lease=120.0, settle_delay=1.0,
+                 clock=time.time, sleep=time.sleep):
+    # Optimistically claim an available volume by tagging it, such that
+    # instances racing for the same volumes end up picking different ones.
+    # After waiting for concurrent claims to land, the tag is read back and
+    # the last writer wins. Claims expire after `lease` seconds, such that
+    # instances that crash don't hold volumes forever. Returns the claim to
+    # be released later, or None if the volume was taken.
+    available, claim = _read_claim(volume_id)
+    if not available:
+        logger.info('Volume %s is no longer available', volume_id)
+        return None
+    if claim and _claim_held_by_other(claim, owner, clock()):
+        logger.info('Volume %s is claimed by someone else: %s', volume_id,
+                    claim)
+        return None
+
+    claim = '{} {:.0f}'.format(owner, clock() + lease)
+    ec2().create_tags(Resources=[volume_id],
+                      Tags=[{'Key': CLAIM_TAG, 'Value': claim}],
+                      DryRun=False)
+    sleep(settle_delay)
+
+    available, current_claim = _read_claim(volume_id)
+    if not available or current_claim != claim:
+        logger.info('Lost claim on volume %s to %s', volume_id,
+                    current_claim or 'another attachment')
+        return None
+
+    logger.info('Claimed volume %s', volume_id)
+    return claim
+
+
+def release_volume(volume_id, claim):
+    # Only removes the tag if it still holds the given claim. Failures are
+    # not fatal, as claims expire anyway.
+    try:
+        ec2().delete_tags(Resources=[volume_id],
+                          Tags=[{'Key': CLAIM_TAG, 'Value': claim}],
+                          DryRun=False)
+    except ClientError as e:
+        logger.warning('Failed to release claim on volume %s: %s', volume_id,
+                       e)
+
+
+def delete_volume(volume_id, waiter=None):
     ec2().delete_volume(VolumeId=volume_id, DryRun=False)
 
-    waiter = ec2().get_waiter('volume_deleted')
-    waiter.wait(VolumeIds=[volume_id], DryRun=False)
+    wait_volume_deleted(volume_id, waiter or Waiter(), 'delete')
 
     return None
 
 
-def find_system_block_device(volume_id, ebs_device_path, retries=10,
-                             sleep=time.sleep):
+def find_system_block_device(volume_id, ebs_device_path, timeout=100.0,
+                             poll_interval=0.5, open_watcher=watch.open_watcher,
+                             clock=time.time, fallback=True):
     clean_volume_id = volume_id.replace('-', '')
     nvme_path = '/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_{}'.format(
         clean_volume_id)
     xen_path = ebs_device_path.replace('/sd', '/xvd')
 
-    for _ in range(retries):
-        # Try NVME devices tagged with the vol. ID as the serial number first,
-        # as found in the c5/m5 family instances
-        if os.path.exists(nvme_path):
-            return nvme_path
-
-        # Try Xen Virtual Block Device next
-        if os.path.exists(xen_path):
-            return xen_path
-
-        # Try standard SCSI path last
-        if os.path.exists(ebs_device_path):
-            return ebs_device_path
-
-        # Sleep for a little and try again
-        sleep(10.0)
-
-    # Fall back to the unchanged device
-    return ebs_device_path
+    # Try NVME devices tagged with the vol. ID as the serial number first,
+    # as found in the c5/m5 family instances. Then try the Xen Virtual Block
+    # Device, and the standard SCSI path last.
+    paths = [nvme_path, xen_path, ebs_device_path]
+
+    deadline = clock() + timeout
+    # Start watching before checking the paths, such that a device appearing
+    # in between is not missed
+    with open_watcher(paths) as watcher:
+        while True:
+            for path in paths:
+                if os.path.exists(path):
+                    return path
+
+            remaining = deadline - clock()
+            if remaining <= 0:
+                break
+
+            # Wake up as soon as anything changes in the watched directories,
+            # but check again periodically in case an event is missed
+            watcher.wait(min(poll_interval, remaining))
+
+    # Fall back to the unchanged device, unless the caller needs to know it
+    # was not found
+    logger.warning('Device for volume %s did not appear after %.1f seconds',
+                   volume_id, timeout)
+    return ebs_device_path if fallback else None
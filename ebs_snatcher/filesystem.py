@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+
+import logging
+import re
+import shlex
+import subprocess
+
+
+EXT_TYPES = set(['ext2', 'ext3', 'ext4'])
+
+logger = logging.getLogger('ebs-snatcher.filesystem')
+
+
+def run(*cmd):
+    logger.debug('Running %s', ' '.join(cmd))
+    return subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+
+
+def list_block_devices(device, run=run):
+    # The device itself comes first, followed by its partitions. Pairs output
+    # is used as it quotes empty and whitespace-containing values.
+    output = run('lsblk', '--pairs', '--paths', '--output',
+                 'NAME,TYPE,FSTYPE,MOUNTPOINT', device)
+
+    devices = []
+    for line in output.splitlines():
+        if line.strip():
+            devices.append(dict(pair.split('=', 1)
+                                for pair in shlex.split(line)))
+
+    return devices
+
+
+def grow_partition(device, partition, run=run):
+    number = re.search(r'(\d+)$', partition).group(1)
+    try:
+        run('growpart', device, number)
+    except subprocess.CalledProcessError as e:
+        # Partitions already filling the device are not an error
+        if 'NOCHANGE' not in (e.output or ''):
+            raise
+
+        logger.info('Partition %s already fills device %s', partition,
+                    device)
+
+
+def grow_filesystem(device, run=run):
+    # Grow the filesystem in a device to fill it, after the device itself was
+    # grown. Partitioned devices have their last partition grown first.
+    devices = list_block_devices(device, run=run)
+    target = devices[0]
+    partitions = [d for d in devices if d['TYPE'] == 'part']
+    if partitions:
+        target = partitions[-1]
+        grow_partition(device, target['NAME'], run=run)
+
+    path = target['NAME']
+    fstype = target['FSTYPE']
+    result = {'device': path, 'filesystem': fstype or None, 'grown': False}
+
+    if fstype in EXT_TYPES:
+        logger.info('Growing %s filesystem in %s', fstype, path)
+        run('resize2fs', path)
+    elif fstype == 'xfs' and target['MOUNTPOINT']:
+        logger.info('Growing XFS filesystem in %s', path)
+        run('xfs_growfs', target['MOUNTPOINT'])
+    elif fstype == 'xfs':
+        logger.warning('XFS filesystem in %s must be mounted to be grown',
+                       path)
+        return result
+    else:
+        logger.warning('Not growing unsupported filesystem %s in %s',
+                       fstype or 'none', path)
+        return result
+
+    result['grown'] = True
+    return result
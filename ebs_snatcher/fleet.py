@@ -0,0 +1,129 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import clients, ebs
+from .main import add_volume_args, configure_clients, override_args, \
+    positive_int, provision, write_metrics
+from .metrics import RunMetrics
+
+
+logger = logging.getLogger('ebs-snatcher.fleet')
+
+
+def get_args():  # pragma: no cover
+    argp = argparse.ArgumentParser(
+        'ebs-snatcher-fleet',
+        description='Provision AWS EBS volumes for many instances at once')
+    argp.add_argument(
+        '--manifest', metavar='PATH', required=True,
+        help='File listing the instances to provision, one per line, either '
+             'as a bare instance ID or as a JSON object containing an '
+             '"instance_id" key and optional overrides for any other '
+             'argument. Use "-" to read from stdin.')
+    argp.add_argument(
+        '--workers', metavar='COUNT', type=positive_int, default=8,
+        help='Maximum number of instances to provision concurrently')
+    add_volume_args(argp)
+
+    return argp.parse_args()
+
+
+def read_manifest(lines):
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith('{'):
+            entry = json.loads(line)
+            if not entry.get('instance_id'):
+                raise ValueError(
+                    'Manifest entry missing instance_id: {}'.format(line))
+        else:
+            entry = {'instance_id': line}
+
+        entries.append(entry)
+
+    return entries
+
+
+def provision_instance(args, entry):
+    instance_id = entry['instance_id']
+    result = {'instance_id': instance_id}
+
+    resource_state = None
+    try:
+        instance_info = ebs.get_instance_info(instance_id)
+        if instance_info is None:
+            raise ValueError('Instance not found: {}'.format(instance_id))
+
+        # The instances are not the one running ebs-snatcher, so their block
+        # devices can't be looked up or hydrated from here
+        resource_state = provision(override_args(args, entry),
+                                   instance_info, local=False)
+    except Exception as e:
+        logger.exception('Failed to provision volume for instance %s',
+                         instance_id)
+        result.update({'status': 'error',
+                       'error_type': type(e).__name__,
+                       'error': str(e)})
+    else:
+        result['status'] = 'ok'
+        result.update(resource_state.to_json())
+
+    # The state is None if provisioning failed
+    return result, resource_state
+
+
+def run_fleet(args, entries, workers, out=sys.stdout, metrics=None):
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(provision_instance, args, entry)
+                   for entry in entries]
+        for future in as_completed(futures):
+            result, resource_state = future.result()
+            if result['status'] != 'ok':
+                failures += 1
+            # Each instance is counted as a separate run
+            if metrics:
+                metrics.observe_run(resource_state)
+
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+
+    return failures
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+
+    args = get_args()
+    # Allow every worker to keep its own connection
+    rate_limiter = configure_clients(
+        args, max(clients.DEFAULT_MAX_POOL_CONNECTIONS, args.workers))
+
+    if args.manifest == '-':
+        entries = read_manifest(sys.stdin)
+    else:
+        with open(args.manifest) as f:
+            entries = read_manifest(f)
+
+    metrics = RunMetrics() if args.metrics_file else None
+    try:
+        failures = run_fleet(args, entries, args.workers, metrics=metrics)
+    finally:
+        if metrics:
+            write_metrics(args.metrics_file, metrics, rate_limiter)
+
+    logger.info('AWS API calls: %s', json.dumps(rate_limiter.stats()))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
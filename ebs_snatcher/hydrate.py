@@ -0,0 +1,124 @@
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Reads are aligned to this size, matching the sector size of most devices
+ALIGNMENT = 4096
+
+logger = logging.getLogger('ebs-snatcher.hydrate')
+
+
+class RateLimiter(object):
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._next_time = None
+
+    def acquire(self, amount):
+        # Reserve a slot proportional to the amount to be read, and sleep
+        # until it starts. Slots are handed out in order, such that the
+        # total rate is shared by all readers.
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next_time or now)
+            self._next_time = start + float(amount) / self.rate
+
+        delay = start - now
+        if delay > 0:
+            self.sleep(delay)
+
+
+class Progress(object):
+    def __init__(self, total, interval=10.0, clock=time.time):
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+
+        self.done = 0
+        self.start_time = clock()
+        self._last_report = self.start_time
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        with self._lock:
+            self.done += amount
+            now = self.clock()
+            if now - self._last_report < self.interval:
+                return
+
+            self._last_report = now
+
+        logger.info('Hydrated %.1f%% of the device (%.1f MiB/s)',
+                    100.0 * self.done / self.total if self.total else 100.0,
+                    self.throughput() / (1024 * 1024))
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+
+def _device_size(fd):
+    # Block devices report a size of zero in stat, but can be seeked
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def hydrate(path, readers=8, block_size=1024 * 1024, rate_limit=None,
+            progress_interval=10.0):
+    # Read every block of the device once, forcing EBS to load any blocks of
+    # volumes created from snapshots that have not been fetched from S3 yet.
+    block_size = max(ALIGNMENT, block_size - block_size % ALIGNMENT)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = _device_size(fd)
+        logger.info('Hydrating %s (%d bytes) with %d readers', path, size,
+                    readers)
+
+        limiter = rate_limit and RateLimiter(rate_limit)
+        progress = Progress(size, progress_interval)
+        offsets = iter(range(0, size, block_size))
+        offsets_lock = threading.Lock()
+
+        def read_blocks():
+            while True:
+                with offsets_lock:
+                    offset = next(offsets, None)
+                if offset is None:
+                    return
+
+                length = min(block_size, size - offset)
+                if limiter:
+                    limiter.acquire(length)
+
+                data = os.pread(fd, length, offset)
+                if hasattr(os, 'posix_fadvise'):
+                    # The data itself is not needed, don't keep it cached
+                    os.posix_fadvise(fd, offset, length,
+                                     os.POSIX_FADV_DONTNEED)
+
+                progress.add(len(data))
+
+        with ThreadPoolExecutor(max_workers=readers) as executor:
+            futures = [executor.submit(read_blocks) for _ in range(readers)]
+        for future in futures:
+            future.result()
+    finally:
+        os.close(fd)
+
+    elapsed = progress.elapsed()
+    logger.info('Hydrated %s in %.1fs', path, elapsed)
+
+    return {'bytes': progress.done,
+            'seconds': round(elapsed, 3),
+            'throughput': round(progress.throughput(), 1)}
@@ -0,0 +1,127 @@
+from __future__ import unicode_literals
+
+import json
+import logging
+import socket
+import time
+from urllib.error import URLError, HTTPError
+
+from .util import memoize
+
+
+DEFAULT_ENDPOINT = 'http://169.254.169.254'
+TOKEN_TTL = 21600
+# Refresh tokens a little before they actually expire, to account for clock
+# differences and requests in flight
+TOKEN_EXPIRY_MARGIN = 60
+
+logger = logging.getLogger('ebs-snatcher.imds')
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataClient(object):
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, token_ttl=TOKEN_TTL,
+                 timeout=1.0, clock=time.time):
+        self.endpoint = endpoint.rstrip('/')
+        self.token_ttl = token_ttl
+        self.timeout = timeout
+        self.clock = clock
+
+        self._token = None
+        self._token_expiry = 0
+
+    def _request(self, path, method='GET', headers=None):
+        # Pulls in http.client, ssl and email, which are only needed when
+        # the instance ID is not given
+        from urllib.request import Request, urlopen
+
+        url = '{}/{}'.format(self.endpoint, path.lstrip('/'))
+        request = Request(url, headers=headers or {}, method=method)
+
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            try:
+                return response.read().decode('utf-8')
+            finally:
+                response.close()
+        except HTTPError:
+            raise
+        except (URLError, socket.timeout) as e:
+            raise MetadataError(
+                'Failed to reach instance metadata at {}: {}'.format(url, e))
+
+    def get_token(self):
+        now = self.clock()
+        if self._token and now < self._token_expiry:
+            return self._token
+
+        logger.debug('Requesting new instance metadata session token')
+        try:
+            token = self._request(
+                'latest/api/token', method='PUT',
+                headers={'X-aws-ec2-metadata-token-ttl-seconds':
+                         str(self.token_ttl)})
+        except HTTPError as e:
+            raise MetadataError(
+                'Failed to get instance metadata token: {}'.format(e))
+
+        self._token = token
+        self._token_expiry = now + self.token_ttl - TOKEN_EXPIRY_MARGIN
+        return token
+
+    def get(self, path):
+        for attempt in range(2):
+            headers = {'X-aws-ec2-metadata-token': self.get_token()}
+            try:
+                return self._request('latest/' + path.lstrip('/'),
+                                     headers=headers)
+            except HTTPError as e:
+                # The token might have been invalidated before its expiry
+                # time, so get a new one and try once more.
+                if e.code == 401 and attempt == 0:
+                    self._token = None
+                    continue
+
+                raise MetadataError(
+                    'Failed to get instance metadata {}: {}'.format(path, e))
+
+    def get_identity_document(self):
+        document = self.get('dynamic/instance-identity/document')
+        try:
+            return json.loads(document)
+        except ValueError as e:
+            raise MetadataError(
+                'Invalid instance identity document: {}'.format(e))
+
+
+default_client = memoize(MetadataClient)
+
+
+def get_block_device_mappings(client):
+    # Only the mappings the instance was launched with are listed, not
+    # volumes attached later, so attachments can still find a device in use
+    names = client.get('meta-data/block-device-mapping/').split()
+    devices = []
+    for name in names:
+        device = client.get('meta-data/block-device-mapping/' + name).strip()
+        if not device.startswith('/dev/'):
+            device = '/dev/' + device
+        if device not in devices:
+            devices.append(device)
+
+    return [{'DeviceName': device} for device in devices]
+
+
+def get_instance_identity(client=None):
+    client = client or default_client()
+    document = client.get_identity_document()
+
+    instance_info = {
+        'InstanceId': document['instanceId'],
+        'Placement': {'AvailabilityZone': document['availabilityZone']},
+        'BlockDeviceMappings': get_block_device_mappings(client)
+    }
+    return instance_info, document['accountId']
@@ -0,0 +1,219 @@
+from __future__ import unicode_literals
+
+import logging
+import random
+from collections import defaultdict
+
+from . import ebs
+
+
+logger = logging.getLogger('ebs-snatcher.inventory')
+
+
+def _has_tags(resource, tag_pairs):
+    return set(tag_pairs).issubset(resource.tags)
+
+
+def shared_tag_filters(tag_sets):
+    # API filters for the tag keys present in every set, matching any of the
+    # values the sets have for them. Results still have to be matched against
+    # each set locally.
+    tag_sets = [list(tags) for tags in tag_sets]
+    if not tag_sets:
+        return []
+
+    keys = set.intersection(*(set(key for key, _ in tags)
+                              for tags in tag_sets))
+    filters = []
+    for key in sorted(keys):
+        values = sorted(set(value for tags in tag_sets
+                            for k, value in tags if k == key))
+        if len(values) <= ebs.MAX_FILTER_VALUES:
+            filters.append({'Name': 'tag:{}'.format(key), 'Values': values})
+
+    return filters
+
+
+def _matching(resources, tag_sets):
+    tag_sets = [frozenset(tags) for tags in tag_sets]
+    return (resource for resource in resources
+            if any(_has_tags(resource, tags) for tags in tag_sets))
+
+
+class _VolumeIndex(object):
+    # Volumes matching a tag set, split by the instances they are attached to,
+    # and by AZ if available
+    def __init__(self, volumes):
+        self.attached = defaultdict(list)
+        self.available = defaultdict(dict)
+        for volume in volumes:
+            for instance_id in ebs.attached_instance_ids(volume):
+                self.attached[instance_id].append(volume)
+
+            if ebs.is_volume_available(volume):
+                az = volume.availability_zone
+                self.available[az][volume.volume_id] = volume
+
+
+class Inventory(object):
+    # In-memory set of volumes and snapshots, providing the same lookups as
+    # the `ebs` module, such that it can be used in its place by
+    # `ResourceState`. Lookups are indexed by tag set, such that repeating
+    # them for many instances is cheap.
+    #
+    # An offline inventory is expected to contain every snapshot, and the
+    # snapshot IDs with fast restore enabled in each AZ, such that no lookups
+    # fall back to the API.
+
+    def __init__(self, volumes=(), snapshots=(), fast_restore_ids=None,
+                 offline=False):
+        self.volumes = list(volumes)
+        # Fetched inventories only hold the best snapshots of each lookup
+        self.snapshots = None if snapshots is None else list(snapshots)
+        self.fast_restore_ids = fast_restore_ids or {}
+        self.offline = offline
+
+        self._volume_indexes = {}
+        self._snapshots_by_tags = {}
+        self._best_snapshots = {}
+        self._snapshots_by_volume = None
+
+    @classmethod
+    def fetch(cls, volume_tag_sets, snapshot_tag_sets, page_size=None,
+              scorers=None):
+        # Fetch the volumes and snapshots of many tag sets in a single scan
+        # of each. Only the best snapshot for each tag set and its scorer (if
+        # any) is kept, such that memory usage does not grow with the number
+        # of snapshots. Lookups with other tag sets or scorers fall back to
+        # the API.
+        volume_filters = shared_tag_filters(volume_tag_sets)
+        volume_filters.append({'Name': 'status',
+                               'Values': ['creating', 'available', 'in-use']})
+        volumes = list(_matching(ebs._describe_volumes(volume_filters),
+                                 volume_tag_sets))
+
+        inventory = cls(volumes, snapshots=None)
+
+        queries = []
+        for i, search_tags in enumerate(snapshot_tag_sets):
+            scorer = scorers[i] if scorers else None
+            if scorer:
+                scorer.prepare()
+            queries.append((inventory._best_snapshot_key(search_tags, scorer),
+                            frozenset(search_tags), scorer))
+
+        best = {}
+        snapshot_filters = shared_tag_filters(snapshot_tag_sets)
+        snapshot_filters.append({'Name': 'status', 'Values': ['completed']})
+        snapshots = ebs._describe_snapshots(snapshot_filters, page_size)
+        count = 0
+        for snapshot in snapshots:
+            count += 1
+            for key, search_tags, scorer in queries:
+                if _has_tags(snapshot, search_tags):
+                    ebs.keep_best_snapshot(best, key, snapshot, scorer)
+
+        for key, _, _ in queries:
+            inventory._best_snapshots[key] = \
+                best[key][1] if key in best else None
+
+        logger.info('Fetched inventory of %d volumes and %d snapshots',
+                    len(volumes), count)
+        return inventory
+
+    def _volume_index(self, id_tags):
+        key = frozenset(id_tags)
+        index = self._volume_indexes.get(key)
+        if index is None:
+            index = _VolumeIndex(v for v in self.volumes if _has_tags(v, key))
+            self._volume_indexes[key] = index
+
+        return index
+
+    def _prepare(self, scorer):
+        if self.offline and scorer.fast_restore_ids is None:
+            scorer.fast_restore_ids = self.fast_restore_ids.get(
+                scorer.availability_zone, set())
+
+        scorer.prepare()
+
+    def find_volumes(self, id_tags, instance_info, cache=None):
+        instance_id = instance_info['InstanceId']
+        availability_zone = instance_info['Placement']['AvailabilityZone']
+
+        index = self._volume_index(id_tags)
+        attached = list(index.attached.get(instance_id, []))
+        available = list(index.available.get(availability_zone, {}).values())
+        other_az = [volume for az, volumes in index.available.items()
+                    if az != availability_zone for volume in volumes.values()]
+
+        random.shuffle(available)
+        random.shuffle(other_az)
+        return attached, available, other_az
+
+    def claim_volume(self, volume_id):
+        # Stop offering a volume as available, such as after planning to
+        # attach it to an instance
+        for index in self._volume_indexes.values():
+            for volumes in index.available.values():
+                volumes.pop(volume_id, None)
+
+    def _tagged_snapshots(self, search_tags):
+        key = frozenset(search_tags)
+        snapshots = self._snapshots_by_tags.get(key)
+        if snapshots is None:
+            snapshots = [s for s in self.snapshots if _has_tags(s, key)]
+            self._snapshots_by_tags[key] = snapshots
+
+        return snapshots
+
+    def _best_snapshot_key(self, search_tags, scorer):
+        key = frozenset(search_tags)
+        if scorer:
+            key = (key, repr(scorer.cache_key()))
+
+        return key
+
+    def find_existing_snapshot(self, search_tags=(), page_size=None,
+                               cache=None, scorer=None, regions=()):
+        if regions and not self.offline:
+            # Only the current region is part of the inventory
+            return ebs.find_existing_snapshot(
+                search_tags=search_tags, page_size=page_size, cache=cache,
+                scorer=scorer, regions=regions)
+
+        key = self._best_snapshot_key(search_tags, scorer)
+        if key not in self._best_snapshots and self.snapshots is None:
+            # Not one of the lookups of a fetched inventory
+            return ebs.find_existing_snapshot(
+                search_tags=search_tags, page_size=page_size, cache=cache,
+                scorer=scorer)
+
+        if scorer:
+            self._prepare(scorer)
+
+        if key not in self._best_snapshots:
+            best = ebs.best_snapshots(self._tagged_snapshots(search_tags),
+                                      scorer)
+            self._best_snapshots[key] = best[None][1] if best else None
+
+        return self._best_snapshots[key]
+
+    def find_snapshots_by_volume(self, volume_ids, page_size=None,
+                                 scorer=None):
+        if not self.offline:
+            # Snapshots of arbitrary volumes are not part of the inventory
+            return ebs.find_snapshots_by_volume(
+                volume_ids, page_size=page_size, scorer=scorer)
+
+        if scorer:
+            self._prepare(scorer)
+
+        if self._snapshots_by_volume is None:
+            self._snapshots_by_volume = defaultdict(list)
+            for snapshot in self.snapshots:
+                self._snapshots_by_volume[snapshot.volume_id].append(snapshot)
+
+        snapshots = (snapshot for volume_id in volume_ids
+                     for snapshot in self._snapshots_by_volume[volume_id])
+        return ebs.best_snapshots(snapshots, scorer, group_by='volume_id')
@@ -1,16 +1,31 @@
 from __future__ import unicode_literals
-from builtins import str, bytes
 
 import argparse
+import copy
 import json
 import logging
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from . import ebs
+from botocore.exceptions import ClientError
+
+from . import clients, ebs, filesystem, hydrate, imds, ratelimit
+from .cache import InventoryCache
+from .metrics import RunMetrics
+from .scoring import FACTORS, SnapshotScorer
+from .timing import Timings
+from .waiters import Waiter
 
 
 logger = logging.getLogger('ebs-snatcher.main')
 
+# Arguments holding lists of tags, which are parsed from KEY=VALUE strings
+# when overridden
+TAG_ARGS = set(['volume_id_tag', 'snapshot_search_tag', 'volume_extra_tag',
+                'snapshot_prefer_tag'])
+
 
 def get_args():  # pragma: no cover
     argp = argparse.ArgumentParser(
@@ -19,24 +34,31 @@ def get_args():  # pragma: no cover
     argp.add_argument(
         '--instance-id', metavar='ID', required=True,
         help='Instance ID to attach volumes to')
+    add_volume_args(argp)
+
+    return argp.parse_args()
+
+
+def add_volume_args(argp, required=True):  # pragma: no cover
     argp.add_argument(
         '--volume-id-tag', metavar='KEY=VALUE', type=key_tag_pair,
-        required=True, action='append',
+        required=required, action='append',
         help='Tag used to identify desired volumes. Will be used to search '
              'currently attached volumes to determine if a new one is needed '
              'and applied to new volumes. Can be provided multiple times, in '
              'which case tags will be combined as an AND condition.')
     argp.add_argument(
-        '--volume-size', metavar='GB', type=positive_int, required=True,
+        '--volume-size', metavar='GB', type=positive_int,
+        required=required,
         help='Size to assign to newly created volumes, in GBs.')
     argp.add_argument(
         '--snapshot-search-tag', metavar='KEY=VALUE', type=key_tag_pair,
-        required=True, action='append',
+        required=required, action='append',
         help='Tag used to identify snapshots to create new volumes from.'
              'Can be provided multiple times, in which case tags will be '
              'combined as an AND condition.')
     argp.add_argument(
-        '--attach-device', metavar='PATH|auto', required=True,
+        '--attach-device', metavar='PATH|auto', required=required,
         help='Name of device to use when attaching a volume, such as '
              '"/dev/sdb". Can be set to "auto" to use a safe default. '
              'Device names found to be already in use will be skipped, and the '
@@ -53,8 +75,10 @@ def get_args():  # pragma: no cover
              'volumes')
     argp.add_argument(
         '--volume-type', metavar='TYPE', choices=ebs.VOLUME_TYPES,
-        default='gp2',
-        help='Volume type to use for newly created volumes')
+        default=None,
+        help='Volume type to use for newly created volumes (default: '
+             '{}). With --modify-attached, attached volumes are only changed '
+             'to this type if given'.format(ebs.DEFAULT_VOLUME_TYPE))
     argp.add_argument(
         '--volume-iops', metavar='COUNT', type=positive_int, default=None,
         help='Number of provisioned I/O operations to assign to newly created '
@@ -66,8 +90,164 @@ def get_args():  # pragma: no cover
              "current one, instead of skipping it and looking for snapshots "
              "by tag, try to move it to the current AZ, by cloning it and "
              "deleting the original.")
-
-    return argp.parse_args()
+    argp.add_argument(
+        '--volume-count', metavar='COUNT', type=positive_int, default=1,
+        help='Number of volumes to provision, such as for use in a RAID '
+             'array. When greater than one, all volumes matching the '
+             'identification tags are treated as members of a single set. '
+             'Missing members are created from scratch concurrently.')
+    argp.add_argument(
+        '--snapshot-weight', metavar='FACTOR=WEIGHT', type=score_weight,
+        action='append',
+        help='Weight of a factor in the score used to pick snapshots, which '
+             'will be the one with highest score. Factors are "fsr" (1 if fast '
+             'snapshot restore is enabled in the instance\'s AZ), "age" '
+             '(negated age in days), "size" (1 if at least --volume-size) '
+             'and "tag" (number of --snapshot-prefer-tag matches). Can be '
+             'provided multiple times. Defaults to picking the newest '
+             'snapshot (age=1).')
+    argp.add_argument(
+        '--snapshot-prefer-tag', metavar='KEY=VALUE', type=key_tag_pair,
+        action='append',
+        help='Tag that increases the score of snapshots having it, with the '
+             'weight of the "tag" factor. Can be provided multiple times.')
+    argp.add_argument(
+        '--snapshot-page-size', metavar='COUNT', type=snapshot_page_size,
+        default=None,
+        help='Number of snapshots to request per page when searching for '
+             'snapshots, between {} and {}. Defaults to the AWS API '
+             'default.'.format(*ebs.SNAPSHOT_PAGE_SIZES))
+    argp.add_argument(
+        '--snapshot-region', metavar='REGION', action='append',
+        help='Additional region to search for snapshots, at the same time as '
+             'the current one. If the best snapshot is found in another '
+             'region, it is copied to the current one before creating the '
+             'volume. Can be provided multiple times.')
+    argp.add_argument(
+        '--snapshot-copy-timeout', metavar='SECONDS', type=positive_float,
+        default=7200.0,
+        help='Maximum time to wait for a snapshot copied from another region '
+             'to complete')
+    argp.add_argument(
+        '--device-timeout', metavar='SECONDS', type=positive_float,
+        default=100.0,
+        help='Maximum time to wait for the device of an attached volume to '
+             'appear in the system')
+    argp.add_argument(
+        '--device-poll-interval', metavar='SECONDS', type=positive_float,
+        default=0.5,
+        help='Interval between checks for the device of an attached volume, '
+             'in case change notifications for /dev are not available')
+    argp.add_argument(
+        '--wait-initial-delay', metavar='SECONDS', type=positive_float,
+        default=1.0,
+        help='Initial interval between checks when waiting for volumes to '
+             'change state. Grows exponentially (with some random jitter) '
+             'after each check.')
+    argp.add_argument(
+        '--wait-max-delay', metavar='SECONDS', type=positive_float,
+        default=15.0,
+        help='Maximum interval between checks when waiting for volumes to '
+             'change state')
+    argp.add_argument(
+        '--wait-timeout', metavar='SECONDS', type=positive_float,
+        default=600.0,
+        help='Maximum time to wait for a volume to change state')
+    argp.add_argument(
+        '--cache-dir', metavar='PATH', default=None,
+        help='Directory to cache volume and snapshot lookups in, such that '
+             'repeated runs can skip them. Disabled by default.')
+    argp.add_argument(
+        '--cache-ttl', metavar='SECONDS', type=positive_float, default=300.0,
+        help='Maximum age of cached lookups to use')
+    argp.add_argument(
+        '--claim-lease', metavar='SECONDS', type=positive_float,
+        default=120.0,
+        help='Time for which a claim on an available volume holds, keeping '
+             'other instances from picking it while it is being attached')
+    argp.add_argument(
+        '--claim-settle-delay', metavar='SECONDS', type=positive_float,
+        default=1.0,
+        help='Time to wait after claiming an available volume before '
+             'checking that the claim was not overwritten by another '
+             'instance')
+    argp.add_argument(
+        '--modify-attached', action='store_true', default=False,
+        help='If a volume is already attached to the instance, modify it to '
+             'match --volume-size, --volume-type and --volume-iops, instead '
+             'of leaving it unchanged. Volumes are never shrunk.')
+    argp.add_argument(
+        '--grow-filesystem', action='store_true', default=False,
+        help='After growing an attached volume with --modify-attached, also '
+             'grow its last partition (if partitioned) and its ext2/3/4 or '
+             'XFS filesystem (which must be mounted)')
+    argp.add_argument(
+        '--timings', action='store_true', default=False,
+        help='Include the time spent in each phase of provisioning, the AWS '
+             'API calls made in each, and the totals of API calls and rate '
+             'limit waits in the output')
+    argp.add_argument(
+        '--metrics-file', metavar='PATH', default=None,
+        help='File to write Prometheus metrics of provisioning runs to, such '
+             'as in the directory of the node_exporter textfile collector. '
+             'Replaced atomically after each run.')
+    argp.add_argument(
+        '--hydrate', action='store_true', default=False,
+        help='After creating a volume from a snapshot, read the whole device '
+             'once, such that all of its blocks are loaded from the snapshot '
+             'before it is used')
+    argp.add_argument(
+        '--hydrate-readers', metavar='COUNT', type=positive_int, default=8,
+        help='Number of concurrent readers to use for hydration')
+    argp.add_argument(
+        '--hydrate-block-size', metavar='KB', type=positive_int,
+        default=1024,
+        help='Size of each read made during hydration, in KBs. Rounded down '
+             'to a multiple of 4KB.')
+    argp.add_argument(
+        '--hydrate-rate-limit', metavar='MB/S', type=positive_float,
+        default=None,
+        help='Maximum rate to read at during hydration, in MBs per second. '
+             'Unlimited by default.')
+    argp.add_argument(
+        '--instance-metadata', action='store_true', default=False,
+        help='Read the instance information and account ID from the local '
+             'instance metadata service (IMDSv2) instead of the EC2 and STS '
+             'APIs. Falls back to the APIs if the metadata is unavailable or '
+             'belongs to a different instance.')
+    argp.add_argument(
+        '--parallel-survey', action='store_true', default=False,
+        help='Start all volume and snapshot lookups at once instead of one '
+             'after another, then pick the result in the usual order of '
+             'preference. Reduces latency at the cost of extra API calls.')
+    argp.add_argument(
+        '--aws-profile', metavar='NAME', default=None,
+        help='Name of the AWS credentials profile to use. Defaults to the '
+             'usual credential lookup of boto3.')
+    argp.add_argument(
+        '--aws-max-connections', metavar='COUNT', type=positive_int,
+        default=None,
+        help='Maximum number of HTTPS connections to keep open to each AWS '
+             'service, shared by all threads. Defaults to {}, or the number '
+             'of workers if greater.'.format(
+                 clients.DEFAULT_MAX_POOL_CONNECTIONS))
+    argp.add_argument(
+        '--api-describe-rate', metavar='CALLS/S', type=positive_float,
+        default=20.0,
+        help='Maximum average rate of describe calls to AWS APIs, which are '
+             'limited separately from calls making changes. The rate is '
+             'reduced whenever calls are throttled, and slowly recovers '
+             'afterwards.')
+    argp.add_argument(
+        '--api-mutate-rate', metavar='CALLS/S', type=positive_float,
+        default=5.0,
+        help='Maximum average rate of AWS API calls making changes (such as '
+             'creating or attaching volumes)')
+    argp.add_argument(
+        '--api-rate-file', metavar='PATH', default=None,
+        help='File to keep the state of the API rate limits in, such that '
+             'all processes on the host using the same file share them. '
+             'Defaults to limiting each process separately.')
 
 
 def positive_int(s):
@@ -78,6 +258,32 @@ def positive_int(s):
     return n
 
 
+def snapshot_page_size(s):
+    n = int(s)
+    low, high = ebs.SNAPSHOT_PAGE_SIZES
+    if not low <= n <= high:
+        raise ValueError('Page size must be between {} and {}: {}'.format(
+            low, high, n))
+
+    return n
+
+
+def positive_float(s):
+    n = float(s)
+    if n <= 0:
+        raise ValueError('Value must be positive: {}'.format(n))
+
+    return n
+
+
+def score_weight(s):
+    name, weight = key_tag_pair(s)
+    if name not in FACTORS:
+        raise ValueError('Unknown factor: {}'.format(name))
+
+    return name, float(weight)
+
+
 def key_tag_pair(s):
     if isinstance(s, bytes):
         s = str(s, 'utf-8')
@@ -92,76 +298,155 @@ def key_tag_pair(s):
     return key, value
 
 
+def override_args(args, overrides):
+    new_args = copy.copy(args)
+    for key, value in overrides.items():
+        if key in TAG_ARGS and value is not None:
+            value = [key_tag_pair(v) for v in value]
+        elif key == 'snapshot_weight' and value is not None:
+            value = [score_weight(v) for v in value]
+        setattr(new_args, key, value)
+
+    return new_args
+
+
+def snapshot_scorer(args, instance_info):
+    return SnapshotScorer(
+        weights=dict(args.snapshot_weight or []),
+        availability_zone=instance_info['Placement']['AvailabilityZone'],
+        min_size=args.volume_size,
+        preferred_tags=args.snapshot_prefer_tag or [])
+
+
 class ResourceState(object):
-    def __init__(self, args, instance_info):
+    def __init__(self, args, instance_info, inventory=None, local=True):
         self.args = args
         self.instance_info = instance_info
+        # Lookups are made through the `ebs` module, or a pre-fetched
+        # inventory exposing the same functions
+        self.finder = inventory or ebs
+        # Whether the instance is the one running ebs-snatcher, such that its
+        # block devices can be found, hydrated and grown
+        self.local = local
+        # Whether new volumes may be created from snapshots, rather than empty
+        self.use_snapshots = True
 
         self.state = None
         self.volume_id = None
         self.old_volume_id = None
+        # Available volumes to try attaching, in order
+        self.candidates = []
+        # Volumes in other AZs to try moving, in order, with their snapshots
+        self.move_candidates = []
+        self.move_claim = None
         self.snapshot_id = None
+        # Set while the snapshot found in another region is not yet copied
+        self.remote_snapshot = None
+        self.snapshot_copied_from = None
         self.attached_device = None
+        self.device_wait_time = None
+        self.device_found = False
+        self.hydration = None
+        self.modification = None
+        self.filesystem = None
+
+        self.timings = Timings()
+        self.waiter = Waiter(initial_delay=args.wait_initial_delay,
+                             max_delay=args.wait_max_delay,
+                             timeout=args.wait_timeout)
+        self.snapshot_reason = None
+        self.scorer = snapshot_scorer(args, instance_info)
+
+        self.cache = None
+        if args.cache_dir:
+            self.cache = InventoryCache(args.cache_dir, args.cache_ttl)
+
+    def _lookups(self):
+        lookups = {
+            'volumes': partial(self.finder.find_volumes,
+                               self.args.volume_id_tag, self.instance_info,
+                               cache=self.cache)
+        }
+
+        if not self.args.move_to_current_az:
+            lookups['snapshot'] = partial(
+                self.finder.find_existing_snapshot,
+                search_tags=self.args.snapshot_search_tag,
+                page_size=self.args.snapshot_page_size,
+                cache=self.cache,
+                scorer=self.scorer,
+                regions=self.args.snapshot_region or ())
+
+        return lookups
 
     def survey(self):
-        logger.debug('Looking up currently attached volumes')
-
-        attached_volumes = \
-            ebs.find_attached_volumes(self.args.volume_id_tag,
-                                      self.instance_info)
+        with self.timings.phase('survey'):
+            lookups = self._lookups()
+            if not self.args.parallel_survey:
+                self._survey(lambda name: lookups[name]())
+                return
+
+            logger.debug('Starting all survey lookups in parallel')
+            with ThreadPoolExecutor(max_workers=len(lookups)) as executor:
+                futures = dict(
+                    (name, executor.submit(self.timings.bind(lookup)))
+                    for name, lookup in lookups.items())
+                self._survey(lambda name: futures[name].result())
+
+    def _survey(self, lookup):
+        logger.debug('Looking up existing volumes')
+
+        attached_volumes, volumes, other_az_volumes = lookup('volumes')
         if attached_volumes:
-            volume_id = attached_volumes[0]['VolumeId']
-            attached_device = attached_volumes[0]['Attachments'][0]['Device']
+            volume_id = attached_volumes[0].volume_id
+            attached_device = attached_volumes[0].attachments[0].device
             logger.info(
                 'Found volume already attached to instance: %s', volume_id)
 
             self.state = 'present'
             self.volume_id = volume_id
             self.attached_device = attached_device
+            self.plan_modification(attached_volumes[0])
             return
 
-        logger.debug('Looking up existing available volumes in AZ')
-
-        volumes = \
-            ebs.find_available_volumes(self.args.volume_id_tag,
-                                       self.instance_info, current_az=True)
         if volumes:
             logger.info(
                 'Found available volumes with given specifications in current '
                 'AZ: %s',
-                ', '.join(map(lambda v: v['VolumeId'], volumes)))
+                ', '.join(v.volume_id for v in volumes))
 
             self.state = 'attached'
-            self.volume_id = random.choice(volumes)['VolumeId']
+            self.candidates = [v.volume_id for v in
+                               random.sample(volumes, len(volumes))]
+            self.volume_id = self.candidates[0]
             return
 
         if self.args.move_to_current_az:
             logger.info('Did not find any available volumes in current AZ. '
                         'Searching for available volumes to move in other AZ')
 
-            other_az_volumes = \
-                ebs.find_available_volumes(self.args.volume_id_tag,
-                                           self.instance_info,
-                                           current_az=False)
-            for old_volume in other_az_volumes:
-                old_volume_id = old_volume['VolumeId']
-                old_az = old_volume['AvailabilityZone']
+            volumes_by_id = dict((v.volume_id, v) for v in other_az_volumes)
+            candidates = self.finder.find_snapshots_by_volume(
+                volumes_by_id, page_size=self.args.snapshot_page_size,
+                scorer=self.scorer)
+
+            if candidates:
+                # Prefer the volumes with the best snapshots, trying the next
+                # ones if they are claimed by other instances
+                self.move_candidates = [
+                    (volume_id, snapshot) for volume_id, (_, snapshot) in
+                    sorted(candidates.items(), key=lambda item: item[1][0],
+                           reverse=True)]
+                old_volume_id, snapshot = self.move_candidates[0]
+                old_az = volumes_by_id[old_volume_id].availability_zone
                 new_az = self.instance_info['Placement']['AvailabilityZone']
+                logger.info(
+                    'Found volume %s in AZ %s, will attempt to move '
+                    'it to current AZ %s. Using snapshot %s.',
+                    old_volume_id, old_az, new_az, snapshot.snapshot_id)
 
-                filters = [{'Name': 'volume-id', 'Values': [old_volume_id]}]
-                snapshot = ebs.find_existing_snapshot(filters=filters)
-
-                if snapshot:
-                    snapshot_id = snapshot['SnapshotId']
-                    logger.info(
-                        'Found volume %s in AZ %s, will attempt to move '
-                        'it to current AZ %s. Using snapshot %s.',
-                        old_volume_id, old_az, new_az, snapshot_id)
-
-                    self.state = 'created'
-                    self.snapshot_id = snapshot_id
-                    self.old_volume_id = old_volume_id
-                    break
+                self.state = 'created'
+                self._use_move_candidate(old_volume_id, snapshot)
             else:
                 logger.info('Did not find any available volumes in other AZ '
                             'move. Creating new volume from scratch.')
@@ -170,66 +455,462 @@ class ResourceState(object):
             logger.info('Did not find any available volumes. Searching for a '
                         'suitable snapshot instead')
 
-            snapshot = ebs.find_existing_snapshot(
-                search_tags=self.args.snapshot_search_tag)
             self.state = 'created'
-            self.snapshot_id = snapshot and snapshot['SnapshotId']
+            self._use_snapshot(lookup('snapshot'))
+
+    def _use_move_candidate(self, old_volume_id, snapshot):
+        self.snapshot_id = snapshot.snapshot_id
+        self.snapshot_reason = snapshot.score_reason
+        self.old_volume_id = old_volume_id
+
+    def _use_snapshot(self, snapshot):
+        if not snapshot:
+            return
+
+        logger.info('Found snapshot %s (%s)', snapshot.snapshot_id,
+                    snapshot.score_reason)
+        self.snapshot_id = snapshot.snapshot_id
+        self.snapshot_reason = snapshot.score_reason
+        if snapshot.region:
+            logger.info('Snapshot %s is in region %s, will copy it to the '
+                        'current region', snapshot.snapshot_id,
+                        snapshot.region)
+            self.remote_snapshot = snapshot
+
+    def plan_modification(self, volume):
+        # Find the changes needed for an attached volume to match the
+        # requested size, type and IOPS
+        if not self.args.modify_attached:
+            return
+
+        changes = {}
+        if volume.size is not None and self.args.volume_size > volume.size:
+            changes['size'] = self.args.volume_size
+        elif volume.size is not None and self.args.volume_size < volume.size:
+            logger.warning('Volume %s is larger than requested (%d GB), but '
+                           'volumes can not be shrunk', volume.volume_id,
+                           volume.size)
+
+        # Only change the type if explicitly requested, as the default for
+        # new volumes might be worse than what is attached
+        if self.args.volume_type and \
+                self.args.volume_type != volume.volume_type:
+            changes['volume_type'] = self.args.volume_type
+        if self.args.volume_iops and self.args.volume_iops != volume.iops:
+            changes['iops'] = self.args.volume_iops
+
+        if changes:
+            logger.info('Volume %s will be modified: %s', volume.volume_id,
+                        ', '.join('{}={}'.format(k, v)
+                                  for k, v in sorted(changes.items())))
+            self.state = 'modified'
+            self.modification = changes
 
     def converge(self):
-        if not self.volume_id:
-            availability_zone = \
-                self.instance_info['Placement']['AvailabilityZone']
-            logger.info('About to create volume in AZ %s', availability_zone)
+        try:
+            self._converge()
+        finally:
+            # Let other instances move the old volume if it was not deleted
+            if self.move_claim:
+                ebs.release_volume(self.old_volume_id, self.move_claim)
+                self.move_claim = None
+
+            # Anything cached is now outdated if volumes were changed
+            if self.cache and self.state != 'present':
+                self.cache.invalidate()
+
+    def _copy_snapshot(self):
+        snapshot = self.remote_snapshot
+        self.snapshot_id = ebs.copy_snapshot(
+            snapshot,
+            kms_key_id=self.args.encrypt_kms_key_id,
+            waiter=self.waiter,
+            timeout=self.args.snapshot_copy_timeout)
+        self.snapshot_copied_from = {'region': snapshot.region,
+                                     'snapshot_id': snapshot.snapshot_id}
+        self.remote_snapshot = None
+
+    def _attach_candidate(self):
+        # Other instances might be racing for the same available volumes, so
+        # claim each before attaching it, moving on to the next one if it is
+        # taken. Attaching is the final arbiter, in case claims still clash.
+        for volume_id in self.candidates:
+            claim = ebs.claim_volume(
+                volume_id, self.instance_info['InstanceId'],
+                lease=self.args.claim_lease,
+                settle_delay=self.args.claim_settle_delay)
+            if not claim:
+                continue
+
+            try:
+                self.attached_device = ebs.attach_volume(
+                    volume_id=volume_id,
+                    instance_info=self.instance_info,
+                    device_name=self.args.attach_device,
+                    waiter=self.waiter)
+            except (ClientError, ebs.VolumeTakenError) as e:
+                if not ebs.is_volume_taken_error(e):
+                    raise
+
+                logger.info('Volume %s was taken while attaching it',
+                            volume_id)
+                continue
+            finally:
+                ebs.release_volume(volume_id, claim)
 
-            if not self.snapshot_id:
-                logger.info('Creating volume from scratch')
-            else:
-                logger.info('Creating volume from snapshot %s',
-                            self.snapshot_id)
+            self.volume_id = volume_id
+            return True
+
+        return False
+
+    def _claim_move_candidate(self):
+        # Instances starting together would all pick the same volume to move,
+        # and race to delete it after cloning it, so claim it first, moving
+        # on to the next one if it is taken. The claim goes away with the
+        # volume once it is deleted.
+        for old_volume_id, snapshot in self.move_candidates:
+            claim = ebs.claim_volume(
+                old_volume_id, self.instance_info['InstanceId'],
+                lease=self.args.claim_lease,
+                settle_delay=self.args.claim_settle_delay)
+            if claim:
+                if old_volume_id != self.old_volume_id:
+                    logger.info('Moving volume %s instead, using snapshot %s',
+                                old_volume_id, snapshot.snapshot_id)
+
+                self._use_move_candidate(old_volume_id, snapshot)
+                self.move_claim = claim
+                return True
+
+        logger.info('All volumes in other AZs were taken by other instances, '
+                    'creating a new volume from scratch instead')
+        self.snapshot_id = None
+        self.snapshot_reason = None
+        self.old_volume_id = None
+        return False
 
-            new_volume = ebs.create_volume(
-                id_tags=self.args.volume_id_tag,
-                extra_tags=self.args.volume_extra_tag,
-                availability_zone=availability_zone,
-                volume_type=self.args.volume_type,
-                size=self.args.volume_size,
-                iops=self.args.volume_iops,
-                kms_key_id=self.args.encrypt_kms_key_id,
-                src_snapshot_id=self.snapshot_id)
+    def _fall_back_to_create(self):
+        logger.info('All available volumes were taken by other instances, '
+                    'creating a new one instead')
+        self.state = 'created'
+        self.volume_id = None
 
-            self.volume_id = new_volume['VolumeId']
+        lookups = self._lookups()
+        if self.use_snapshots and 'snapshot' in lookups:
+            self._use_snapshot(lookups['snapshot']())
 
-        if not self.attached_device:
-            self.attached_device = ebs.attach_volume(
-                volume_id=self.volume_id,
-                instance_info=self.instance_info,
-                device_name=self.args.attach_device)
+    def _converge(self):
+        if self.candidates and not self.attached_device:
+            with self.timings.phase('attach'):
+                attached = self._attach_candidate()
+            if not attached:
+                with self.timings.phase('survey'):
+                    self._fall_back_to_create()
+
+        if self.remote_snapshot:
+            with self.timings.phase('copy'):
+                self._copy_snapshot()
+
+        if not self.volume_id:
+            with self.timings.phase('create'):
+                if self.move_candidates:
+                    self._claim_move_candidate()
+                self._create_volume()
 
-        self.attached_device = \
-            ebs.find_system_block_device(self.volume_id, self.attached_device)
+        if not self.attached_device:
+            with self.timings.phase('attach'):
+                self.attached_device = ebs.attach_volume(
+                    volume_id=self.volume_id,
+                    instance_info=self.instance_info,
+                    device_name=self.args.attach_device,
+                    waiter=self.waiter)
+
+        # Devices of other instances never appear here, so they keep the
+        # device they were attached as
+        if self.local:
+            self._find_device()
+
+        if self.modification:
+            with self.timings.phase('modify'):
+                self._modify_volume()
 
         if self.old_volume_id:
-            ebs.delete_volume(volume_id=self.old_volume_id)
+            with self.timings.phase('delete'):
+                ebs.delete_volume(volume_id=self.old_volume_id,
+                                  waiter=self.waiter)
+                self.move_claim = None
+
+    def _create_volume(self):
+        availability_zone = self.instance_info['Placement']['AvailabilityZone']
+        logger.info('About to create volume in AZ %s', availability_zone)
+
+        if not self.snapshot_id:
+            logger.info('Creating volume from scratch')
+        else:
+            logger.info('Creating volume from snapshot %s', self.snapshot_id)
+
+        new_volume = ebs.create_volume(
+            id_tags=self.args.volume_id_tag,
+            extra_tags=self.args.volume_extra_tag,
+            availability_zone=availability_zone,
+            volume_type=self.args.volume_type or ebs.DEFAULT_VOLUME_TYPE,
+            size=self.args.volume_size,
+            iops=self.args.volume_iops,
+            kms_key_id=self.args.encrypt_kms_key_id,
+            src_snapshot_id=self.snapshot_id,
+            waiter=self.waiter)
+
+        self.volume_id = new_volume.volume_id
+
+    def _find_device(self):
+        with self.timings.phase('device'):
+            start = time.time()
+            device = ebs.find_system_block_device(
+                self.volume_id, self.attached_device,
+                timeout=self.args.device_timeout,
+                poll_interval=self.args.device_poll_interval,
+                fallback=False)
+            self.device_found = device is not None
+            self.attached_device = device or self.attached_device
+            self.device_wait_time = round(time.time() - start, 3)
+
+    def _modify_volume(self):
+        ebs.modify_volume(self.volume_id, waiter=self.waiter,
+                          **self.modification)
+        if 'size' not in self.modification or not self.args.grow_filesystem:
+            return
+
+        if self.local:
+            self.filesystem = filesystem.grow_filesystem(self.attached_device)
+        else:
+            logger.warning('Not growing the filesystem of volume %s, as it is '
+                           'attached to another instance', self.volume_id)
+
+    def hydrate(self):
+        # Only volumes created from snapshots need to be hydrated
+        if self.state != 'created' or not self.snapshot_id:
+            return
+        if not self.local:
+            logger.warning('Not hydrating volume %s, as it is attached to '
+                           'another instance', self.volume_id)
+            return
+        if not self.device_found:
+            logger.warning('Not hydrating volume %s, as its block device was '
+                           'not found', self.volume_id)
+            return
+
+        rate_limit = self.args.hydrate_rate_limit
+        with self.timings.phase('hydrate'):
+            self.hydration = hydrate.hydrate(
+                self.attached_device,
+                readers=self.args.hydrate_readers,
+                block_size=self.args.hydrate_block_size * 1024,
+                rate_limit=rate_limit and rate_limit * 1024 * 1024)
 
     def to_json(self):
-        return {'volume_id': self.volume_id,
-                'attached_device': self.attached_device,
-                'result': self.state,
-                'src_snapshot_id': self.snapshot_id}
+        result = {'volume_id': self.volume_id,
+                  'attached_device': self.attached_device,
+                  'result': self.state,
+                  'src_snapshot_id': self.snapshot_id,
+                  'src_snapshot_reason': self.snapshot_reason,
+                  'src_snapshot_copied_from': self.snapshot_copied_from,
+                  'modification': self.modification,
+                  'filesystem': self.filesystem,
+                  'device_wait_time': self.device_wait_time,
+                  'wait_times': dict((name, round(seconds, 3)) for name, seconds
+                                     in self.waiter.timings.items()),
+                  'hydration': self.hydration}
+        if self.args.timings:
+            result['timings'] = self.timings.to_json()
+
+        return result
+
+
+class VolumeSetState(object):
+    def __init__(self, args, instance_info, inventory=None, local=True):
+        self.args = args
+        self.instance_info = instance_info
+        self.finder = inventory or ebs
+        self.local = local
+
+        self.members = []
+        # Phases of each member are timed separately
+        self.timings = Timings()
+
+    def _add_member(self, state, volume=None):
+        member = ResourceState(copy.copy(self.args), self.instance_info,
+                               local=self.local)
+        # Snapshots hold the data of a single volume, so members of a set are
+        # always created empty
+        member.use_snapshots = False
+        member.state = state
+        if volume:
+            member.volume_id = volume.volume_id
+        if state == 'attached':
+            member.candidates = [volume.volume_id]
+        if state == 'present':
+            member.attached_device = volume.attachments[0].device
+            member.plan_modification(volume)
+
+        self.members.append(member)
+
+    def survey(self):
+        count = self.args.volume_count
+        cache = None
+        if self.args.cache_dir:
+            cache = InventoryCache(self.args.cache_dir, self.args.cache_ttl)
 
+        with self.timings.phase('survey'):
+            attached_volumes, volumes, _ = self.finder.find_volumes(
+                self.args.volume_id_tag, self.instance_info, cache=cache)
 
-def main():
-    logging.basicConfig(level=logging.DEBUG)
+        for volume in attached_volumes[:count]:
+            self._add_member('present', volume)
 
-    args = get_args()
+        for volume in volumes[:count - len(self.members)]:
+            self._add_member('attached', volume)
 
-    instance_info = ebs.get_instance_info(args.instance_id)
+        while len(self.members) < count:
+            self._add_member('created')
 
-    resource_state = ResourceState(args, instance_info)
+        logger.info('Volume set has %d members present, %d to modify, %d to '
+                    'attach and %d to create',
+                    *[len(self._members(state)) for state in
+                      ('present', 'modified', 'attached', 'created')])
+
+        self._allocate_devices()
+
+    def _members(self, state):
+        return [m for m in self.members if m.state == state]
+
+    def _allocate_devices(self):
+        # Pick distinct device names for all members upfront, such that
+        # concurrent attachments don't compete for the same names
+        mappings = list(self.instance_info.get('BlockDeviceMappings', []))
+        device = self.args.attach_device
+        if device == 'auto':
+            device = '/dev/sdf'
+
+        for member in self.members:
+            if member.attached_device:
+                continue
+
+            device = ebs.allocate_device_name(
+                device, {'BlockDeviceMappings': mappings})
+            mappings.append({'DeviceName': device})
+            member.args.attach_device = device
+
+    def converge(self):
+        with ThreadPoolExecutor(max_workers=len(self.members)) as executor:
+            futures = [executor.submit(member.converge)
+                       for member in self.members]
+
+        # Only raise errors after all members finished converging
+        for future in futures:
+            future.result()
+
+    def hydrate(self):
+        for member in self.members:
+            member.hydrate()
+
+    @property
+    def state(self):
+        states = set(member.state for member in self.members)
+        for state in ('created', 'attached', 'modified'):
+            if state in states:
+                return state
+
+        return 'present'
+
+    def to_json(self):
+        result = {'result': self.state,
+                  'volumes': [member.to_json() for member in self.members]}
+        if self.args.timings:
+            result['timings'] = self.timings.to_json()
+
+        return result
+
+
+def configure_clients(args, max_pool_connections=None):
+    rate_limiter = ratelimit.ApiRateLimiter.create(
+        args.api_describe_rate, args.api_mutate_rate,
+        path=args.api_rate_file)
+    clients.configure(
+        profile=args.aws_profile,
+        max_pool_connections=(args.aws_max_connections or
+                              max_pool_connections),
+        rate_limiter=rate_limiter)
+
+    return rate_limiter
+
+
+def get_instance_info(args):
+    if args.instance_metadata:
+        try:
+            instance_info, account_id = imds.get_instance_identity()
+        except imds.MetadataError as e:
+            logger.warning('Failed to read instance metadata, falling back '
+                           'to the API: %s', e)
+        else:
+            if instance_info['InstanceId'] == args.instance_id:
+                ebs.set_account_id(account_id)
+                return instance_info
+
+            logger.warning('Instance metadata belongs to instance %s instead '
+                           'of %s, falling back to the API',
+                           instance_info['InstanceId'], args.instance_id)
+
+    return ebs.get_instance_info(args.instance_id)
+
+
+def new_resource_state(args, instance_info, inventory=None, local=True):
+    if args.volume_count > 1:
+        return VolumeSetState(args, instance_info, inventory, local=local)
+
+    return ResourceState(args, instance_info, inventory, local=local)
+
+
+def provision(args, instance_info, inventory=None, local=True):
+    resource_state = new_resource_state(args, instance_info, inventory,
+                                        local=local)
     resource_state.survey()
     resource_state.converge()
+    if args.hydrate:
+        resource_state.hydrate()
+
+    return resource_state
+
+
+def write_metrics(path, metrics, rate_limiter):
+    # Failing to write metrics must not hide the outcome of provisioning,
+    # including any exception being raised
+    metrics.observe_api(rate_limiter.stats())
+    try:
+        metrics.write(path)
+    except (IOError, OSError):
+        logger.exception('Failed to write metrics to %s', path)
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+
+    args = get_args()
+    rate_limiter = configure_clients(args)
 
-    print(json.dumps(resource_state.to_json()))
+    resource_state = None
+    try:
+        instance_info = get_instance_info(args)
+        resource_state = provision(args, instance_info)
+    finally:
+        if args.metrics_file:
+            metrics = RunMetrics()
+            metrics.observe_run(resource_state)
+            write_metrics(args.metrics_file, metrics, rate_limiter)
+
+    result = resource_state.to_json()
+    if args.timings:
+        result['api_calls'] = rate_limiter.stats()
+    print(json.dumps(result))
     return 0
 
 
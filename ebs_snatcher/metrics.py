@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+import os
+import time
+
+
+# Upper bounds of histogram buckets, in seconds. Provisioning steps range
+# from sub-second lookups to snapshot copies taking many minutes.
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+                   300.0, 600.0, 1800.0)
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_sample(name, labels, value):
+    label_str = ''
+    if labels:
+        label_str = '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in labels))
+
+    if isinstance(value, float):
+        value = '+Inf' if value == float('inf') else repr(value)
+
+    return '{}{} {}'.format(name, label_str, value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # Counters kept elsewhere (such as by the rate limiter) are copied
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, list(zip(self.label_names, key)), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # Bucket counts are cumulative, as in the exposition format
+        key = self._key(labels)
+        counts, total, count = self.values.get(
+            key, ([0] * len(self.buckets), 0.0, 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+
+        self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = list(zip(self.label_names, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield (self.name + '_bucket', labels + [('le', repr(bound))],
+                       bucket_count)
+
+            yield self.name + '_bucket', labels + [('le', '+Inf')], count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class RunMetrics(object):
+    # Metrics of provisioning runs, in the Prometheus text format. A single
+    # instance accumulates the runs of a long-lived process (such as the
+    # daemon), so histograms cover all of them.
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+
+        self.runs = Counter(
+            'ebs_snatcher_runs_total',
+            'Provisioning runs, by result (present, modified, attached, '
+            'created or error)', ['result'])
+        self.last_run = Gauge(
+            'ebs_snatcher_last_run_timestamp_seconds',
+            'Time the last provisioning run finished')
+        self.last_success = Gauge(
+            'ebs_snatcher_last_run_success',
+            'Whether the last provisioning run succeeded')
+        self.phases = Histogram(
+            'ebs_snatcher_phase_duration_seconds',
+            'Time spent in each phase of provisioning runs', ['phase'])
+        self.waits = Histogram(
+            'ebs_snatcher_wait_duration_seconds',
+            'Time spent waiting for volumes and snapshots to change state, '
+            'by stage', ['stage'])
+        self.api_counters = dict(
+            (counter, Counter(
+                'ebs_snatcher_api_{}_total'.format(counter),
+                'AWS API {} by call kind (describe or mutate)'.format(
+                    description), ['kind']))
+            for counter, description in [('calls', 'calls'),
+                                         ('retried', 'calls retried'),
+                                         ('throttled', 'calls throttled')])
+
+    def observe_run(self, resource_state, api_stats=None):
+        # A missing state means the run failed before finishing
+        result = resource_state.state if resource_state else 'error'
+        self.runs.inc(result=result)
+        self.last_run.set(self.clock())
+        self.last_success.set(0 if result == 'error' else 1)
+
+        if resource_state:
+            states = [resource_state] + list(
+                getattr(resource_state, 'members', []))
+            for state in states:
+                for phase, entry in state.timings.to_json().items():
+                    self.phases.observe(entry['seconds'], phase=phase)
+
+                waiter = getattr(state, 'waiter', None)
+                for stage, seconds in (waiter.timings if waiter else
+                                       {}).items():
+                    self.waits.observe(seconds, stage=stage)
+
+        self.observe_api(api_stats)
+
+    def observe_api(self, api_stats):
+        # Totals of API calls made by the whole process so far
+        for kind, counters in (api_stats or {}).items():
+            for counter, metric in self.api_counters.items():
+                metric.set(counters[counter], kind=kind)
+
+    def metrics(self):
+        return ([self.runs, self.last_run, self.last_success, self.phases,
+                 self.waits] +
+                [self.api_counters[name] for name in sorted(self.api_counters)])
+
+    def render(self):
+        lines = []
+        for metric in self.metrics():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help_text))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append(_format_sample(name, labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Write to a temporary file in the same directory first, and rename
+        # it over the target, such that collectors never see partial files
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, path)
@@ -0,0 +1,194 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from .fleet import read_manifest
+from .inventory import Inventory
+from .main import ResourceState, VolumeSetState, add_volume_args, \
+    override_args
+from .records import Snapshot, Volume
+
+
+logger = logging.getLogger('ebs-snatcher.plan')
+
+TIMESTAMP_RE = re.compile(
+    r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|([+-])(\d\d):?(\d\d))?$')
+
+
+def get_args():  # pragma: no cover
+    argp = argparse.ArgumentParser(
+        'ebs-snatcher-plan',
+        description='Plan the provisioning of AWS EBS volumes for many '
+                    'instances from an inventory dump, without making any '
+                    'changes or API calls')
+    argp.add_argument(
+        '--inventory', metavar='PATH', required=True, action='append',
+        help='JSON file containing instances, volumes and snapshots, in the '
+             'format output by the AWS CLI for describe-instances, '
+             'describe-volumes, describe-snapshots and '
+             'describe-fast-snapshot-restores. Can be provided multiple '
+             'times, in which case the contents are combined.')
+    argp.add_argument(
+        '--manifest', metavar='PATH', default=None,
+        help='File listing the instances to plan for, in the same format as '
+             'for ebs-snatcher-fleet. Defaults to all instances in the '
+             'inventory.')
+    argp.add_argument(
+        '--seed', metavar='N', type=int, default=None,
+        help='Seed for the random choice between equivalent volumes, such '
+             'that plans can be reproduced')
+    add_volume_args(argp)
+
+    return argp.parse_args()
+
+
+def parse_timestamp(s):
+    match = TIMESTAMP_RE.match(s)
+    if not match:
+        raise ValueError('Invalid timestamp: {}'.format(s))
+
+    base, fraction, tz, sign, hours, minutes = match.groups()
+    result = datetime.strptime(base, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        result += timedelta(microseconds=int(fraction[:6].ljust(6, '0')))
+
+    offset = timedelta()
+    if sign:
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        if sign == '-':
+            offset = -offset
+
+    return result.replace(tzinfo=timezone.utc) - offset
+
+
+def load_inventory(files):
+    instances = []
+    volumes = []
+    snapshots = []
+    fast_restore_ids = defaultdict(set)
+
+    for f in files:
+        data = json.load(f)
+        for reservation in data.get('Reservations', []):
+            instances.extend(reservation['Instances'])
+        instances.extend(data.get('Instances', []))
+        volumes.extend(Volume.from_boto(volume)
+                       for volume in data.get('Volumes', []))
+
+        for snapshot in data.get('Snapshots', []):
+            if snapshot.get('State', 'completed') != 'completed':
+                continue
+
+            if not isinstance(snapshot['StartTime'], datetime):
+                snapshot['StartTime'] = parse_timestamp(snapshot['StartTime'])
+            snapshots.append(Snapshot.from_boto(snapshot))
+
+        for restore in data.get('FastSnapshotRestores', []):
+            if restore.get('State', 'enabled') == 'enabled':
+                fast_restore_ids[restore['AvailabilityZone']].add(
+                    restore['SnapshotId'])
+
+    logger.info('Loaded inventory of %d instances, %d volumes and %d '
+                'snapshots', len(instances), len(volumes), len(snapshots))
+
+    instances = dict((i['InstanceId'], i) for i in instances)
+    return instances, Inventory(volumes, snapshots, fast_restore_ids,
+                                offline=True)
+
+
+def _plan_json(resource_state):
+    return {'result': resource_state.state,
+            'volume_id': resource_state.volume_id,
+            'old_volume_id': resource_state.old_volume_id,
+            'attach_device': (resource_state.attached_device or
+                              resource_state.args.attach_device),
+            'src_snapshot_id': resource_state.snapshot_id,
+            'src_snapshot_reason': resource_state.snapshot_reason,
+            'modification': resource_state.modification}
+
+
+def plan_instance(args, instance_info, inventory):
+    # Lookups are all in memory, there is nothing to gain from threads
+    args = override_args(args, {'parallel_survey': False})
+
+    if args.volume_count > 1:
+        resource_state = VolumeSetState(args, instance_info, inventory)
+        resource_state.survey()
+        members = resource_state.members
+        result = {'result': resource_state.state,
+                  'volumes': [_plan_json(member) for member in members]}
+    else:
+        resource_state = ResourceState(args, instance_info, inventory)
+        resource_state.survey()
+        members = [resource_state]
+        result = _plan_json(resource_state)
+
+    # Volumes to be attached or moved can't be used by later instances
+    for member in members:
+        if member.state == 'attached':
+            inventory.claim_volume(member.volume_id)
+        if member.old_volume_id:
+            inventory.claim_volume(member.old_volume_id)
+
+    return result
+
+
+def run_plan(args, entries, instances, inventory, out=sys.stdout):
+    failures = 0
+    for entry in entries:
+        instance_id = entry['instance_id']
+        result = {'instance_id': instance_id}
+
+        instance_info = instances.get(instance_id)
+        if instance_info is None:
+            failures += 1
+            result.update({'status': 'error',
+                           'error_type': 'ValueError',
+                           'error': 'Instance not found: {}'.format(
+                               instance_id)})
+        else:
+            result['status'] = 'ok'
+            result.update(plan_instance(override_args(args, entry),
+                                        instance_info, inventory))
+
+        out.write(json.dumps(result) + '\n')
+
+    return failures
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    files = [open(path) for path in args.inventory]
+    try:
+        instances, inventory = load_inventory(files)
+    finally:
+        for f in files:
+            f.close()
+
+    if args.manifest is None:
+        entries = [{'instance_id': instance_id}
+                   for instance_id in sorted(instances)]
+    elif args.manifest == '-':
+        entries = read_manifest(sys.stdin)
+    else:
+        with open(args.manifest) as f:
+            entries = read_manifest(f)
+
+    failures = run_plan(args, entries, instances, inventory)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
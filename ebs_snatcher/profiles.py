@@ -0,0 +1,144 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .inventory import Inventory
+from .main import add_volume_args, configure_clients, get_instance_info, \
+    override_args, provision, snapshot_scorer, write_metrics
+from .metrics import RunMetrics
+
+
+logger = logging.getLogger('ebs-snatcher.profiles')
+
+# Arguments that must be set for each profile, either in the command line or
+# in the profile itself
+REQUIRED_ARGS = ('volume_id_tag', 'volume_size', 'snapshot_search_tag',
+                 'attach_device')
+
+
+def get_args():  # pragma: no cover
+    argp = argparse.ArgumentParser(
+        'ebs-snatcher-profiles',
+        description='Provision multiple kinds of AWS EBS volumes for an '
+                    'instance at once')
+    argp.add_argument(
+        '--instance-id', metavar='ID', required=True,
+        help='Instance ID to attach volumes to')
+    argp.add_argument(
+        '--profiles', metavar='PATH', required=True,
+        help='JSON file containing a list of profiles, each an object with a '
+             'unique "name" key and overrides for any other argument. Use "-" '
+             'to read from stdin.')
+    add_volume_args(argp, required=False)
+
+    return argp.parse_args()
+
+
+def read_profiles(f):
+    profiles = json.load(f)
+    if not isinstance(profiles, list):
+        raise ValueError('Profiles must be a list of objects')
+
+    names = set()
+    for profile in profiles:
+        name = profile.get('name')
+        if not name:
+            raise ValueError('Profile missing name: {}'.format(profile))
+        if name in names:
+            raise ValueError('Duplicate profile name: {}'.format(name))
+        names.add(name)
+
+    return profiles
+
+
+def profile_args(args, profile):
+    overrides = dict(profile)
+    name = overrides.pop('name')
+
+    new_args = override_args(args, overrides)
+    missing = [key for key in REQUIRED_ARGS
+               if getattr(new_args, key, None) is None]
+    if missing:
+        raise ValueError('Profile {} missing arguments: {}'.format(
+            name, ', '.join(missing)))
+
+    return name, new_args
+
+
+def provision_profile(name, args, instance_info, inventory):
+    try:
+        resource_state = provision(args, instance_info, inventory)
+    except Exception as e:
+        logger.exception('Failed to provision volume for profile %s', name)
+        return {'status': 'error',
+                'error_type': type(e).__name__,
+                'error': str(e)}, None
+
+    result = {'status': 'ok'}
+    result.update(resource_state.to_json())
+    return result, resource_state
+
+
+def run_profiles(args, profiles, metrics=None):
+    all_args = [profile_args(args, profile) for profile in profiles]
+    if not all_args:
+        return {}
+
+    instance_info = get_instance_info(args)
+
+    # Look up volumes and snapshots for all profiles at once, then pick from
+    # them locally for each profile
+    inventory = Inventory.fetch(
+        [new_args.volume_id_tag for _, new_args in all_args],
+        [new_args.snapshot_search_tag for _, new_args in all_args],
+        page_size=args.snapshot_page_size,
+        scorers=[snapshot_scorer(new_args, instance_info)
+                 for _, new_args in all_args])
+
+    with ThreadPoolExecutor(max_workers=len(all_args)) as executor:
+        futures = [(name, executor.submit(provision_profile, name,
+                                          new_args, instance_info,
+                                          inventory))
+                   for name, new_args in all_args]
+
+    results = {}
+    for name, future in futures:
+        results[name], resource_state = future.result()
+        # Each profile is counted as a separate run
+        if metrics:
+            metrics.observe_run(resource_state)
+
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+
+    args = get_args()
+    rate_limiter = configure_clients(args)
+
+    if args.profiles == '-':
+        profiles = read_profiles(sys.stdin)
+    else:
+        with open(args.profiles) as f:
+            profiles = read_profiles(f)
+
+    metrics = RunMetrics() if args.metrics_file else None
+    try:
+        results = run_profiles(args, profiles, metrics=metrics)
+    finally:
+        if metrics:
+            write_metrics(args.metrics_file, metrics, rate_limiter)
+
+    print(json.dumps(results))
+
+    failed = any(result['status'] != 'ok' for result in results.values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,199 @@
+from __future__ import unicode_literals
+
+import fcntl
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Error codes used by AWS services to signal throttling
+THROTTLE_CODES = set([
+    'RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+    'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'SlowDown'
+])
+# Calls that only read state, which EC2 limits separately from mutating ones
+DESCRIBE_PREFIXES = ('Describe', 'Get', 'List')
+KINDS = ('describe', 'mutate')
+COUNTERS = ('calls', 'retried', 'throttled', 'wait_time')
+
+logger = logging.getLogger('ebs-snatcher.ratelimit')
+
+
+def operation_kind(operation_name):
+    if operation_name.startswith(DESCRIBE_PREFIXES):
+        return 'describe'
+
+    return 'mutate'
+
+
+class TokenBucket(object):
+    # Allows `rate` calls per second on average, in bursts of up to
+    # `capacity`. The rate is cut by the `backoff` factor whenever calls are
+    # throttled, and recovers by a `recovery` fraction of the maximum rate
+    # after each successful call.
+
+    def __init__(self, rate, capacity=None, backoff=0.5, recovery=0.05,
+                 min_rate=None, clock=time.time, sleep=time.sleep):
+        self.max_rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.backoff = backoff
+        self.recovery = recovery
+        self.min_rate = min_rate or rate / 16.0
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _initial_state(self):
+        return {'tokens': self.capacity, 'time': self.clock(),
+                'rate': self.max_rate}
+
+    def _update(self, fn):
+        # Apply `fn` to the bucket state atomically, returning its result
+        with self._lock:
+            if self._state is None:
+                self._state = self._initial_state()
+
+            return fn(self._state)
+
+    def acquire(self):
+        # Take a token, sleeping until it is available. Tokens are taken in
+        # advance (making the count negative), such that waiting callers are
+        # served in order. Returns the time spent waiting.
+        def take(state):
+            now = self.clock()
+            elapsed = max(0.0, now - state['time'])
+            tokens = min(self.capacity,
+                         state['tokens'] + elapsed * state['rate'])
+            state['tokens'] = tokens - 1
+            state['time'] = now
+            return max(0.0, (1 - tokens) / state['rate'])
+
+        delay = self._update(take)
+        if delay > 0:
+            self.sleep(delay)
+
+        return delay
+
+    def throttled(self):
+        def slow_down(state):
+            state['rate'] = max(self.min_rate, state['rate'] * self.backoff)
+            return state['rate']
+
+        rate = self._update(slow_down)
+        logger.info('Calls were throttled, reducing rate to %.2f/s', rate)
+
+    def succeeded(self):
+        def speed_up(state):
+            state['rate'] = min(self.max_rate,
+                                state['rate'] + self.max_rate * self.recovery)
+
+        self._update(speed_up)
+
+    @property
+    def rate(self):
+        return self._update(lambda state: state['rate'])
+
+
+class FileTokenBucket(TokenBucket):
+    # Token bucket stored in a file, such that all processes using the same
+    # file share it. Buckets are stored as JSON keyed by name, and the file
+    # is locked during each update.
+
+    def __init__(self, path, name, rate, **kwargs):
+        super(FileTokenBucket, self).__init__(rate, **kwargs)
+        self.path = path
+        self.name = name
+
+    def _update(self, fn):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._lock, io.open(fd, 'r+') as f:
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                buckets = json.loads(f.read() or '{}')
+            except ValueError:
+                logger.warning('Resetting corrupt rate limit file %s',
+                               self.path)
+                buckets = {}
+
+            state = buckets.get(self.name) or self._initial_state()
+            result = fn(state)
+            buckets[self.name] = state
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(buckets))
+            return result
+
+
+class ApiRateLimiter(object):
+    # Rate limits all calls made by the boto clients registered with it,
+    # with separate buckets for describe and mutating calls, and keeps
+    # counters of calls for each kind
+
+    def __init__(self, buckets, max_attempts=10):
+        self.buckets = buckets
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._counters = dict((kind, dict.fromkeys(COUNTERS, 0))
+                              for kind in buckets)
+
+    @classmethod
+    def create(cls, describe_rate, mutate_rate, path=None, **kwargs):
+        rates = {'describe': describe_rate, 'mutate': mutate_rate}
+        if path:
+            buckets = dict(
+                (kind, FileTokenBucket(path, kind, rate, **kwargs))
+                for kind, rate in rates.items())
+        else:
+            buckets = dict((kind, TokenBucket(rate, **kwargs))
+                           for kind, rate in rates.items())
+
+        return cls(buckets)
+
+    def _count(self, kind, counter, amount=1):
+        with self._lock:
+            self._counters[kind][counter] += amount
+
+    def register(self, client):
+        events = client.meta.events
+        # Wait before requests are signed, such that signatures are fresh
+        events.register_first('request-created', self._before_request)
+        events.register('needs-retry', self._after_response)
+
+    def _before_request(self, request, operation_name, **kwargs):
+        kind = operation_kind(operation_name)
+        attempt = request.context.get('retries', {}).get('attempt', 1)
+        self._count(kind, 'calls' if attempt == 1 else 'retried')
+
+        delay = self.buckets[kind].acquire()
+        if delay:
+            self._count(kind, 'wait_time', delay)
+
+    def _after_response(self, response, operation, **kwargs):
+        # Connection errors have no response, and say nothing about limits
+        if response is None:
+            return
+
+        kind = operation_kind(operation.name)
+        _, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            self._count(kind, 'throttled')
+            self.buckets[kind].throttled()
+        elif not code:
+            self.buckets[kind].succeeded()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                (kind, dict(counters, wait_time=round(counters['wait_time'],
+                                                      3)))
+                for kind, counters in self._counters.items())
@@ -0,0 +1,92 @@
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+
+# Compact records holding only the fields of volumes and snapshots that are
+# actually used, instead of whole boto response dicts. They are plain tuples
+# (without a per-instance __dict__), such that they can also be stored as JSON
+# arrays and rebuilt with `from_row`.
+
+
+def _tags(resource):
+    return tuple((tag['Key'], tag['Value'])
+                 for tag in resource.get('Tags', ()))
+
+
+def _tags_from_row(row):
+    return tuple((key, value) for key, value in row)
+
+
+_Attachment = namedtuple('Attachment', ['instance_id', 'device', 'state'])
+_Attachment.__new__.__defaults__ = (None, None)
+
+
+class Attachment(_Attachment):
+    __slots__ = ()
+
+    @classmethod
+    def from_boto(cls, attachment):
+        return cls(attachment['InstanceId'], attachment.get('Device'),
+                   attachment.get('State'))
+
+
+_Volume = namedtuple('Volume', ['volume_id', 'state', 'availability_zone',
+                                'size', 'attachments', 'tags', 'volume_type',
+                                'iops'])
+_Volume.__new__.__defaults__ = (None, None, None, (), (), None, None)
+
+
+class Volume(_Volume):
+    __slots__ = ()
+
+    @classmethod
+    def from_boto(cls, volume):
+        return cls(volume['VolumeId'],
+                   volume.get('State'),
+                   volume.get('AvailabilityZone'),
+                   volume.get('Size'),
+                   tuple(Attachment.from_boto(attachment)
+                         for attachment in volume.get('Attachments', ())),
+                   _tags(volume),
+                   volume.get('VolumeType'),
+                   volume.get('Iops'))
+
+    @classmethod
+    def from_row(cls, row):
+        (volume_id, state, availability_zone, size, attachments, tags,
+         volume_type, iops) = row
+        return cls(volume_id, state, availability_zone, size,
+                   tuple(Attachment(*attachment) for attachment in attachments),
+                   _tags_from_row(tags), volume_type, iops)
+
+
+# Snapshots found in regions other than the current one have their `region`
+# set
+_Snapshot = namedtuple('Snapshot', ['snapshot_id', 'volume_id', 'volume_size',
+                                    'start_time', 'tags', 'score_reason',
+                                    'region'])
+_Snapshot.__new__.__defaults__ = (None, None, None, (), None, None)
+
+
+class Snapshot(_Snapshot):
+    __slots__ = ()
+
+    @classmethod
+    def from_boto(cls, snapshot, region=None):
+        return cls(snapshot['SnapshotId'],
+                   snapshot.get('VolumeId'),
+                   snapshot.get('VolumeSize'),
+                   snapshot.get('StartTime'),
+                   _tags(snapshot),
+                   region=region)
+
+    @classmethod
+    def from_row(cls, row):
+        if row is None:
+            return None
+
+        (snapshot_id, volume_id, volume_size, start_time, tags, score_reason,
+         region) = row
+        return cls(snapshot_id, volume_id, volume_size, start_time,
+                   _tags_from_row(tags), score_reason, region)
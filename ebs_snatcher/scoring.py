@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timezone
+
+from . import ebs
+
+
+def _fsr_factor(scorer, snapshot):
+    enabled = snapshot.snapshot_id in scorer.fast_restore_ids
+    description = 'fast restore {} in {}'.format(
+        'enabled' if enabled else 'disabled', scorer.availability_zone)
+    return (1.0 if enabled else 0.0), description
+
+
+def _age_factor(scorer, snapshot):
+    start_time = snapshot.start_time
+    if start_time.tzinfo is None:
+        now = scorer.now.replace(tzinfo=None)
+    else:
+        now = scorer.now
+
+    days = (now - start_time).total_seconds() / 86400.0
+    return -days, '{:.1f} days old'.format(days)
+
+
+def _size_factor(scorer, snapshot):
+    size = snapshot.volume_size or 0
+    fits = scorer.min_size is None or size >= scorer.min_size
+    return (1.0 if fits else 0.0), '{} GB'.format(size)
+
+
+def _tag_factor(scorer, snapshot):
+    matches = len(scorer.preferred_tags.intersection(snapshot.tags))
+    return float(matches), '{} preferred tags'.format(matches)
+
+
+# Factors are functions of the scorer and a snapshot, returning a value
+# (where higher is better) and a human-readable description of it. The final
+# score is the sum of the values multiplied by their weights.
+FACTORS = {
+    'fsr': _fsr_factor,
+    'age': _age_factor,
+    'size': _size_factor,
+    'tag': _tag_factor
+}
+
+# Pick the newest snapshot by default
+DEFAULT_WEIGHTS = {'age': 1.0}
+
+
+class SnapshotScorer(object):
+    def __init__(self, weights=None, availability_zone=None, min_size=None,
+                 preferred_tags=(), now=None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        for name in self.weights:
+            if name not in FACTORS:
+                raise ValueError('Unknown snapshot score factor: {}'.format(
+                    name))
+
+        self.availability_zone = availability_zone
+        self.min_size = min_size
+        self.preferred_tags = set(preferred_tags)
+        self.now = now or datetime.now(timezone.utc)
+
+        self.fast_restore_ids = None
+
+    def _active_factors(self):
+        return sorted((name, weight) for name, weight in self.weights.items()
+                      if weight)
+
+    def prepare(self):
+        if self.weights.get('fsr') and self.fast_restore_ids is None:
+            self.fast_restore_ids = \
+                ebs.find_fast_restore_snapshots(self.availability_zone)
+
+    def score(self, snapshot):
+        return sum(weight * FACTORS[name](self, snapshot)[0]
+                   for name, weight in self._active_factors())
+
+    def explain(self, snapshot):
+        descriptions = [FACTORS[name](self, snapshot)[1]
+                        for name, _ in self._active_factors()]
+        return 'score {:.2f}: {}'.format(self.score(snapshot),
+                                         ', '.join(descriptions))
+
+    def cache_key(self):
+        return [self._active_factors(), self.availability_zone,
+                self.min_size, sorted(self.preferred_tags)]
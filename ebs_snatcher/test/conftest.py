@@ -9,20 +9,16 @@ from botocore import UNSIGNED
 from botocore.client import Config
 from botocore.stub import Stubber
 
+from ..records import Attachment, Volume
+from ..waiters import Waiter
+
 
 def boto3_stub(mocker, svc):
     client = boto3.client(svc, config=Config(signature_version=UNSIGNED),
                           region_name='us-east-1')
     mocker.patch('ebs_snatcher.ebs.' + svc, return_value=client)
-
-    orig_get_waiter = type(client).get_waiter
-
-    def get_waiter_no_delay(*args, **kwargs):
-        waiter = orig_get_waiter(client, *args, **kwargs)
-        waiter.config.delay = 0
-        return waiter
-
-    mocker.patch.object(client, 'get_waiter', wraps=get_waiter_no_delay)
+    # Don't actually sleep between waiter checks
+    mocker.patch.object(Waiter, 'sleep')
 
     stub = Stubber(client)
     stub.activate()
@@ -82,24 +78,10 @@ def attach_device():
 
 @pytest.fixture
 def attached_volume(volume_id, instance_id, attach_device):
-    return {
-        'VolumeId': volume_id,
-        'Attachments': [{
-            'Device': attach_device,
-            'InstanceId': instance_id
-        }]
-    }
+    return Volume(volume_id, state='in-use', attachments=(
+        Attachment(instance_id, attach_device, 'attached'),))
 
 
 @pytest.fixture
 def snapshot_id():
     return 'snap-11111111'
-
-
-def ordered(obj):
-    if isinstance(obj, dict):
-        return sorted((k, ordered(v)) for k, v in obj.items())
-    elif isinstance(obj, (list, tuple)):
-        return sorted(ordered(x) for x in obj)
-    else:
-        return obj
@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+
+import os
+import threading
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import cache as cache_module
+from ..cache import InventoryCache
+
+
+@pytest.fixture
+def now():
+    return [1000.0]
+
+
+@pytest.fixture
+def cache(tmpdir, now):
+    return InventoryCache(str(tmpdir.join('cache')), ttl=60,
+                          clock=lambda: now[0])
+
+
+def test_dumps_loads():
+    value = [{
+        'VolumeId': 'vol-11111111',
+        'CreateTime': datetime(2017, 1, 1, 12, 30, tzinfo=timezone.utc),
+        'Attachments': []
+    }]
+
+    assert cache_module.loads(cache_module.dumps(value)) == value
+
+
+def test_dumps_naive_datetime():
+    value = {'StartTime': datetime(2017, 1, 1)}
+
+    assert cache_module.loads(cache_module.dumps(value)) == \
+        {'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)}
+
+
+def test_get_missing(cache):
+    assert cache.get('volumes', [{'Name': 'a'}]) == (False, None)
+
+
+def test_put_get(cache):
+    key = [{'Name': 'tag:a', 'Values': ['b']}]
+    cache.put('volumes', key, [{'VolumeId': 'vol-11111111'}])
+    cache.put('snapshot', key, None)
+
+    assert cache.get('volumes', key) == \
+        (True, [{'VolumeId': 'vol-11111111'}])
+    assert cache.get('snapshot', key) == (True, None)
+    assert cache.get('volumes', [{'Name': 'tag:a', 'Values': ['c']}]) == \
+        (False, None)
+
+    # No temporary files are left behind
+    assert all(name.endswith(cache_module.CACHE_SUFFIX)
+               for name in os.listdir(cache.path))
+
+
+def test_expired(cache, now):
+    cache.put('volumes', [], [])
+    now[0] += 61
+
+    assert cache.get('volumes', []) == (False, None)
+
+
+def test_corrupt(cache):
+    cache.put('volumes', [], [])
+    with open(cache._entry_path('volumes', []), 'wb') as f:
+        f.write(b'garbage')
+
+    assert cache.get('volumes', []) == (False, None)
+
+
+def test_get_or_load(cache, mocker):
+    load = mocker.Mock(return_value=[1, 2, 3])
+
+    assert cache.get_or_load('volumes', [], load) == [1, 2, 3]
+    assert cache.get_or_load('volumes', [], load) == [1, 2, 3]
+    load.assert_called_once_with()
+
+
+def test_get_or_load_write_error(cache, mocker):
+    mocker.patch('ebs_snatcher.cache.tempfile.mkstemp',
+                 side_effect=OSError(13, 'Permission denied'))
+    load = mocker.Mock(return_value=[1, 2, 3])
+
+    # Lookups still succeed, but can't be cached
+    assert cache.get_or_load('volumes', [], load) == [1, 2, 3]
+    assert cache.get_or_load('volumes', [], load) == [1, 2, 3]
+    assert load.call_count == 2
+
+
+def test_put_concurrent(cache):
+    # Writers racing to create the directory must not fail
+    errors = []
+
+    def put(i):
+        try:
+            cache.put('volumes', [i], [])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(cache.get('volumes', [i]) == (True, []) for i in range(8))
+
+
+def test_invalidate(cache):
+    cache.put('volumes', [], [])
+    cache.put('snapshot', [], None)
+    cache.invalidate()
+
+    assert cache.get('volumes', []) == (False, None)
+    assert cache.get('snapshot', []) == (False, None)
+
+
+def test_invalidate_missing_dir(cache):
+    cache.invalidate()
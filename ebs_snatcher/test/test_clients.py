@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import pytest
+
+from ..clients import ClientPool
+
+
+class FakeSession(object):
+    created = []
+
+    def __init__(self, profile_name=None):
+        self.profile_name = profile_name
+
+    def client(self, service, region_name=None, config=None):
+        # Widen the window for races between threads
+        time.sleep(0.01)
+        client = (service, region_name, self.profile_name, config)
+        FakeSession.created.append(client)
+        return client
+
+
+@pytest.fixture(autouse=True)
+def mock_timing(mocker):
+    return mocker.patch('ebs_snatcher.timing.register')
+
+
+def make_pool(**kwargs):
+    FakeSession.created = []
+    return ClientPool(session_factory=FakeSession, **kwargs)
+
+
+def test_keyed():
+    pool = make_pool()
+
+    assert pool.get('ec2') == ('ec2', None, None, None)
+    assert pool.get('ec2', 'us-west-2') == ('ec2', 'us-west-2', None, None)
+    assert pool.get('ec2', profile='other') == ('ec2', None, 'other', None)
+    assert pool.get('sts') == ('sts', None, None, None)
+
+    # Clients are reused for the same key
+    assert pool.get('ec2') is pool.get('ec2')
+    assert len(FakeSession.created) == 4
+
+
+def test_configure():
+    pool = make_pool()
+    pool.get('ec2')
+
+    pool.configure(profile='other', max_pool_connections=32)
+    service, region, profile, config = pool.get('ec2')
+    assert profile == 'other'
+    assert config.max_pool_connections == 32
+    assert len(FakeSession.created) == 2
+
+
+def test_concurrent_get():
+    pool = make_pool()
+    results = []
+
+    def get():
+        results.append(pool.get('ec2'))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # All threads share a single client
+    assert len(FakeSession.created) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_rate_limiter():
+    class FakeRateLimiter(object):
+        max_attempts = 7
+        registered = []
+
+        def register(self, client):
+            self.registered.append(client)
+
+    rate_limiter = FakeRateLimiter()
+    pool = make_pool(rate_limiter=rate_limiter)
+
+    client = pool.get('ec2')
+    service, region, profile, config = client
+    assert config.retries == {'mode': 'standard', 'max_attempts': 7}
+    assert rate_limiter.registered == [client]
+
+
+def test_default_session():
+    # boto3 is only imported once a client is actually needed
+    pool = ClientPool()
+    client = pool.get('ec2', 'us-east-1')
+
+    assert client.meta.service_model.service_name == 'ec2'
+    assert client.meta.region_name == 'us-east-1'
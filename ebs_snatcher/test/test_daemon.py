@@ -0,0 +1,214 @@
+from __future__ import unicode_literals
+
+import argparse
+import json
+import socket
+import threading
+
+import pytest
+
+from .. import daemon
+from ..timing import Timings
+
+
+@pytest.fixture
+def daemon_args(tmpdir, instance_id):
+    return argparse.Namespace(
+        instance_id=instance_id,
+        socket=str(tmpdir.join('ebs-snatcher.sock')),
+        check_interval=60.0,
+        metrics_file=None,
+        volume_count=1,
+        hydrate=False)
+
+
+def fake_resource_state(mocker, states):
+    states = iter(states)
+
+    def make(args, instance_info, inventory=None):
+        resource_state = mocker.Mock()
+        resource_state.state = next(states)
+        resource_state.instance_info = instance_info
+        resource_state.timings = Timings()
+        resource_state.waiter.timings = {'attach': 1.5}
+        resource_state.members = []
+        resource_state.to_json.side_effect = lambda: {
+            'volume_id': 'vol-11111111',
+            'result': resource_state.state,
+            'instance_id': resource_state.instance_info['InstanceId']}
+        return resource_state
+
+    return mocker.patch('ebs_snatcher.daemon.new_resource_state',
+                        side_effect=make)
+
+
+def test_reconciler_present(mocker, daemon_args, instance_info):
+    get_instance_info = mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                                     return_value=instance_info)
+    fake_resource_state(mocker, ['present', 'present'])
+
+    reconciler = daemon.Reconciler(daemon_args)
+    assert reconciler.ensure()['result'] == 'present'
+    assert reconciler.ensure()['result'] == 'present'
+    assert reconciler.status()['result'] == 'present'
+
+    # Instance info is only fetched once if nothing changes
+    get_instance_info.assert_called_once_with(daemon_args)
+
+
+def test_reconciler_drift(mocker, daemon_args, instance_info):
+    new_instance_info = dict(instance_info, InstanceId='i-22222222')
+    get_instance_info = mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                                     side_effect=[instance_info,
+                                                  new_instance_info])
+    fake_resource_state(mocker, ['present', 'attached', 'attached'])
+
+    reconciler = daemon.Reconciler(daemon_args)
+    reconciler.ensure()
+    result = reconciler.ensure()
+
+    assert result['result'] == 'attached'
+    # Survey and converge again with the refreshed instance info
+    assert result['instance_id'] == 'i-22222222'
+    assert get_instance_info.call_count == 2
+
+
+def test_reconciler_modified(mocker, daemon_args, instance_info):
+    get_instance_info = mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                                     return_value=instance_info)
+    new_resource_state = fake_resource_state(mocker, ['modified'])
+
+    reconciler = daemon.Reconciler(daemon_args)
+    assert reconciler.ensure()['result'] == 'modified'
+
+    # Volumes modified in place stay attached to the same devices
+    get_instance_info.assert_called_once_with(daemon_args)
+    new_resource_state.assert_called_once_with(daemon_args, instance_info)
+
+
+def test_reconciler_volume_set_hydrate(mocker, daemon_args, instance_info):
+    daemon_args.volume_count = 3
+    daemon_args.hydrate = True
+    mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                 return_value=instance_info)
+    volume_set_state = mocker.patch('ebs_snatcher.main.VolumeSetState')
+    volume_set_state.return_value.state = 'present'
+    volume_set_state.return_value.to_json.return_value = {
+        'result': 'present', 'volumes': []}
+
+    reconciler = daemon.Reconciler(daemon_args)
+    assert reconciler.ensure() == {'result': 'present', 'volumes': []}
+
+    volume_set_state.assert_called_once_with(daemon_args, instance_info,
+                                             None, local=True)
+    volume_set_state.return_value.converge.assert_called_once_with()
+    volume_set_state.return_value.hydrate.assert_called_once_with()
+
+
+def test_reconciler_error(mocker, daemon_args):
+    mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                 side_effect=RuntimeError('boom'))
+
+    reconciler = daemon.Reconciler(daemon_args)
+    assert reconciler.ensure() == {'error_type': 'RuntimeError',
+                                   'error': 'boom'}
+
+
+def test_reconciler_status_during_ensure(mocker, daemon_args):
+    started = threading.Event()
+    finish = threading.Event()
+
+    def ensure():
+        started.set()
+        finish.wait(5)
+        state = mocker.Mock()
+        state.to_json.return_value = {'result': 'attached'}
+        return state
+
+    reconciler = daemon.Reconciler(daemon_args)
+    reconciler.last_result = {'result': 'present'}
+    mocker.patch.object(reconciler, '_ensure', side_effect=ensure)
+
+    thread = threading.Thread(target=reconciler.ensure)
+    thread.start()
+    try:
+        assert started.wait(5)
+        # The previous result is returned while the check is still running
+        assert reconciler.status() == {'result': 'present'}
+    finally:
+        finish.set()
+        thread.join()
+
+    assert reconciler.status() == {'result': 'attached'}
+
+
+def test_reconciler_metrics(mocker, daemon_args, instance_info, tmpdir):
+    daemon_args.metrics_file = str(tmpdir.join('ebs-snatcher.prom'))
+    mocker.patch('ebs_snatcher.daemon.get_instance_info',
+                 side_effect=[instance_info, instance_info,
+                              RuntimeError('boom')])
+    fake_resource_state(mocker, ['attached', 'attached'])
+    rate_limiter = mocker.Mock()
+    rate_limiter.stats.return_value = {
+        'describe': {'calls': 3, 'retried': 1, 'throttled': 1,
+                     'wait_time': 0.5}}
+
+    reconciler = daemon.Reconciler(daemon_args, rate_limiter)
+    reconciler.ensure()
+    reconciler.instance_info = None
+    reconciler.ensure()
+
+    # Metrics accumulate over checks
+    lines = tmpdir.join('ebs-snatcher.prom').read().splitlines()
+    assert 'ebs_snatcher_runs_total{result="attached"} 1' in lines
+    assert 'ebs_snatcher_runs_total{result="error"} 1' in lines
+    assert 'ebs_snatcher_last_run_success 0' in lines
+    assert 'ebs_snatcher_wait_duration_seconds_count{stage="attach"} 1' in \
+        lines
+    assert 'ebs_snatcher_api_throttled_total{kind="describe"} 1' in lines
+    assert tmpdir.listdir() == [tmpdir.join('ebs-snatcher.prom')]
+
+
+def request(path, command):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(command.encode('utf-8') + b'\n')
+        return json.loads(sock.makefile('rb').readline().decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def test_server(mocker, daemon_args):
+    reconciler = mocker.Mock()
+    reconciler.ensure.return_value = {'result': 'present'}
+    reconciler.status.return_value = {'result': 'attached'}
+
+    server = daemon.Server(daemon_args.socket, reconciler)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.01})
+    thread.start()
+
+    try:
+        assert request(daemon_args.socket, 'ensure') == {'result': 'present'}
+        assert request(daemon_args.socket, 'status') == {'result': 'attached'}
+        assert request(daemon_args.socket, 'bogus')['error_type'] == \
+            'ValueError'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_run(mocker, daemon_args):
+    mocker.patch('ebs_snatcher.ebs.ec2')
+    mocker.patch('ebs_snatcher.ebs.sts')
+    ensure = mocker.patch.object(daemon.Reconciler, 'ensure')
+
+    stop_event = mocker.Mock()
+    stop_event.wait.side_effect = [False, True]
+
+    daemon.run(daemon_args, stop_event)
+
+    assert ensure.call_count == 2
+    stop_event.wait.assert_called_with(daemon_args.check_interval)
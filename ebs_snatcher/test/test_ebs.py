@@ -1,12 +1,19 @@
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timezone
 
+import boto3
 import pytest
+from botocore import UNSIGNED
+from botocore.client import Config
 from botocore.exceptions import ClientError
+from botocore.stub import Stubber
 
-from .conftest import ordered
-from .. import ebs
+from .. import ebs, watch
+from ..cache import InventoryCache
+from ..records import Snapshot, Volume
+from ..scoring import SnapshotScorer
+from ..waiters import Waiter, WaiterError
 
 
 def test_get_account_id(sts_stub):
@@ -123,7 +130,7 @@ def test_find_attached_volumes(ec2_stub, mocker):
 
     assert (ebs.find_attached_volumes(tags, {'InstanceId': instance_id},
                                       base_filters) ==
-            [volume_1, volume_2])
+            [Volume('vol-11111111'), Volume('vol-22222222')])
     ec2_stub.assert_no_pending_responses()
 
 
@@ -166,11 +173,100 @@ def test_find_available_volumes(ec2_stub, mocker):
 
     actual_volumes = ebs.find_available_volumes(tags, instance_info,
                                                 base_filters)
-    assert ordered(actual_volumes) == ordered([volume_1, volume_2])
+    assert sorted(actual_volumes) == [Volume('vol-11111111'),
+                                      Volume('vol-22222222')]
 
     ec2_stub.assert_no_pending_responses()
 
 
+def test_find_volumes(ec2_stub, instance_id, availability_zone,
+                      instance_info):
+    tags = [('a', 'b')]
+    filters = [
+        {'Name': 'tag:a', 'Values': ['b']},
+        {'Name': 'status', 'Values': ['creating', 'available', 'in-use']}
+    ]
+
+    attached = {
+        'VolumeId': 'vol-11111111',
+        'State': 'in-use',
+        'AvailabilityZone': availability_zone,
+        'Attachments': [{'InstanceId': instance_id, 'State': 'attached'}]
+    }
+    attached_elsewhere = {
+        'VolumeId': 'vol-22222222',
+        'State': 'in-use',
+        'AvailabilityZone': availability_zone,
+        'Attachments': [{'InstanceId': 'i-22222222', 'State': 'attached'}]
+    }
+    available = {
+        'VolumeId': 'vol-33333333',
+        'State': 'available',
+        'AvailabilityZone': availability_zone,
+        'Attachments': []
+    }
+    other_az = {
+        'VolumeId': 'vol-44444444',
+        'State': 'creating',
+        'AvailabilityZone': availability_zone + 'x',
+        'Attachments': []
+    }
+    next_token = 'whatever'
+
+    ec2_stub.add_response(
+        'describe_volumes',
+        {
+            'Volumes': [attached, attached_elsewhere],
+            'NextToken': next_token
+        },
+        {'Filters': filters, 'DryRun': False})
+
+    ec2_stub.add_response(
+        'describe_volumes',
+        {
+            'Volumes': [available, other_az]
+        },
+        {'Filters': filters, 'DryRun': False, 'NextToken': next_token})
+
+    assert (ebs.find_volumes(tags, instance_info) ==
+            ([Volume.from_boto(attached)], [Volume.from_boto(available)],
+             [Volume.from_boto(other_az)]))
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_find_volumes_cached(ec2_stub, tmpdir, instance_id,
+                             availability_zone, instance_info):
+    available = {
+        'VolumeId': 'vol-11111111',
+        'State': 'available',
+        'AvailabilityZone': availability_zone,
+        'CreateTime': datetime(2017, 1, 1, tzinfo=timezone.utc),
+        'Attachments': []
+    }
+
+    ec2_stub.add_response('describe_volumes', {'Volumes': [available]})
+
+    cache = InventoryCache(str(tmpdir), ttl=60)
+    expected = ([], [Volume.from_boto(available)], [])
+    assert ebs.find_volumes([('a', 'b')], instance_info, cache=cache) == \
+        expected
+    # Second call must not hit the API
+    assert ebs.find_volumes([('a', 'b')], instance_info, cache=cache) == \
+        expected
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_find_existing_snapshot_cached(ec2_stub, tmpdir, mocker):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+
+    ec2_stub.add_response('describe_snapshots', {'Snapshots': []})
+
+    cache = InventoryCache(str(tmpdir), ttl=60)
+    assert ebs.find_existing_snapshot([('a', 'b')], cache=cache) is None
+    assert ebs.find_existing_snapshot([('a', 'b')], cache=cache) is None
+    ec2_stub.assert_no_pending_responses()
+
+
 def test_find_existing_snapshots(ec2_stub, mocker):
     account_id = '23456789012'
     mocker.patch('ebs_snatcher.ebs.get_account_id', return_value=account_id)
@@ -217,10 +313,300 @@ def test_find_existing_snapshots(ec2_stub, mocker):
         params)
 
     assert \
-        ebs.find_existing_snapshot(tags, base_filters) == snap_new
+        ebs.find_existing_snapshot(tags, base_filters) == \
+        Snapshot.from_boto(snap_new)
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_find_existing_snapshot_page_size(ec2_stub, mocker):
+    account_id = '23456789012'
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value=account_id)
+
+    snap_new = {
+        'SnapshotId': 'snap-22222222',
+        'VolumeId': 'vol-22222222',
+        'StartTime': datetime(2017, 2, 1, 0, 0, 0),
+        'Description': 'unused',
+        'Tags': [{'Key': 'a', 'Value': 'b'}]
+    }
+    snap_old = {
+        'SnapshotId': 'snap-11111111',
+        'StartTime': datetime(2017, 1, 1, 0, 0, 0)
+    }
+
+    ec2_stub.add_response(
+        'describe_snapshots',
+        {
+            'Snapshots': [snap_new, snap_old]
+        },
+        {
+            'Filters': [{'Name': 'status', 'Values': ['completed']}],
+            'DryRun': False,
+            'RestorableByUserIds': [account_id],
+            'MaxResults': 50
+        })
+
+    # Only the fields used later are kept from the chosen snapshot
+    assert ebs.find_existing_snapshot(page_size=50) == Snapshot(
+        'snap-22222222', 'vol-22222222',
+        start_time=datetime(2017, 2, 1, 0, 0, 0), tags=(('a', 'b'),))
     ec2_stub.assert_no_pending_responses()
 
 
+def test_find_existing_snapshot_none(ec2_stub, mocker):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+
+    ec2_stub.add_response('describe_snapshots', {'Snapshots': []})
+
+    assert ebs.find_existing_snapshot() is None
+
+
+def test_find_existing_snapshot_scored(ec2_stub, mocker):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+
+    snap_fsr = {
+        'SnapshotId': 'snap-11111111',
+        'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)
+    }
+    snap_new = {
+        'SnapshotId': 'snap-22222222',
+        'StartTime': datetime(2017, 2, 1, tzinfo=timezone.utc)
+    }
+
+    ec2_stub.add_response(
+        'describe_fast_snapshot_restores',
+        {
+            'FastSnapshotRestores': [
+                {'SnapshotId': 'snap-11111111', 'State': 'enabled'}
+            ]
+        },
+        {
+            'Filters': [
+                {'Name': 'availability-zone', 'Values': ['us-east-1a']},
+                {'Name': 'state', 'Values': ['enabled']}
+            ],
+            'DryRun': False
+        })
+
+    ec2_stub.add_response('describe_snapshots',
+                          {'Snapshots': [snap_fsr, snap_new]})
+
+    scorer = SnapshotScorer(weights={'fsr': 1000},
+                            availability_zone='us-east-1a',
+                            now=datetime(2017, 3, 1, tzinfo=timezone.utc))
+    snapshot = ebs.find_existing_snapshot(scorer=scorer)
+
+    assert snapshot.snapshot_id == 'snap-11111111'
+    assert 'fast restore enabled' in snapshot.score_reason
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_find_snapshots_by_volume(ec2_stub, mocker):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+    mocker.patch('ebs_snatcher.ebs.MAX_FILTER_VALUES', 2)
+
+    volume_ids = ['vol-11111111', 'vol-22222222', 'vol-33333333']
+    snap_1_old = {
+        'SnapshotId': 'snap-11111111',
+        'VolumeId': 'vol-11111111',
+        'StartTime': datetime(2017, 1, 1)
+    }
+    snap_1_new = {
+        'SnapshotId': 'snap-11111112',
+        'VolumeId': 'vol-11111111',
+        'StartTime': datetime(2017, 1, 2)
+    }
+    snap_3 = {
+        'SnapshotId': 'snap-33333333',
+        'VolumeId': 'vol-33333333',
+        'StartTime': datetime(2017, 1, 3)
+    }
+
+    def params(volume_ids):
+        return {
+            'Filters': [
+                {'Name': 'volume-id', 'Values': volume_ids},
+                {'Name': 'status', 'Values': ['completed']}
+            ],
+            'RestorableByUserIds': ['1234'],
+            'DryRun': False
+        }
+
+    # Volume IDs are split into chunks the API accepts
+    ec2_stub.add_response('describe_snapshots',
+                          {'Snapshots': [snap_1_new, snap_1_old]},
+                          params(volume_ids[:2]))
+    ec2_stub.add_response('describe_snapshots',
+                          {'Snapshots': [snap_3]},
+                          params(volume_ids[2:]))
+
+    assert ebs.find_snapshots_by_volume(volume_ids) == {
+        'vol-11111111': (snap_1_new['StartTime'],
+                         Snapshot.from_boto(snap_1_new)),
+        'vol-33333333': (snap_3['StartTime'], Snapshot.from_boto(snap_3))
+    }
+    ec2_stub.assert_no_pending_responses()
+
+
+@pytest.fixture
+def remote_ec2_stub(ec2_stub, mocker):
+    # Separate client for another region, alongside the default one
+    local_client = ebs.ec2()
+    client = boto3.client('ec2', config=Config(signature_version=UNSIGNED),
+                          region_name='eu-west-1')
+    mocker.patch('ebs_snatcher.ebs.ec2',
+                 side_effect=lambda region=None:
+                 client if region == 'eu-west-1' else local_client)
+
+    stub = Stubber(client)
+    stub.activate()
+
+    yield stub
+
+    stub.deactivate()
+
+
+@pytest.mark.parametrize('remote_time,result_region', [
+    (datetime(2017, 2, 1, 0, 0, 0), 'eu-west-1'),
+    (datetime(2017, 1, 1, 0, 0, 0), None),
+])
+def test_find_existing_snapshot_regions(ec2_stub, remote_ec2_stub, mocker,
+                                        remote_time, result_region):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+
+    params = {
+        'Filters': [
+            {'Name': 'tag:a', 'Values': ['b']},
+            {'Name': 'status', 'Values': ['completed']}
+        ],
+        'DryRun': False,
+        'RestorableByUserIds': ['1234']
+    }
+    local = {
+        'SnapshotId': 'snap-11111111',
+        'StartTime': datetime(2017, 1, 1, 0, 0, 0)
+    }
+    remote = {
+        'SnapshotId': 'snap-22222222',
+        'StartTime': remote_time
+    }
+
+    ec2_stub.add_response('describe_snapshots', {'Snapshots': [local]},
+                          params)
+    remote_ec2_stub.add_response('describe_snapshots',
+                                 {'Snapshots': [remote]}, params)
+
+    # The current region is not searched twice, and wins ties
+    snapshot = ebs.find_existing_snapshot(
+        [('a', 'b')], regions=['us-east-1', 'eu-west-1'])
+    assert snapshot.region == result_region
+    if result_region:
+        assert snapshot == Snapshot.from_boto(remote, 'eu-west-1')
+    else:
+        assert snapshot == Snapshot.from_boto(local)
+
+    ec2_stub.assert_no_pending_responses()
+    remote_ec2_stub.assert_no_pending_responses()
+
+
+def test_find_existing_snapshot_regions_cached(ec2_stub, remote_ec2_stub,
+                                               tmpdir, mocker):
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value='1234')
+
+    remote = {
+        'SnapshotId': 'snap-22222222',
+        'StartTime': datetime(2017, 2, 1, 0, 0, 0, tzinfo=timezone.utc)
+    }
+    ec2_stub.add_response('describe_snapshots', {'Snapshots': []})
+    remote_ec2_stub.add_response('describe_snapshots',
+                                 {'Snapshots': [remote]})
+
+    cache = InventoryCache(str(tmpdir), ttl=60)
+    expected = Snapshot.from_boto(remote, 'eu-west-1')
+    for _ in range(2):
+        assert ebs.find_existing_snapshot(
+            [('a', 'b')], cache=cache, regions=['eu-west-1']) == expected
+
+    ec2_stub.assert_no_pending_responses()
+    remote_ec2_stub.assert_no_pending_responses()
+
+
+def test_copy_snapshot(ec2_stub):
+    snapshot = Snapshot('snap-22222222',
+                        tags=(('a', 'b'), ('aws:backup:source-resource', 'c')),
+                        region='eu-west-1')
+
+    # Tags reserved by AWS are not copied
+    ec2_stub.add_response(
+        'copy_snapshot',
+        {'SnapshotId': 'snap-33333333'},
+        {
+            'SourceRegion': 'eu-west-1',
+            'SourceSnapshotId': 'snap-22222222',
+            'Description': 'Copy of snap-22222222 from eu-west-1',
+            'Encrypted': True,
+            'KmsKeyId': 'key',
+            'TagSpecifications': [{
+                'ResourceType': 'snapshot',
+                'Tags': [{'Key': 'a', 'Value': 'b'}]
+            }],
+            'DryRun': False
+        })
+
+    params = {'SnapshotIds': ['snap-33333333'], 'DryRun': False}
+    ec2_stub.add_client_error('describe_snapshots',
+                              'InvalidSnapshot.NotFound',
+                              expected_params=params)
+    for state, progress in [('pending', '50%'), ('completed', '100%')]:
+        ec2_stub.add_response(
+            'describe_snapshots',
+            {'Snapshots': [{'SnapshotId': 'snap-33333333', 'State': state,
+                            'Progress': progress}]},
+            params)
+
+    waiter = Waiter()
+    assert ebs.copy_snapshot(snapshot, kms_key_id='key', waiter=waiter,
+                             timeout=3600) == 'snap-33333333'
+    assert 'copy' in waiter.timings
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_copy_snapshot_aws_tags(ec2_stub):
+    snapshot = Snapshot('snap-22222222', tags=(('aws:dlm:lifecycle-policy-id',
+                                                'policy-1'),),
+                        region='eu-west-1')
+
+    ec2_stub.add_response(
+        'copy_snapshot',
+        {'SnapshotId': 'snap-33333333'},
+        {
+            'SourceRegion': 'eu-west-1',
+            'SourceSnapshotId': 'snap-22222222',
+            'Description': 'Copy of snap-22222222 from eu-west-1',
+            'DryRun': False
+        })
+    ec2_stub.add_response(
+        'describe_snapshots',
+        {'Snapshots': [{'SnapshotId': 'snap-33333333', 'State': 'completed',
+                        'Progress': '100%'}]})
+
+    assert ebs.copy_snapshot(snapshot) == 'snap-33333333'
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_copy_snapshot_error(ec2_stub):
+    snapshot = Snapshot('snap-22222222', region='eu-west-1')
+
+    ec2_stub.add_response('copy_snapshot', {'SnapshotId': 'snap-33333333'})
+    ec2_stub.add_response(
+        'describe_snapshots',
+        {'Snapshots': [{'SnapshotId': 'snap-33333333', 'State': 'error',
+                        'StateMessage': 'broken'}]})
+
+    with pytest.raises(WaiterError, match='broken'):
+        ebs.copy_snapshot(snapshot)
+
+
 def test_create_volume(ec2_stub):
     az = 'us-east-1'
     volume_type = 'gp2'
@@ -276,7 +662,7 @@ def test_create_volume(ec2_stub):
         kms_key_id=kms_key_id,
         src_snapshot_id=snapshot_id)
 
-    assert volume['VolumeId'] == volume_id
+    assert volume.volume_id == volume_id
     ec2_stub.assert_no_pending_responses()
 
 
@@ -295,6 +681,82 @@ def test_next_device_name(prefix, dev, next_dev):
     assert ebs.next_device_name(prefix + dev) == prefix + next_dev
 
 
+@pytest.mark.parametrize('device_name,mappings,result', [
+    ('/dev/sdf', [], '/dev/sdf'),
+    ('/dev/sdf', ['/dev/sda1'], '/dev/sdf'),
+    ('/dev/sdf', ['/dev/sda1', '/dev/sdf'], '/dev/sdg'),
+    ('/dev/sdf', ['/dev/xvdf', 'sdg', '/dev/sdh1'], '/dev/sdi'),
+    ('/dev/xvdz', ['/dev/sdz'], '/dev/xvdaa'),
+    ('/dev/nvme1n1', ['/dev/nvme1n1'], '/dev/nvme1n1')
+])
+def test_allocate_device_name(device_name, mappings, result):
+    instance_info = {
+        'BlockDeviceMappings': [{'DeviceName': m} for m in mappings]
+    }
+    assert ebs.allocate_device_name(device_name, instance_info) == result
+
+
+def test_attach_volume_preallocated_device(ec2_stub):
+    volume_id = 'vol-11111111'
+    instance_id = 'i-11111111'
+    instance_info = {
+        'InstanceId': instance_id,
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/sda1'},
+            {'DeviceName': '/dev/sdf'},
+            {'DeviceName': '/dev/sdg'}
+        ]
+    }
+    device_name = '/dev/sdh'
+
+    ec2_stub.add_response(
+        'describe_volumes',
+        {
+            'Volumes': [{
+                'VolumeId': volume_id,
+                'State': 'available'
+            }]
+        },
+        {
+            'VolumeIds': [volume_id],
+            'DryRun': False
+        })
+
+    # No attempts are made with the names already in use
+    ec2_stub.add_response(
+        'attach_volume',
+        {
+            'VolumeId': volume_id,
+            'InstanceId': instance_id,
+            'State': 'attaching',
+            'Device': device_name,
+            'AttachTime': datetime(2017, 1, 1, 0, 0, 0)
+        },
+        {
+            'Device': device_name,
+            'InstanceId': instance_id,
+            'VolumeId': volume_id,
+            'DryRun': False
+        })
+
+    ec2_stub.add_response(
+        'describe_volumes',
+        {
+            'Volumes': [{
+                'VolumeId': volume_id,
+                'State': 'in-use'
+            }]
+        },
+        {
+            'VolumeIds': [volume_id],
+            'Filters': [{'Name': 'attachment.status', 'Values': ['attached']}],
+            'DryRun': False
+        })
+
+    assert ebs.attach_volume(volume_id, instance_info) == device_name
+    ec2_stub.assert_no_pending_responses()
+
+
 def test_attach_volume_default_device(ec2_stub):
     volume_id = 'vol-11111111'
     instance_id = 'i-11111111'
@@ -495,6 +957,90 @@ def test_attach_volume_device_in_use_retry(ec2_stub):
             device_ok)
 
 
+def claimed_volume(volume_id, state='available', claim=None):
+    volume = {'VolumeId': volume_id, 'State': state}
+    if claim:
+        volume['Tags'] = [{'Key': ebs.CLAIM_TAG, 'Value': claim}]
+
+    return {'Volumes': [volume]}
+
+
+@pytest.mark.parametrize('existing,final,won', [
+    # Unclaimed volume, claim kept
+    (None, 'i-1 1120', True),
+    # Claim overwritten by another instance in the meantime
+    (None, 'i-2 1121', False),
+    # Expired claim by another instance, and own older claim
+    ('i-2 999', 'i-1 1120', True),
+    ('i-1 2000', 'i-1 1120', True),
+    # Malformed claims are ignored
+    ('garbage', 'i-1 1120', True),
+])
+def test_claim_volume(ec2_stub, volume_id, existing, final, won):
+    params = {'VolumeIds': [volume_id], 'DryRun': False}
+    ec2_stub.add_response('describe_volumes',
+                          claimed_volume(volume_id, claim=existing), params)
+    ec2_stub.add_response(
+        'create_tags', {},
+        {'Resources': [volume_id],
+         'Tags': [{'Key': ebs.CLAIM_TAG, 'Value': 'i-1 1120'}],
+         'DryRun': False})
+    ec2_stub.add_response('describe_volumes',
+                          claimed_volume(volume_id, claim=final), params)
+
+    sleeps = []
+    claim = ebs.claim_volume(volume_id, 'i-1', lease=120.0, settle_delay=2.0,
+                             clock=lambda: 1000.0, sleep=sleeps.append)
+    assert claim == ('i-1 1120' if won else None)
+    assert sleeps == [2.0]
+    ec2_stub.assert_no_pending_responses()
+
+
+@pytest.mark.parametrize('response', [
+    claimed_volume('vol-11111111', state='in-use'),
+    claimed_volume('vol-11111111', claim='i-2 1060'),
+    None
+])
+def test_claim_volume_taken(ec2_stub, response):
+    if response:
+        ec2_stub.add_response('describe_volumes', response)
+    else:
+        ec2_stub.add_client_error('describe_volumes',
+                                  'InvalidVolume.NotFound')
+
+    assert ebs.claim_volume('vol-11111111', 'i-1', clock=lambda: 1000.0,
+                            sleep=None) is None
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_release_volume(ec2_stub, volume_id):
+    tags = [{'Key': ebs.CLAIM_TAG, 'Value': 'i-1 1120'}]
+    ec2_stub.add_response(
+        'delete_tags', {},
+        {'Resources': [volume_id], 'Tags': tags, 'DryRun': False})
+    ec2_stub.add_client_error('delete_tags', 'RequestLimitExceeded')
+
+    ebs.release_volume(volume_id, 'i-1 1120')
+    # Failures are only logged
+    ebs.release_volume(volume_id, 'i-1 1120')
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_attach_volume_taken(ec2_stub, volume_id, instance_info):
+    ec2_stub.add_response('describe_volumes',
+                          claimed_volume(volume_id, state='in-use'))
+
+    with pytest.raises(ebs.VolumeTakenError) as exc_info:
+        ebs.attach_volume(volume_id, instance_info)
+
+    assert ebs.is_volume_taken_error(exc_info.value)
+    assert ebs.is_volume_taken_error(ClientError(
+        {'Error': {'Code': 'VolumeInUse', 'Message': ''}}, 'AttachVolume'))
+    assert not ebs.is_volume_taken_error(ClientError(
+        {'Error': {'Code': 'InvalidParameterValue', 'Message': ''}},
+        'AttachVolume'))
+
+
 def test_delete_volume(ec2_stub, volume_id):
     params = {
         'VolumeId': volume_id,
@@ -532,6 +1078,129 @@ def test_delete_volume(ec2_stub, volume_id):
     ec2_stub.assert_no_pending_responses()
 
 
+def test_delete_volume_not_found(ec2_stub, volume_id):
+    ec2_stub.add_response(
+        'delete_volume',
+        {},
+        {'VolumeId': volume_id, 'DryRun': False})
+
+    ec2_stub.add_client_error(
+        'describe_volumes',
+        service_error_code='InvalidVolume.NotFound',
+        expected_params={'VolumeIds': [volume_id], 'DryRun': False})
+
+    waiter = Waiter()
+    assert ebs.delete_volume(volume_id=volume_id, waiter=waiter) is None
+    assert 'delete' in waiter.timings
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_wait_volume_available_deleted(ec2_stub, volume_id):
+    ec2_stub.add_response(
+        'describe_volumes',
+        {
+            'Volumes': [{
+                'VolumeId': volume_id,
+                'State': 'deleted'
+            }]
+        },
+        {'VolumeIds': [volume_id], 'DryRun': False}
+    )
+
+    with pytest.raises(WaiterError):
+        ebs.wait_volume_available(volume_id, Waiter(), 'create')
+
+
+def test_modify_volume(ec2_stub, volume_id):
+    ec2_stub.add_response(
+        'modify_volume',
+        {'VolumeModification': {
+            'VolumeId': volume_id, 'ModificationState': 'modifying',
+            'StartTime': datetime(2017, 2, 1, tzinfo=timezone.utc)}},
+        {'VolumeId': volume_id, 'Size': 20, 'VolumeType': 'io1',
+         'Iops': 1000, 'DryRun': False})
+
+    params = {'VolumeIds': [volume_id], 'DryRun': False}
+    for state in ('modifying', 'optimizing'):
+        ec2_stub.add_response(
+            'describe_volumes_modifications',
+            {'VolumesModifications': [
+                # Only the latest modification matters
+                {'VolumeId': volume_id, 'ModificationState': 'completed',
+                 'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)},
+                {'VolumeId': volume_id, 'ModificationState': state,
+                 'Progress': 10,
+                 'StartTime': datetime(2017, 2, 1, tzinfo=timezone.utc)}
+            ]},
+            params)
+
+    waiter = Waiter()
+    ebs.modify_volume(volume_id, size=20, volume_type='io1', iops=1000,
+                      waiter=waiter)
+    assert 'modify' in waiter.timings
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_modify_volume_previous_completed(ec2_stub, volume_id):
+    start_time = datetime(2017, 2, 1, tzinfo=timezone.utc)
+    ec2_stub.add_response(
+        'modify_volume',
+        {'VolumeModification': {'VolumeId': volume_id,
+                                'ModificationState': 'modifying',
+                                'StartTime': start_time}})
+
+    previous = {'VolumeId': volume_id, 'ModificationState': 'completed',
+                'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)}
+    # Earlier modifications are not mistaken for the new one, even when it
+    # is not visible yet
+    ec2_stub.add_response('describe_volumes_modifications',
+                          {'VolumesModifications': [previous]})
+    ec2_stub.add_response(
+        'describe_volumes_modifications',
+        {'VolumesModifications': [
+            previous,
+            {'VolumeId': volume_id, 'ModificationState': 'optimizing',
+             'StartTime': start_time}
+        ]})
+
+    ebs.modify_volume(volume_id, size=20,
+                      waiter=Waiter(sleep=lambda delay: None))
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_modify_volume_not_visible(ec2_stub, volume_id):
+    ec2_stub.add_response('modify_volume', {})
+    # Neither an error nor an empty list mean the modification failed
+    ec2_stub.add_client_error('describe_volumes_modifications',
+                              'InvalidVolumeModification.NotFound')
+    ec2_stub.add_response('describe_volumes_modifications',
+                          {'VolumesModifications': []})
+    ec2_stub.add_response(
+        'describe_volumes_modifications',
+        {'VolumesModifications': [
+            {'VolumeId': volume_id, 'ModificationState': 'optimizing',
+             'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)}
+        ]})
+
+    ebs.modify_volume(volume_id, size=20,
+                      waiter=Waiter(sleep=lambda delay: None))
+    ec2_stub.assert_no_pending_responses()
+
+
+def test_modify_volume_failed(ec2_stub, volume_id):
+    ec2_stub.add_response('modify_volume', {})
+    ec2_stub.add_response(
+        'describe_volumes_modifications',
+        {'VolumesModifications': [
+            {'VolumeId': volume_id, 'ModificationState': 'failed',
+             'StatusMessage': 'broken',
+             'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc)}
+        ]})
+
+    with pytest.raises(WaiterError, match='broken'):
+        ebs.modify_volume(volume_id, size=20)
+
+
 DEV_TEST_VOLUME_ID = 'vol-12345678'
 DEV_TEST_NVME_PATH = \
     '/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_vol12345678'
@@ -540,6 +1209,13 @@ DEV_TEST_EBS_PATH = '/dev/sda'
 DEV_TEST_SCSI_PATH = DEV_TEST_EBS_PATH
 
 
+@pytest.fixture
+def polling_watcher(mocker):
+    sleep = mocker.Mock()
+    open_watcher = mocker.Mock(return_value=watch.PollingWatcher(sleep))
+    return open_watcher, sleep
+
+
 @pytest.mark.parametrize('nvme_exists,xen_exists,scsi_exists,expected_path', [
     (False, False, False, DEV_TEST_SCSI_PATH),
     (False, False, True, DEV_TEST_SCSI_PATH),
@@ -550,8 +1226,8 @@ DEV_TEST_SCSI_PATH = DEV_TEST_EBS_PATH
     (True, True, False, DEV_TEST_NVME_PATH),
     (True, True, True, DEV_TEST_NVME_PATH),
 ])
-def test_find_system_block_device(mocker, nvme_exists, xen_exists, scsi_exists,
-                                  expected_path):
+def test_find_system_block_device(mocker, polling_watcher, nvme_exists,
+                                  xen_exists, scsi_exists, expected_path):
     def path_exists(path):
         if path == DEV_TEST_NVME_PATH:
             return nvme_exists
@@ -563,21 +1239,54 @@ def test_find_system_block_device(mocker, nvme_exists, xen_exists, scsi_exists,
         assert False
 
     mocker.patch('os.path.exists', side_effect=path_exists)
-    sleep = mocker.Mock()
+    open_watcher, sleep = polling_watcher
 
     actual_path = ebs.find_system_block_device(
-        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, retries=1, sleep=sleep)
+        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, timeout=0,
+        open_watcher=open_watcher)
 
     assert actual_path == expected_path
+    open_watcher.assert_called_once_with(
+        [DEV_TEST_NVME_PATH, DEV_TEST_XEN_PATH, DEV_TEST_SCSI_PATH])
 
 
-def test_find_system_block_device_retry(mocker):
+def test_find_system_block_device_retry(mocker, polling_watcher):
     mocker.patch('os.path.exists', return_value=False)
-    sleep = mocker.Mock()
+    open_watcher, sleep = polling_watcher
+
+    now = [0.0]
+
+    def advance(seconds):
+        now[0] += seconds
+
+    sleep.side_effect = advance
+
+    actual_path = ebs.find_system_block_device(
+        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, timeout=2.25,
+        poll_interval=1.0, open_watcher=open_watcher, clock=lambda: now[0])
 
-    retries = 2
-    ebs.find_system_block_device(
-        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, retries=2, sleep=sleep)
+    assert actual_path == DEV_TEST_EBS_PATH
+    assert sleep.call_args_list == [mocker.call(1.0), mocker.call(1.0),
+                                    mocker.call(0.25)]
+
+
+def test_find_system_block_device_no_fallback(mocker, polling_watcher):
+    mocker.patch('os.path.exists', return_value=False)
+    open_watcher, sleep = polling_watcher
+
+    assert ebs.find_system_block_device(
+        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, timeout=0,
+        open_watcher=open_watcher, fallback=False) is None
+
+
+def test_find_system_block_device_appears(mocker, polling_watcher):
+    exists = iter([False, False, False, False, True])
+    mocker.patch('os.path.exists', side_effect=lambda path: next(exists))
+    open_watcher, sleep = polling_watcher
+
+    actual_path = ebs.find_system_block_device(
+        DEV_TEST_VOLUME_ID, DEV_TEST_EBS_PATH, timeout=10.0,
+        poll_interval=1.0, open_watcher=open_watcher)
 
-    assert sleep.call_count == retries
-    sleep.assert_called_with(10.0)
+    assert actual_path == DEV_TEST_XEN_PATH
+    sleep.assert_called_once_with(1.0)
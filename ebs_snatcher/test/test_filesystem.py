@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+
+import subprocess
+
+import pytest
+
+from .. import filesystem
+
+
+class FakeRun(object):
+    def __init__(self, lsblk_output, errors=None):
+        self.lsblk_output = lsblk_output
+        self.errors = errors or {}
+        self.calls = []
+
+    def __call__(self, *cmd):
+        self.calls.append(cmd)
+        if cmd[0] in self.errors:
+            raise subprocess.CalledProcessError(1, cmd, self.errors[cmd[0]])
+        if cmd[0] == 'lsblk':
+            return self.lsblk_output
+
+        return ''
+
+
+def test_list_block_devices():
+    run = FakeRun(
+        'NAME="/dev/nvme1n1" TYPE="disk" FSTYPE="" MOUNTPOINT=""\n'
+        'NAME="/dev/nvme1n1p1" TYPE="part" FSTYPE="ext4" '
+        'MOUNTPOINT="/mnt/my data"\n')
+
+    assert filesystem.list_block_devices('/dev/nvme1n1', run=run) == [
+        {'NAME': '/dev/nvme1n1', 'TYPE': 'disk', 'FSTYPE': '',
+         'MOUNTPOINT': ''},
+        {'NAME': '/dev/nvme1n1p1', 'TYPE': 'part', 'FSTYPE': 'ext4',
+         'MOUNTPOINT': '/mnt/my data'}
+    ]
+
+
+def test_grow_filesystem_ext4():
+    run = FakeRun('NAME="/dev/xvdf" TYPE="disk" FSTYPE="ext4" MOUNTPOINT=""\n')
+
+    assert filesystem.grow_filesystem('/dev/xvdf', run=run) == \
+        {'device': '/dev/xvdf', 'filesystem': 'ext4', 'grown': True}
+    assert run.calls[1:] == [('resize2fs', '/dev/xvdf')]
+
+
+@pytest.mark.parametrize('growpart_error', [None, 'NOCHANGE: cannot grow'])
+def test_grow_filesystem_partitioned_xfs(growpart_error):
+    errors = {'growpart': growpart_error} if growpart_error else None
+    run = FakeRun(
+        'NAME="/dev/nvme1n1" TYPE="disk" FSTYPE="" MOUNTPOINT=""\n'
+        'NAME="/dev/nvme1n1p1" TYPE="part" FSTYPE="vfat" MOUNTPOINT=""\n'
+        'NAME="/dev/nvme1n1p2" TYPE="part" FSTYPE="xfs" MOUNTPOINT="/data"\n',
+        errors)
+
+    assert filesystem.grow_filesystem('/dev/nvme1n1', run=run) == \
+        {'device': '/dev/nvme1n1p2', 'filesystem': 'xfs', 'grown': True}
+    assert run.calls[1:] == [('growpart', '/dev/nvme1n1', '2'),
+                             ('xfs_growfs', '/data')]
+
+
+def test_grow_filesystem_growpart_error():
+    run = FakeRun(
+        'NAME="/dev/xvdf" TYPE="disk" FSTYPE="" MOUNTPOINT=""\n'
+        'NAME="/dev/xvdf1" TYPE="part" FSTYPE="ext4" MOUNTPOINT=""\n',
+        {'growpart': 'FAILED: something'})
+
+    with pytest.raises(subprocess.CalledProcessError):
+        filesystem.grow_filesystem('/dev/xvdf', run=run)
+
+
+@pytest.mark.parametrize('fstype', ['', 'btrfs', 'xfs'])
+def test_grow_filesystem_unsupported(fstype):
+    # XFS can only be grown when mounted
+    run = FakeRun('NAME="/dev/xvdf" TYPE="disk" FSTYPE="{}" '
+                  'MOUNTPOINT=""\n'.format(fstype))
+
+    assert filesystem.grow_filesystem('/dev/xvdf', run=run) == \
+        {'device': '/dev/xvdf', 'filesystem': fstype or None, 'grown': False}
+    assert len(run.calls) == 1
@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+
+import argparse
+import io
+import json
+
+import pytest
+
+from .. import fleet
+from ..records import Snapshot, Volume
+
+
+@pytest.fixture
+def fleet_args(attach_device):
+    return argparse.Namespace(
+        volume_id_tag=[('a', 'b')],
+        volume_size=10,
+        snapshot_search_tag=[('c', 'd')],
+        attach_device=attach_device,
+        volume_extra_tag=None,
+        encrypt_kms_key_id=None,
+        volume_type='gp2',
+        volume_iops=None,
+        move_to_current_az=False,
+        parallel_survey=False,
+        snapshot_page_size=None,
+        instance_metadata=False,
+        device_timeout=100.0,
+        device_poll_interval=0.5,
+        wait_initial_delay=1.0,
+        wait_max_delay=15.0,
+        wait_timeout=600.0,
+        cache_dir=None,
+        cache_ttl=300.0,
+        volume_count=1,
+        hydrate=False,
+        hydrate_readers=8,
+        hydrate_block_size=1024,
+        hydrate_rate_limit=None,
+        snapshot_weight=None,
+        snapshot_prefer_tag=None,
+        aws_profile=None,
+        aws_max_connections=None,
+        snapshot_region=None,
+        snapshot_copy_timeout=7200.0,
+        modify_attached=False,
+        grow_filesystem=False,
+        claim_lease=120.0,
+        claim_settle_delay=1.0,
+        api_describe_rate=20.0,
+        api_mutate_rate=5.0,
+        api_rate_file=None,
+        timings=False,
+        metrics_file=None)
+
+
+def test_read_manifest():
+    lines = [
+        'i-11111111\n',
+        '\n',
+        '# comment\n',
+        '{"instance_id": "i-22222222", "attach_device": "/dev/sdg"}\n'
+    ]
+
+    assert fleet.read_manifest(lines) == [
+        {'instance_id': 'i-11111111'},
+        {'instance_id': 'i-22222222', 'attach_device': '/dev/sdg'}
+    ]
+
+
+def test_read_manifest_missing_instance_id():
+    with pytest.raises(ValueError):
+        fleet.read_manifest(['{"attach_device": "/dev/sdg"}'])
+
+
+def test_run_fleet(mocker, fleet_args, attach_device):
+    mocker.patch('ebs_snatcher.ebs.ec2')
+    mocker.patch('ebs_snatcher.ebs.sts')
+
+    def instance_info(instance_id):
+        if instance_id == 'i-33333333':
+            return None
+
+        return {'InstanceId': instance_id,
+                'Placement': {'AvailabilityZone': 'us-east-1a'}}
+
+    mocker.patch('ebs_snatcher.ebs.get_instance_info',
+                 side_effect=instance_info)
+
+    def provision(args, instance_info, local=True):
+        assert not local
+        if instance_info['InstanceId'] == 'i-22222222':
+            raise RuntimeError('boom')
+
+        state = mocker.Mock()
+        state.to_json.return_value = {
+            'volume_id': 'vol-' + instance_info['InstanceId'][2:],
+            'attached_device': args.attach_device,
+            'result': 'attached',
+            'src_snapshot_id': None}
+        return state
+
+    mocker.patch('ebs_snatcher.fleet.provision', side_effect=provision)
+
+    entries = [{'instance_id': 'i-11111111'},
+               {'instance_id': 'i-22222222'},
+               {'instance_id': 'i-33333333'}]
+    out = io.StringIO()
+    metrics = mocker.Mock()
+
+    failures = fleet.run_fleet(fleet_args, entries, workers=2, out=out,
+                               metrics=metrics)
+    assert failures == 2
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    results = dict((r['instance_id'], r) for r in results)
+    assert len(results) == 3
+
+    assert results['i-11111111']['status'] == 'ok'
+    assert results['i-11111111']['volume_id'] == 'vol-11111111'
+    assert results['i-11111111']['attached_device'] == attach_device
+
+    assert results['i-22222222']['status'] == 'error'
+    assert results['i-22222222']['error_type'] == 'RuntimeError'
+    assert results['i-22222222']['error'] == 'boom'
+
+    assert results['i-33333333']['status'] == 'error'
+    assert results['i-33333333']['error_type'] == 'ValueError'
+
+    # Each instance is a separate run, failed ones without a state
+    states = [c[0][0] for c in metrics.observe_run.call_args_list]
+    assert len(states) == 3
+    assert states.count(None) == 2
+
+
+def test_provision_instance_remote_devices(mocker, fleet_args):
+    mocker.patch('ebs_snatcher.ebs.get_instance_info', return_value={
+        'InstanceId': 'i-11111111',
+        'Placement': {'AvailabilityZone': 'us-east-1a'}})
+    mocker.patch('ebs_snatcher.ebs.find_volumes', return_value=([], [], []))
+    mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                 return_value=Snapshot('snap-11111111', volume_size=10))
+    mocker.patch('ebs_snatcher.ebs.create_volume',
+                 return_value=Volume('vol-11111111'))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value='/dev/sdf')
+    find_device = mocker.patch('ebs_snatcher.ebs.find_system_block_device')
+    hydrate = mocker.patch('ebs_snatcher.hydrate.hydrate')
+
+    fleet_args.hydrate = True
+    result, resource_state = fleet.provision_instance(
+        fleet_args, {'instance_id': 'i-11111111'})
+
+    assert result['status'] == 'ok'
+    assert result['result'] == 'created'
+    assert result['volume_id'] == 'vol-11111111'
+    assert result['attached_device'] == '/dev/sdf'
+    assert result['device_wait_time'] is None
+    assert result['hydration'] is None
+
+    # Only the devices of the local instance can be found and read
+    assert not find_device.called
+    assert not hydrate.called
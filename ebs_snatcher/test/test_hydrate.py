@@ -0,0 +1,80 @@
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from .. import hydrate
+
+
+@pytest.fixture
+def sparse_file(tmpdir):
+    path = str(tmpdir.join('device'))
+    size = 10 * 1024 * 1024 + 1234
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    return path, size
+
+
+@pytest.mark.parametrize('readers', [1, 3])
+def test_hydrate(sparse_file, mocker, readers):
+    path, size = sparse_file
+    pread = mocker.patch('os.pread', wraps=os.pread)
+
+    stats = hydrate.hydrate(path, readers=readers, block_size=1024 * 1024)
+
+    assert stats['bytes'] == size
+    assert stats['seconds'] >= 0
+    # 10 full blocks, plus one partial block at the end
+    assert pread.call_count == 11
+    offsets = sorted(call[0][2] for call in pread.call_args_list)
+    assert offsets == [n * 1024 * 1024 for n in range(11)]
+
+
+def test_hydrate_aligns_block_size(sparse_file, mocker):
+    path, size = sparse_file
+    pread = mocker.patch('os.pread', wraps=os.pread)
+
+    hydrate.hydrate(path, readers=2, block_size=1024 * 1024 + 100)
+
+    assert all(call[0][2] % hydrate.ALIGNMENT == 0
+               for call in pread.call_args_list)
+
+
+def test_hydrate_rate_limited(sparse_file, mocker):
+    path, size = sparse_file
+    acquire = mocker.patch.object(hydrate.RateLimiter, 'acquire')
+
+    hydrate.hydrate(path, readers=2, rate_limit=1024 * 1024)
+
+    assert sum(call[0][0] for call in acquire.call_args_list) == size
+
+
+def test_rate_limiter(mocker):
+    now = [0.0]
+    sleep = mocker.Mock()
+    limiter = hydrate.RateLimiter(100, clock=lambda: now[0], sleep=sleep)
+
+    limiter.acquire(50)
+    assert not sleep.called
+
+    limiter.acquire(50)
+    sleep.assert_called_once_with(0.5)
+
+    # Time passed without reads, so no waiting is necessary
+    now[0] = 10.0
+    sleep.reset_mock()
+    limiter.acquire(50)
+    assert not sleep.called
+
+
+def test_progress(mocker):
+    now = [0.0]
+    progress = hydrate.Progress(1000, interval=1.0, clock=lambda: now[0])
+
+    now[0] = 2.0
+    progress.add(500)
+
+    assert progress.done == 500
+    assert progress.throughput() == 250.0
@@ -0,0 +1,144 @@
+from __future__ import unicode_literals
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from .. import imds
+
+
+IDENTITY = {
+    'accountId': '23456789012',
+    'availabilityZone': 'us-east-1a',
+    'instanceId': 'i-11111111',
+    'region': 'us-east-1'
+}
+
+
+class FakeMetadataHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=''):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        server = self.server
+        if self.path != '/latest/api/token' or \
+                not self.headers.get('X-aws-ec2-metadata-token-ttl-seconds'):
+            self._reply(400)
+            return
+
+        server.token_requests += 1
+        server.token = 'token-{}'.format(server.token_requests)
+        self._reply(200, server.token)
+
+    def do_GET(self):
+        server = self.server
+        if self.headers.get('X-aws-ec2-metadata-token') != server.token:
+            self._reply(401)
+            return
+
+        body = server.documents.get(self.path)
+        if body is None:
+            self._reply(404)
+        else:
+            self._reply(200, body)
+
+
+@pytest.fixture
+def metadata_server():
+    server = HTTPServer(('127.0.0.1', 0), FakeMetadataHandler)
+    server.token = None
+    server.token_requests = 0
+    server.documents = {
+        '/latest/dynamic/instance-identity/document': json.dumps(IDENTITY),
+        '/latest/meta-data/block-device-mapping/': 'ami\nebs1\nroot',
+        '/latest/meta-data/block-device-mapping/ami': 'xvda',
+        '/latest/meta-data/block-device-mapping/ebs1': 'sdf',
+        '/latest/meta-data/block-device-mapping/root': '/dev/xvda'
+    }
+
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def metadata_client(metadata_server):
+    host, port = metadata_server.server_address
+    return imds.MetadataClient('http://{}:{}'.format(host, port))
+
+
+def test_get_instance_identity(metadata_server, metadata_client):
+    instance_info, account_id = imds.get_instance_identity(metadata_client)
+
+    assert instance_info == {
+        'InstanceId': 'i-11111111',
+        'Placement': {'AvailabilityZone': 'us-east-1a'},
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda'},
+                                {'DeviceName': '/dev/sdf'}]
+    }
+    assert account_id == '23456789012'
+
+
+def test_get_instance_identity_no_mappings(metadata_server, metadata_client):
+    del metadata_server.documents['/latest/meta-data/block-device-mapping/']
+
+    with pytest.raises(imds.MetadataError):
+        imds.get_instance_identity(metadata_client)
+
+
+def test_token_cached(metadata_server, metadata_client):
+    metadata_client.get_identity_document()
+    metadata_client.get_identity_document()
+
+    assert metadata_server.token_requests == 1
+
+
+def test_token_expired(metadata_server, metadata_client):
+    now = [1000.0]
+    metadata_client.clock = lambda: now[0]
+
+    metadata_client.get_identity_document()
+    now[0] += imds.TOKEN_TTL
+    metadata_client.get_identity_document()
+
+    assert metadata_server.token_requests == 2
+
+
+def test_token_invalidated(metadata_server, metadata_client):
+    metadata_client.get_identity_document()
+    # Simulate the server forgetting the token before its expiry
+    metadata_server.token = None
+    metadata_client.get_identity_document()
+
+    assert metadata_server.token_requests == 2
+
+
+def test_not_found(metadata_client):
+    with pytest.raises(imds.MetadataError):
+        metadata_client.get('meta-data/missing')
+
+
+def test_unreachable():
+    # Bind a socket to get a free port, then close it so nothing listens
+    server = HTTPServer(('127.0.0.1', 0), FakeMetadataHandler)
+    host, port = server.server_address
+    server.server_close()
+
+    client = imds.MetadataClient('http://{}:{}'.format(host, port))
+    with pytest.raises(imds.MetadataError):
+        client.get_identity_document()
@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from .. import inventory
+from ..inventory import Inventory
+from ..records import Attachment, Snapshot, Volume
+from ..scoring import SnapshotScorer
+
+
+def tags(*pairs):
+    return [{'Key': k, 'Value': v} for k, v in pairs]
+
+
+def test_shared_tag_filters():
+    assert inventory.shared_tag_filters([]) == []
+    assert inventory.shared_tag_filters([[('a', 'b'), ('c', 'd')],
+                                         [('c', 'e'), ('f', 'g')],
+                                         [('c', 'd'), ('a', 'h')]]) == \
+        [{'Name': 'tag:c', 'Values': ['d', 'e']}]
+    assert inventory.shared_tag_filters([[('a', 'b')], []]) == []
+
+
+def test_fetch(ec2_stub, mocker, availability_zone):
+    account_id = '23456789012'
+    mocker.patch('ebs_snatcher.ebs.get_account_id', return_value=account_id)
+
+    volume = {'VolumeId': 'vol-11111111',
+              'Tags': tags(('role', 'data'), ('a', 'b'))}
+    other_volume = {'VolumeId': 'vol-22222222', 'Tags': tags(('role', 'log'))}
+
+    def snapshot(snapshot_id, month, *pairs):
+        return {
+            'SnapshotId': snapshot_id,
+            'VolumeId': 'vol-11111111',
+            'StartTime': datetime(2017, month, 1),
+            'Description': 'unused',
+            'Tags': tags(*pairs)
+        }
+
+    ec2_stub.add_response(
+        'describe_volumes',
+        {'Volumes': [volume, other_volume]},
+        {'Filters': [{'Name': 'tag:role', 'Values': ['data', 'hints']},
+                     {'Name': 'status',
+                      'Values': ['creating', 'available', 'in-use']}],
+         'DryRun': False})
+    ec2_stub.add_response(
+        'describe_snapshots',
+        {'Snapshots': [snapshot('snap-11111111', 1, ('role', 'data')),
+                       snapshot('snap-22222222', 2, ('role', 'data')),
+                       snapshot('snap-33333333', 3, ('role', 'hints')),
+                       snapshot('snap-44444444', 4, ('role', 'hints'),
+                                ('c', 'd'))]},
+        {'Filters': [{'Name': 'tag:role', 'Values': ['data', 'hints']},
+                     {'Name': 'status', 'Values': ['completed']}],
+         'DryRun': False,
+         'RestorableByUserIds': [account_id]})
+
+    # The values of tag keys shared by all sets are filtered by the API, and
+    # the exact sets matched locally
+    scorers = [SnapshotScorer(availability_zone=availability_zone),
+               SnapshotScorer(availability_zone=availability_zone)]
+    result = Inventory.fetch(
+        [[('role', 'data'), ('a', 'b')], [('role', 'hints')]],
+        [[('role', 'data')], [('role', 'hints'), ('c', 'e')]],
+        scorers=scorers)
+    ec2_stub.assert_no_pending_responses()
+
+    assert result.volumes == [
+        Volume('vol-11111111', tags=(('role', 'data'), ('a', 'b')))]
+    # Only the best snapshot of each lookup is kept
+    assert result.snapshots is None
+    best = result.find_existing_snapshot([('role', 'data')],
+                                         scorer=scorers[0])
+    assert best.snapshot_id == 'snap-22222222'
+    assert result.find_existing_snapshot(
+        [('role', 'hints'), ('c', 'e')], scorer=scorers[1]) is None
+
+    # Other lookups fall back to the API
+    find_existing_snapshot = mocker.patch(
+        'ebs_snatcher.ebs.find_existing_snapshot')
+    assert result.find_existing_snapshot([('role', 'other')]) is \
+        find_existing_snapshot.return_value
+
+
+def test_find_volumes(instance_info, instance_id, availability_zone):
+    attached = Volume(
+        'vol-11111111', 'in-use', availability_zone,
+        attachments=(Attachment(instance_id, '/dev/sdf', 'attached'),),
+        tags=(('a', 'b'), ('c', 'd')))
+    available = Volume('vol-22222222', 'available', availability_zone,
+                       tags=(('a', 'b'),))
+
+    inv = Inventory(volumes=[attached, available])
+    assert inv.find_volumes([('a', 'b')], instance_info) == \
+        ([attached], [available], [])
+    assert inv.find_volumes([('a', 'b'), ('c', 'd')], instance_info) == \
+        ([attached], [], [])
+    assert inv.find_volumes([('x', 'y')], instance_info) == ([], [], [])
+
+
+def test_find_existing_snapshot():
+    snap_old = Snapshot('snap-11111111', start_time=datetime(2017, 1, 1),
+                        tags=(('a', 'b'),))
+    snap_new = Snapshot('snap-22222222', start_time=datetime(2017, 2, 1),
+                        tags=(('c', 'd'),))
+
+    inv = Inventory(snapshots=[snap_old, snap_new])
+    assert inv.find_existing_snapshot() == snap_new
+    assert inv.find_existing_snapshot([('a', 'b')]) == snap_old
+    assert inv.find_existing_snapshot([('x', 'y')]) is None
+
+
+def test_claim_volume(instance_info, availability_zone):
+    available = Volume('vol-11111111', 'available', availability_zone,
+                       tags=(('a', 'b'),))
+
+    inv = Inventory(volumes=[available])
+    assert inv.find_volumes([('a', 'b')], instance_info) == \
+        ([], [available], [])
+
+    inv.claim_volume('vol-11111111')
+    assert inv.find_volumes([('a', 'b')], instance_info) == ([], [], [])
+
+
+def test_find_snapshots_by_volume_offline(availability_zone):
+    snap_1 = Snapshot('snap-11111111', 'vol-11111111',
+                      start_time=datetime(2017, 1, 1))
+    snap_2 = Snapshot('snap-22222222', 'vol-11111111',
+                      start_time=datetime(2017, 2, 1))
+    snap_3 = Snapshot('snap-33333333', 'vol-22222222',
+                      start_time=datetime(2017, 3, 1))
+
+    # Fast restore IDs come from the inventory instead of the API
+    scorer = SnapshotScorer(weights={'fsr': 100.0},
+                            availability_zone=availability_zone,
+                            now=datetime(2017, 4, 1))
+    inv = Inventory(snapshots=[snap_1, snap_2, snap_3],
+                    fast_restore_ids={availability_zone: {'snap-11111111'}},
+                    offline=True)
+
+    best = inv.find_snapshots_by_volume(['vol-11111111'], scorer=scorer)
+    assert list(best) == ['vol-11111111']
+    assert best['vol-11111111'][1].snapshot_id == 'snap-11111111'
+
+
+def test_find_snapshots_by_volume_online(mocker):
+    find = mocker.patch('ebs_snatcher.ebs.find_snapshots_by_volume')
+
+    inv = Inventory()
+    assert inv.find_snapshots_by_volume(['vol-11111111'], page_size=10) is \
+        find.return_value
+    find.assert_called_once_with(['vol-11111111'], page_size=10, scorer=None)
@@ -1,10 +1,19 @@
 from __future__ import unicode_literals
 
+import argparse
+import copy
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from botocore.exceptions import ClientError
 
 from .. import main
+from ..ebs import claim_volume, release_volume
+from ..records import Attachment, Snapshot, Volume
 
 
 @pytest.mark.parametrize('value,result', [
@@ -24,6 +33,53 @@ def test_positive_int(value, result):
         assert main.positive_int(value) == result
 
 
+@pytest.mark.parametrize('value,result', [
+    ('5', 5),
+    ('1000', 1000),
+    ('4', ValueError),
+    ('1001', ValueError),
+    ('0', ValueError),
+    ('asd', ValueError)
+])
+def test_snapshot_page_size(value, result):
+    if isinstance(result, type):
+        with pytest.raises(result):
+            main.snapshot_page_size(value)
+    else:
+        assert main.snapshot_page_size(value) == result
+
+
+@pytest.mark.parametrize('value,result', [
+    ('1.5', 1.5),
+    (b'1.5', 1.5),
+    ('0', ValueError),
+    ('-1', ValueError),
+    ('asd', ValueError),
+    (None, TypeError)
+])
+def test_positive_float(value, result):
+    if isinstance(result, type):
+        with pytest.raises(result):
+            main.positive_float(value)
+    else:
+        assert main.positive_float(value) == result
+
+
+@pytest.mark.parametrize('value,result', [
+    ('fsr=100', ('fsr', 100.0)),
+    ('age=0.5', ('age', 0.5)),
+    ('bogus=1', ValueError),
+    ('fsr=x', ValueError),
+    ('fsr', ValueError)
+])
+def test_score_weight(value, result):
+    if isinstance(result, type):
+        with pytest.raises(result):
+            main.score_weight(value)
+    else:
+        assert main.score_weight(value) == result
+
+
 @pytest.mark.parametrize('value,result', [
     ('a=b', ('a', 'b')),
     (b'a=b', ('a', 'b')),
@@ -41,17 +97,123 @@ def test_key_tag_pair(value, result):
         assert main.key_tag_pair(value) == result
 
 
+def test_override_args():
+    args = argparse.Namespace(volume_id_tag=[('a', 'b')], volume_size=10,
+                              volume_extra_tag=[('c', 'd')])
+    overrides = {'instance_id': 'i-11111111', 'volume_id_tag': ['x=y'],
+                 'volume_size': 20, 'volume_extra_tag': None}
+
+    new_args = main.override_args(args, overrides)
+    assert new_args.instance_id == 'i-11111111'
+    assert new_args.volume_id_tag == [('x', 'y')]
+    assert new_args.volume_size == 20
+    assert new_args.volume_extra_tag is None
+    # Original arguments must not be changed
+    assert args.volume_id_tag == [('a', 'b')]
+    assert args.volume_size == 10
+
+
+def test_override_args_snapshot_prefer_tag():
+    args = argparse.Namespace(snapshot_prefer_tag=None)
+
+    new_args = main.override_args(args, {'snapshot_prefer_tag': ['role=db']})
+    assert new_args.snapshot_prefer_tag == [('role', 'db')]
+
+
+def test_override_args_snapshot_weight():
+    args = argparse.Namespace(snapshot_weight=None)
+
+    new_args = main.override_args(
+        args, {'snapshot_weight': ['age=1', 'tag=5']})
+    assert new_args.snapshot_weight == [('age', 1.0), ('tag', 5.0)]
+
+    with pytest.raises(ValueError):
+        main.override_args(args, {'snapshot_weight': ['bogus=1']})
+
+
+@pytest.mark.parametrize('metadata_instance_id', ['i-11111111', 'i-22222222',
+                                                  None])
+def test_get_instance_info_metadata(mocker, main_args, instance_info,
+                                    metadata_instance_id):
+    metadata_info = {'InstanceId': metadata_instance_id,
+                     'Placement': {'AvailabilityZone': 'us-east-1a'}}
+    if metadata_instance_id:
+        get_identity = mocker.patch(
+            'ebs_snatcher.imds.get_instance_identity',
+            return_value=(metadata_info, '23456789012'))
+    else:
+        get_identity = mocker.patch(
+            'ebs_snatcher.imds.get_instance_identity',
+            side_effect=main.imds.MetadataError('unreachable'))
+
+    api_get_instance_info = mocker.patch('ebs_snatcher.ebs.get_instance_info',
+                                         return_value=instance_info)
+    set_account_id = mocker.patch('ebs_snatcher.ebs.set_account_id')
+
+    main_args.instance_metadata = True
+    result = main.get_instance_info(main_args)
+    get_identity.assert_called_once_with()
+
+    if metadata_instance_id == main_args.instance_id:
+        assert result == metadata_info
+        set_account_id.assert_called_once_with('23456789012')
+        assert not api_get_instance_info.called
+    else:
+        assert result == instance_info
+        assert not set_account_id.called
+        api_get_instance_info.assert_called_once_with(main_args.instance_id)
+
+
 @pytest.fixture
 def main_args(mocker, instance_id, attach_device):
     args = mocker.Mock(spec=[
         'instance_id', 'volume_id_tag', 'volume_size', 'snapshot_search_tag',
         'attach_device', 'volume_extra_tag', 'encrypt_kms_key_id',
-        'volume_type', 'volume_iops'
+        'volume_type', 'volume_iops', 'move_to_current_az',
+        'parallel_survey', 'snapshot_page_size', 'instance_metadata',
+        'device_timeout', 'device_poll_interval', 'wait_initial_delay',
+        'wait_max_delay', 'wait_timeout', 'cache_dir', 'cache_ttl',
+        'volume_count', 'hydrate', 'hydrate_readers', 'hydrate_block_size',
+        'hydrate_rate_limit', 'snapshot_weight', 'snapshot_prefer_tag',
+        'aws_profile', 'aws_max_connections', 'snapshot_region',
+        'snapshot_copy_timeout', 'modify_attached', 'grow_filesystem',
+        'claim_lease', 'claim_settle_delay', 'api_describe_rate',
+        'api_mutate_rate', 'api_rate_file', 'timings', 'metrics_file'
     ])
 
     args.instance_id = instance_id
     args.attach_device = attach_device
     args.move_to_current_az = False
+    args.parallel_survey = False
+    args.snapshot_page_size = None
+    args.instance_metadata = False
+    args.device_timeout = 100.0
+    args.device_poll_interval = 0.5
+    args.wait_initial_delay = 1.0
+    args.wait_max_delay = 15.0
+    args.wait_timeout = 600.0
+    args.cache_dir = None
+    args.cache_ttl = 300.0
+    args.volume_count = 1
+    args.hydrate = False
+    args.hydrate_readers = 8
+    args.hydrate_block_size = 1024
+    args.hydrate_rate_limit = None
+    args.snapshot_weight = None
+    args.snapshot_prefer_tag = None
+    args.aws_profile = None
+    args.aws_max_connections = None
+    args.snapshot_region = None
+    args.snapshot_copy_timeout = 7200.0
+    args.modify_attached = False
+    args.grow_filesystem = False
+    args.claim_lease = 120.0
+    args.claim_settle_delay = 1.0
+    args.api_describe_rate = 20.0
+    args.api_mutate_rate = 5.0
+    args.api_rate_file = None
+    args.timings = False
+    args.metrics_file = None
     return args
 
 
@@ -76,20 +238,28 @@ def run_main(capfd, mocker, main_args, instance_info):
     return run_main
 
 
+@pytest.fixture(autouse=True)
+def mock_claim_volume(mocker):
+    mocker.patch('ebs_snatcher.ebs.release_volume')
+    return mocker.patch('ebs_snatcher.ebs.claim_volume',
+                        return_value='claim')
+
+
 @pytest.fixture(autouse=True)
 def mock_find_system_block_device(mocker):
-    def find_device(volume_id, ebs_device, retries=None):
+    def find_device(volume_id, ebs_device, timeout=None, poll_interval=None,
+                    fallback=True):
         return ebs_device
 
-    mocker.patch('ebs_snatcher.ebs.find_system_block_device',
-                 side_effect=find_device)
+    return mocker.patch('ebs_snatcher.ebs.find_system_block_device',
+                        side_effect=find_device)
 
 
 def test_main_already_attached(mocker, attached_volume, run_main, volume_id,
                                attach_device, main_args, instance_info):
-    find_attached_volumes = \
-        mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                     return_value=[attached_volume])
+    find_volumes = \
+        mocker.patch('ebs_snatcher.ebs.find_volumes',
+                     return_value=([attached_volume], [], []))
 
     exit_status, json_out, err = run_main()
     assert exit_status == 0
@@ -97,21 +267,81 @@ def test_main_already_attached(mocker, attached_volume, run_main, volume_id,
     assert json_out['attached_device'] == attach_device
     assert json_out['result'] == 'present'
     assert json_out['src_snapshot_id'] is None
+    assert json_out['device_wait_time'] >= 0
+    assert 'api_calls' not in json_out
+    assert 'timings' not in json_out
 
-    find_attached_volumes.assert_called_once_with(
+    find_volumes.assert_called_once_with(
         main_args.volume_id_tag,
-        instance_info)
+        instance_info,
+        cache=None)
+
+
+@pytest.mark.parametrize('size,volume_type,iops,modification', [
+    (20, 'gp2', None, {'size': 20}),
+    (5, 'gp2', None, None),
+    (10, 'io1', 1000, {'volume_type': 'io1', 'iops': 1000}),
+])
+def test_main_modify_attached(mocker, attached_volume, run_main, main_args,
+                              volume_id, attach_device, size, volume_type,
+                              iops, modification):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([attached_volume._replace(
+                     size=10, volume_type='gp2')], [], []))
+    modify_volume = mocker.patch('ebs_snatcher.ebs.modify_volume')
+    grow_filesystem = mocker.patch(
+        'ebs_snatcher.filesystem.grow_filesystem',
+        return_value={'device': attach_device, 'filesystem': 'ext4',
+                      'grown': True})
+
+    exit_status, json_out, err = run_main(
+        modify_attached=True, grow_filesystem=True, volume_size=size,
+        volume_type=volume_type, volume_iops=iops)
+    assert exit_status == 0
+    assert json_out['volume_id'] == volume_id
+    assert json_out['modification'] == modification
+
+    if not modification:
+        # Volumes are never shrunk
+        assert json_out['result'] == 'present'
+        assert not modify_volume.called
+        return
+
+    assert json_out['result'] == 'modified'
+    modify_volume.assert_called_once_with(volume_id, waiter=mocker.ANY,
+                                          **modification)
+    # Only growing the volume requires growing the filesystem
+    if 'size' in modification:
+        grow_filesystem.assert_called_once_with(attach_device)
+        assert json_out['filesystem']['grown']
+    else:
+        assert not grow_filesystem.called
+        assert json_out['filesystem'] is None
+
+
+def test_main_modify_attached_keeps_type(mocker, attached_volume, run_main,
+                                         volume_id):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([attached_volume._replace(
+                     size=10, volume_type='io1', iops=1000)], [], []))
+    modify_volume = mocker.patch('ebs_snatcher.ebs.modify_volume')
+
+    # Without --volume-type, only the size is changed
+    exit_status, json_out, err = run_main(
+        modify_attached=True, volume_size=20, volume_type=None,
+        volume_iops=None)
+    assert exit_status == 0
+    assert json_out['modification'] == {'size': 20}
+    modify_volume.assert_called_once_with(volume_id, waiter=mocker.ANY,
+                                          size=20)
 
 
 def test_main_available_volume(mocker, volume_id, attach_device, run_main,
                                main_args, instance_info):
-    find_attached_volumes = \
-        mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                     return_value=[])
-
-    volume = {'VolumeId': volume_id}
-    mocker.patch('ebs_snatcher.ebs.find_available_volumes',
-                 return_value=[volume])
+    volume = Volume(volume_id)
+    find_volumes = \
+        mocker.patch('ebs_snatcher.ebs.find_volumes',
+                     return_value=([], [volume], []))
 
     attach_volume = mocker.patch('ebs_snatcher.ebs.attach_volume',
                                  return_value=attach_device)
@@ -123,30 +353,321 @@ def test_main_available_volume(mocker, volume_id, attach_device, run_main,
     assert json_out['result'] == 'attached'
     assert json_out['src_snapshot_id'] is None
 
-    find_attached_volumes.assert_called_once_with(
+    find_volumes.assert_called_once_with(
         main_args.volume_id_tag,
-        instance_info)
+        instance_info,
+        cache=None)
 
     attach_volume.assert_called_once_with(
         volume_id=volume_id,
         instance_info=instance_info,
-        device_name=attach_device)
+        device_name=attach_device,
+        waiter=mocker.ANY)
+
+
+def test_main_timings(mocker, volume_id, attach_device, run_main):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [Volume(volume_id)], []))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+
+    exit_status, json_out, err = run_main(timings=True)
+    assert exit_status == 0
+    assert sorted(json_out['timings']) == ['attach', 'device', 'survey']
+    assert all(phase['seconds'] >= 0
+               for phase in json_out['timings'].values())
+    assert json_out['api_calls']['describe']['throttled'] == 0
+
+
+def test_main_metrics(mocker, volume_id, attach_device, run_main, tmpdir):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [Volume(volume_id)], []))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+
+    path = tmpdir.join('ebs-snatcher.prom')
+    exit_status, json_out, err = run_main(metrics_file=str(path))
+    assert exit_status == 0
+
+    lines = path.read().splitlines()
+    assert 'ebs_snatcher_runs_total{result="attached"} 1' in lines
+    assert 'ebs_snatcher_phase_duration_seconds_count{phase="attach"} 1' in \
+        lines
+
+
+def test_main_metrics_error(mocker, run_main, tmpdir):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 side_effect=RuntimeError('boom'))
+
+    path = tmpdir.join('ebs-snatcher.prom')
+    with pytest.raises(RuntimeError):
+        run_main(metrics_file=str(path))
+
+    assert 'ebs_snatcher_runs_total{result="error"} 1' in \
+        path.read().splitlines()
+
+
+def test_main_metrics_write_error(mocker, volume_id, attach_device,
+                                  run_main, tmpdir):
+    path = str(tmpdir.join('missing', 'ebs-snatcher.prom'))
+    find_volumes = mocker.patch('ebs_snatcher.ebs.find_volumes',
+                                side_effect=RuntimeError('boom'))
+
+    # The provisioning error is not replaced by the metrics one
+    with pytest.raises(RuntimeError, match='boom'):
+        run_main(metrics_file=path)
+
+    # Nor is a successful run failed
+    find_volumes.side_effect = None
+    find_volumes.return_value = ([], [Volume(volume_id)], [])
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+    exit_status, json_out, err = run_main(metrics_file=path)
+    assert exit_status == 0
+    assert json_out['result'] == 'attached'
+
+
+def test_main_available_volume_failover(mocker, gen_volume_id, attach_device,
+                                        run_main, mock_claim_volume):
+    volume_ids = [gen_volume_id() for _ in range(3)]
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [Volume(v) for v in volume_ids], []))
+
+    taken = ClientError({'Error': {'Code': 'VolumeInUse', 'Message': ''}},
+                        'AttachVolume')
+    # First claim is lost, second volume is taken while attaching it
+    mock_claim_volume.side_effect = [None, 'claim', 'claim']
+    attach_volume = mocker.patch('ebs_snatcher.ebs.attach_volume',
+                                 side_effect=[taken, attach_device])
+
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'attached'
+    assert json_out['volume_id'] == attach_volume.call_args[1]['volume_id']
+
+    claimed = [c[0][0] for c in mock_claim_volume.call_args_list]
+    assert sorted(claimed) == sorted(volume_ids)
+    assert [c[1]['volume_id'] for c in attach_volume.call_args_list] == \
+        claimed[1:]
+
+
+def test_main_available_volume_all_taken(mocker, gen_volume_id, volume_id,
+                                         snapshot_id, attach_device, run_main,
+                                         mock_claim_volume):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [Volume(gen_volume_id())], []))
+    mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                 return_value=Snapshot(snapshot_id))
+    mock_claim_volume.return_value = None
+    create_volume = mocker.patch('ebs_snatcher.ebs.create_volume',
+                                 return_value=Volume(volume_id))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'created'
+    assert json_out['volume_id'] == volume_id
+    assert json_out['src_snapshot_id'] == snapshot_id
+    assert create_volume.call_args[1]['src_snapshot_id'] == snapshot_id
+
+
+class FakeEC2(object):
+    # Stand-in for the parts of the EC2 API used to claim and attach volumes,
+    # with a random delay in each call, such that concurrent callers interleave
+    def __init__(self, volume_ids):
+        self.lock = threading.Lock()
+        self.volumes = {}
+        for volume_id in volume_ids:
+            self.add_volume(volume_id)
+
+    def add_volume(self, volume_id):
+        with self.lock:
+            self.volumes[volume_id] = {'VolumeId': volume_id,
+                                       'State': 'available',
+                                       'Tags': [],
+                                       'Attachments': []}
+
+    def _delay(self):
+        time.sleep(random.uniform(0, 0.002))
+
+    def describe_volumes(self, VolumeIds, DryRun, Filters=None):
+        self._delay()
+        with self.lock:
+            return {'Volumes': [copy.deepcopy(self.volumes[volume_id])
+                                for volume_id in VolumeIds]}
+
+    def create_tags(self, Resources, Tags, DryRun):
+        self._delay()
+        with self.lock:
+            for volume_id in Resources:
+                volume = self.volumes[volume_id]
+                keys = set(tag['Key'] for tag in Tags)
+                volume['Tags'] = [tag for tag in volume['Tags']
+                                  if tag['Key'] not in keys] + list(Tags)
+
+    def delete_tags(self, Resources, Tags, DryRun):
+        with self.lock:
+            for volume_id in Resources:
+                volume = self.volumes[volume_id]
+                volume['Tags'] = [tag for tag in volume['Tags']
+                                  if tag not in Tags]
+
+    def attach_volume(self, Device, InstanceId, VolumeId, DryRun):
+        self._delay()
+        with self.lock:
+            volume = self.volumes[VolumeId]
+            if volume['State'] != 'available':
+                raise ClientError(
+                    {'Error': {'Code': 'VolumeInUse',
+                               'Message': 'Volume is in use'}},
+                    'AttachVolume')
+
+            volume['State'] = 'in-use'
+            volume['Attachments'] = [{'InstanceId': InstanceId,
+                                      'Device': Device,
+                                      'State': 'attached'}]
+
+
+def test_claim_boot_storm(mocker, main_args, mock_claim_volume,
+                          availability_zone):
+    # Many instances booting at once compete for few available volumes
+    volume_ids = ['vol-{:08d}'.format(i) for i in range(5)]
+    instance_ids = ['i-{:08d}'.format(i) for i in range(20)]
+    settle_delay = 0.02
+
+    ec2 = FakeEC2(volume_ids)
+    mocker.patch('ebs_snatcher.ebs.ec2', return_value=ec2)
+    mock_claim_volume.side_effect = claim_volume
+    mocker.patch('ebs_snatcher.ebs.release_volume',
+                 side_effect=release_volume)
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 side_effect=lambda *args, **kwargs: (
+                     [], [Volume(v, 'available') for v in volume_ids], []))
+    mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                 return_value=None)
+
+    new_volume_ids = iter('vol-new{:05d}'.format(i) for i in range(100))
+
+    def create_volume(**kwargs):
+        volume_id = next(new_volume_ids)
+        ec2.add_volume(volume_id)
+        return Volume(volume_id)
+
+    mocker.patch('ebs_snatcher.ebs.create_volume', side_effect=create_volume)
+
+    def provision(instance_id):
+        args = copy.copy(main_args)
+        args.attach_device = 'auto'
+        args.claim_settle_delay = settle_delay
+        instance_info = {
+            'InstanceId': instance_id,
+            'Placement': {'AvailabilityZone': availability_zone}
+        }
+
+        start = time.time()
+        resource_state = main.provision(args, instance_info)
+        return resource_state, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=len(instance_ids)) as executor:
+        results = list(executor.map(provision, instance_ids))
+
+    states = [resource_state for resource_state, _ in results]
+    attached = [s.volume_id for s in states if s.state == 'attached']
+    created = [s.volume_id for s in states if s.state == 'created']
+
+    # Every available volume is attached exactly once, and everyone else
+    # creates a volume instead of failing
+    assert sorted(attached) == volume_ids
+    assert len(created) == len(instance_ids) - len(volume_ids)
+    for state in states:
+        volume = ec2.volumes[state.volume_id]
+        assert volume['Attachments'][0]['InstanceId'] == \
+            state.instance_info['InstanceId']
+        # Claims are released after attaching
+        assert volume['Tags'] == []
+
+    # Each instance tries every candidate at most once
+    assert mock_claim_volume.call_count <= \
+        len(instance_ids) * len(volume_ids)
+    assert max(elapsed for _, elapsed in results) < \
+        len(volume_ids) * (settle_delay + 0.5)
+
+
+def test_claim_concurrent_moves(mocker, main_args, mock_claim_volume,
+                                availability_zone):
+    # Instances booting at once all pick the same best volume to move from
+    # another AZ, but only one of them can move each volume
+    other_az = availability_zone + 'x'
+    old_volume_ids = ['vol-old00000', 'vol-old00001']
+    instance_ids = ['i-00000000', 'i-00000001', 'i-00000002']
+
+    ec2 = FakeEC2(old_volume_ids)
+    mocker.patch('ebs_snatcher.ebs.ec2', return_value=ec2)
+    mock_claim_volume.side_effect = claim_volume
+    mocker.patch('ebs_snatcher.ebs.release_volume',
+                 side_effect=release_volume)
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 side_effect=lambda *args, **kwargs: (
+                     [], [], [Volume(v, 'available', other_az)
+                              for v in old_volume_ids]))
+    mocker.patch('ebs_snatcher.ebs.find_snapshots_by_volume',
+                 return_value={
+                     'vol-old00000': (2, Snapshot('snap-00000000')),
+                     'vol-old00001': (1, Snapshot('snap-00000001'))})
+
+    new_volume_ids = iter('vol-new{:05d}'.format(i) for i in range(100))
+    created_from = {}
+
+    def create_volume(src_snapshot_id=None, **kwargs):
+        volume_id = next(new_volume_ids)
+        created_from[volume_id] = src_snapshot_id
+        ec2.add_volume(volume_id)
+        return Volume(volume_id)
+
+    def delete_volume(volume_id, waiter=None):
+        with ec2.lock:
+            del ec2.volumes[volume_id]
+
+    mocker.patch('ebs_snatcher.ebs.create_volume', side_effect=create_volume)
+    delete_volume = mocker.patch('ebs_snatcher.ebs.delete_volume',
+                                 side_effect=delete_volume)
+
+    def provision(instance_id):
+        args = copy.copy(main_args)
+        args.move_to_current_az = True
+        args.attach_device = 'auto'
+        args.claim_settle_delay = 0.02
+        instance_info = {
+            'InstanceId': instance_id,
+            'Placement': {'AvailabilityZone': availability_zone}
+        }
+
+        return main.provision(args, instance_info)
+
+    with ThreadPoolExecutor(max_workers=len(instance_ids)) as executor:
+        states = list(executor.map(provision, instance_ids))
+
+    # Each old volume is moved by a single instance, from its own snapshot,
+    # and the last one creates a volume from scratch
+    moved = sorted((s.old_volume_id, created_from[s.volume_id])
+                   for s in states if s.old_volume_id)
+    assert moved == [('vol-old00000', 'snap-00000000'),
+                     ('vol-old00001', 'snap-00000001')]
+    assert delete_volume.call_count == 2
+    assert [created_from[s.volume_id] for s in states
+            if not s.old_volume_id] == [None]
+    assert all(s.state == 'created' for s in states)
 
 
 def test_main_available_snapshot(mocker, snapshot_id, volume_id, attach_device,
                                  run_main, main_args, availability_zone,
                                  instance_info):
-    mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                 return_value=[])
-    mocker.patch('ebs_snatcher.ebs.find_available_volumes',
-                 return_value=[])
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [], []))
 
-    snapshot = {'SnapshotId': snapshot_id}
+    snapshot = Snapshot(snapshot_id, score_reason='because')
     find_existing_snapshot = \
         mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
                      return_value=snapshot)
 
-    volume = {'VolumeId': volume_id}
+    volume = Volume(volume_id)
     create_volume = mocker.patch('ebs_snatcher.ebs.create_volume',
                                  autospec=True,
                                  return_value=volume)
@@ -160,9 +681,14 @@ def test_main_available_snapshot(mocker, snapshot_id, volume_id, attach_device,
     assert json_out['attached_device'] == attach_device
     assert json_out['result'] == 'created'
     assert json_out['src_snapshot_id'] == snapshot_id
+    assert json_out['src_snapshot_reason'] == 'because'
 
     find_existing_snapshot.assert_called_once_with(
-        search_tags=main_args.snapshot_search_tag)
+        search_tags=main_args.snapshot_search_tag,
+        page_size=main_args.snapshot_page_size,
+        cache=None,
+        scorer=mocker.ANY,
+        regions=())
 
     create_volume.assert_called_once_with(
         availability_zone=availability_zone,
@@ -172,27 +698,58 @@ def test_main_available_snapshot(mocker, snapshot_id, volume_id, attach_device,
         volume_type=main_args.volume_type,
         size=main_args.volume_size,
         iops=main_args.volume_iops,
-        kms_key_id=main_args.encrypt_kms_key_id)
+        kms_key_id=main_args.encrypt_kms_key_id,
+        waiter=mocker.ANY)
 
     attach_volume.assert_called_once_with(
         volume_id=volume_id,
         instance_info=instance_info,
-        device_name=attach_device)
+        device_name=attach_device,
+        waiter=mocker.ANY)
+
+
+def test_main_remote_snapshot(mocker, snapshot_id, volume_id, attach_device,
+                              run_main, main_args, availability_zone):
+    main_args.snapshot_region = ['eu-west-1']
+    main_args.encrypt_kms_key_id = 'key'
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [], []))
+
+    snapshot = Snapshot(snapshot_id, score_reason='because',
+                        region='eu-west-1')
+    find_existing_snapshot = \
+        mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                     return_value=snapshot)
+    copy_snapshot = mocker.patch('ebs_snatcher.ebs.copy_snapshot',
+                                 return_value='snap-copy')
+    create_volume = mocker.patch('ebs_snatcher.ebs.create_volume',
+                                 return_value=Volume(volume_id))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'created'
+    assert json_out['src_snapshot_id'] == 'snap-copy'
+    assert json_out['src_snapshot_copied_from'] == {
+        'region': 'eu-west-1', 'snapshot_id': snapshot_id}
+
+    assert find_existing_snapshot.call_args[1]['regions'] == ['eu-west-1']
+    copy_snapshot.assert_called_once_with(
+        snapshot, kms_key_id='key', waiter=mocker.ANY,
+        timeout=main_args.snapshot_copy_timeout)
+    assert create_volume.call_args[1]['src_snapshot_id'] == 'snap-copy'
 
 
 def test_main_create_scratch(mocker, volume_id, attach_device, run_main,
                              main_args, instance_info, availability_zone):
-    find_attached_volumes = \
-        mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                     return_value=[])
-    find_available_volumes = \
-        mocker.patch('ebs_snatcher.ebs.find_available_volumes',
-                     return_value=[])
+    find_volumes = \
+        mocker.patch('ebs_snatcher.ebs.find_volumes',
+                     return_value=([], [], []))
     find_existing_snapshot = \
         mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
                      return_value=None)
 
-    volume = {'VolumeId': volume_id}
+    volume = Volume(volume_id)
     create_volume = mocker.patch('ebs_snatcher.ebs.create_volume',
                                  autospec=True,
                                  return_value=volume)
@@ -207,17 +764,17 @@ def test_main_create_scratch(mocker, volume_id, attach_device, run_main,
     assert json_out['result'] == 'created'
     assert json_out['src_snapshot_id'] is None
 
-    find_attached_volumes.assert_called_once_with(
-        main_args.volume_id_tag,
-        instance_info)
-
-    find_available_volumes.assert_called_once_with(
+    find_volumes.assert_called_once_with(
         main_args.volume_id_tag,
         instance_info,
-        current_az=True)
+        cache=None)
 
     find_existing_snapshot.assert_called_once_with(
-        search_tags=main_args.snapshot_search_tag)
+        search_tags=main_args.snapshot_search_tag,
+        page_size=main_args.snapshot_page_size,
+        cache=None,
+        scorer=mocker.ANY,
+        regions=())
 
     create_volume.assert_called_once_with(
         availability_zone=availability_zone,
@@ -227,30 +784,21 @@ def test_main_create_scratch(mocker, volume_id, attach_device, run_main,
         volume_type=main_args.volume_type,
         size=main_args.volume_size,
         iops=main_args.volume_iops,
-        kms_key_id=main_args.encrypt_kms_key_id)
+        kms_key_id=main_args.encrypt_kms_key_id,
+        waiter=mocker.ANY)
 
     attach_volume.assert_called_once_with(
         volume_id=volume_id,
         instance_info=instance_info,
-        device_name=attach_device)
+        device_name=attach_device,
+        waiter=mocker.ANY)
 
 
 def test_main_replace_current_az(mocker, volume_id, attach_device, main_args,
                                  run_main, instance_info):
-    mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                 return_value=[])
-
-    volume = {'VolumeId': volume_id}
-
-    def available_volumes(id_tags, instance_info, filters=None,
-                          current_az=True):
-        if current_az:
-            return [volume]
-        else:
-            return []
-
-    mocker.patch('ebs_snatcher.ebs.find_available_volumes',
-                 side_effect=available_volumes)
+    volume = Volume(volume_id)
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [volume], []))
 
     attach_volume = mocker.patch('ebs_snatcher.ebs.attach_volume',
                                  return_value=attach_device)
@@ -266,58 +814,45 @@ def test_main_replace_current_az(mocker, volume_id, attach_device, main_args,
     attach_volume.assert_called_once_with(
         volume_id=volume_id,
         instance_info=instance_info,
-        device_name=attach_device)
+        device_name=attach_device,
+        waiter=mocker.ANY)
 
 
 def test_main_replace_other_az(mocker, gen_volume_id, snapshot_id,
                                attach_device, main_args, run_main,
                                availability_zone, instance_info):
-    mocker.patch('ebs_snatcher.ebs.find_attached_volumes',
-                 return_value=[])
-
     this_az = availability_zone
     other_az = availability_zone + 'x'
 
     old_volume_without_snap_id = gen_volume_id()
     old_volume_without_snap = \
-        {'VolumeId': old_volume_without_snap_id, 'AvailabilityZone': other_az}
+        Volume(old_volume_without_snap_id, availability_zone=other_az)
 
     old_volume_with_snap_id = gen_volume_id()
     old_volume_with_snap = \
-        {'VolumeId': old_volume_with_snap_id, 'AvailabilityZone': other_az}
+        Volume(old_volume_with_snap_id, availability_zone=other_az)
 
     new_volume_id = gen_volume_id()
-    new_volume = \
-        {'VolumeId': new_volume_id, 'AvailabilityZone': this_az}
-
-    snapshot = {'SnapshotId': snapshot_id, 'VolumeId': old_volume_with_snap_id}
-
-    def available_volumes(id_tags, instance_info, filters=None,
-                          current_az=True):
-        if current_az:
-            return []
-        else:
-            return [old_volume_without_snap, old_volume_with_snap]
+    new_volume = Volume(new_volume_id, availability_zone=this_az)
 
-    mocker.patch('ebs_snatcher.ebs.find_available_volumes', autospec=True,
-                 side_effect=available_volumes)
+    old_volume_with_worse_snap_id = gen_volume_id()
+    old_volume_with_worse_snap = \
+        Volume(old_volume_with_worse_snap_id, availability_zone=other_az)
 
-    old_volume_without_snap_filters = \
-        [{'Name': 'volume-id', 'Values': [old_volume_without_snap_id]}]
-    old_volume_with_snap_filters = \
-        [{'Name': 'volume-id', 'Values': [old_volume_with_snap_id]}]
+    snapshot = Snapshot(snapshot_id, old_volume_with_snap_id)
+    worse_snapshot = Snapshot('snap-22222222', old_volume_with_worse_snap_id)
 
-    def existing_snapshot(search_tags=(), filters=()):
-        if filters == old_volume_without_snap_filters:
-            return None
-        elif filters == old_volume_with_snap_filters:
-            return snapshot
+    old_volumes = [old_volume_with_worse_snap, old_volume_without_snap,
+                   old_volume_with_snap]
+    mocker.patch('ebs_snatcher.ebs.find_volumes', autospec=True,
+                 return_value=([], [], old_volumes))
 
-        assert False
-
-    find_existing_snapshot = \
-        mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
-                     side_effect=existing_snapshot)
+    find_snapshots_by_volume = \
+        mocker.patch('ebs_snatcher.ebs.find_snapshots_by_volume',
+                     return_value={
+                         old_volume_with_worse_snap_id: (1, worse_snapshot),
+                         old_volume_with_snap_id: (2, snapshot)
+                     })
 
     create_volume = mocker.patch('ebs_snatcher.ebs.create_volume',
                                  autospec=True,
@@ -336,9 +871,10 @@ def test_main_replace_other_az(mocker, gen_volume_id, snapshot_id,
     assert json_out['result'] == 'created'
     assert json_out['src_snapshot_id'] == snapshot_id
 
-    find_existing_snapshot.assert_has_calls([
-        mocker.call(filters=old_volume_without_snap_filters),
-        mocker.call(filters=old_volume_with_snap_filters)])
+    # All volumes are searched at once, and the best snapshot is picked
+    find_snapshots_by_volume.assert_called_once_with(
+        dict((v.volume_id, v) for v in old_volumes),
+        page_size=None, scorer=mocker.ANY)
 
     create_volume.assert_called_once_with(
         availability_zone=availability_zone,
@@ -348,12 +884,251 @@ def test_main_replace_other_az(mocker, gen_volume_id, snapshot_id,
         volume_type=main_args.volume_type,
         size=main_args.volume_size,
         iops=main_args.volume_iops,
-        kms_key_id=main_args.encrypt_kms_key_id)
+        kms_key_id=main_args.encrypt_kms_key_id,
+        waiter=mocker.ANY)
 
     attach_volume.assert_called_once_with(
         volume_id=new_volume_id,
         instance_info=instance_info,
-        device_name=attach_device)
+        device_name=attach_device,
+        waiter=mocker.ANY)
 
     delete_volume.assert_called_once_with(
-        volume_id=old_volume_with_snap_id)
+        volume_id=old_volume_with_snap_id,
+        waiter=mocker.ANY)
+
+
+@pytest.mark.parametrize('attached', [False, True])
+def test_main_parallel_survey(mocker, snapshot_id, volume_id, attach_device,
+                              run_main, main_args, instance_info, attached,
+                              attached_volume):
+    find_volumes = \
+        mocker.patch('ebs_snatcher.ebs.find_volumes',
+                     return_value=([attached_volume] if attached else [],
+                                   [], []))
+
+    snapshot = Snapshot(snapshot_id)
+    find_existing_snapshot = \
+        mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                     return_value=snapshot)
+
+    volume = Volume(volume_id)
+    mocker.patch('ebs_snatcher.ebs.create_volume', autospec=True,
+                 return_value=volume)
+    mocker.patch('ebs_snatcher.ebs.attach_volume',
+                 return_value=attach_device)
+
+    main_args.parallel_survey = True
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['volume_id'] == volume_id
+    if attached:
+        assert json_out['result'] == 'present'
+        assert json_out['src_snapshot_id'] is None
+    else:
+        assert json_out['result'] == 'created'
+        assert json_out['src_snapshot_id'] == snapshot_id
+
+    # All lookups are started regardless of which result is picked
+    find_volumes.assert_called_once_with(
+        main_args.volume_id_tag,
+        instance_info,
+        cache=None)
+    find_existing_snapshot.assert_called_once_with(
+        search_tags=main_args.snapshot_search_tag,
+        page_size=main_args.snapshot_page_size,
+        cache=None,
+        scorer=mocker.ANY,
+        regions=())
+
+
+@pytest.mark.parametrize('attached', [False, True])
+def test_main_cache_invalidated(mocker, tmpdir, volume_id, attach_device,
+                                run_main, main_args, attached,
+                                attached_volume):
+    volume = Volume(volume_id)
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([attached_volume] if attached else [],
+                               [volume], []))
+    mocker.patch('ebs_snatcher.ebs.attach_volume',
+                 return_value=attach_device)
+    invalidate = mocker.patch('ebs_snatcher.cache.InventoryCache.invalidate')
+
+    main_args.cache_dir = str(tmpdir)
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+
+    # Only changes to volumes invalidate the cache
+    assert invalidate.called != attached
+
+
+def test_main_volume_set(mocker, gen_volume_id, run_main, main_args,
+                         instance_info, availability_zone):
+    instance_info['BlockDeviceMappings'] = [
+        {'DeviceName': '/dev/sda1'},
+        {'DeviceName': '/dev/sdf'},
+        {'DeviceName': '/dev/sdh'}
+    ]
+
+    present_volume_id = gen_volume_id()
+    present_volume = Volume(present_volume_id, attachments=(
+        Attachment(instance_info['InstanceId'], '/dev/sdf', 'attached'),))
+    available_volume_id = gen_volume_id()
+    available_volume = Volume(available_volume_id)
+
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([present_volume], [available_volume], []))
+
+    new_volume_ids = [gen_volume_id(), gen_volume_id()]
+    create_volume = mocker.patch(
+        'ebs_snatcher.ebs.create_volume', autospec=True,
+        side_effect=[Volume(v) for v in new_volume_ids])
+
+    def attach_volume(volume_id, instance_info, device_name, waiter):
+        return device_name
+
+    attach_volume = mocker.patch('ebs_snatcher.ebs.attach_volume',
+                                 side_effect=attach_volume)
+
+    main_args.volume_count = 4
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'created'
+
+    members = json_out['volumes']
+    assert [m['result'] for m in members] == \
+        ['present', 'attached', 'created', 'created']
+    assert members[0]['volume_id'] == present_volume_id
+    assert members[1]['volume_id'] == available_volume_id
+    assert set(m['volume_id'] for m in members[2:]) == set(new_volume_ids)
+
+    # Devices are allocated upfront, skipping the ones in use
+    assert [m['attached_device'] for m in members] == \
+        ['/dev/sdf', '/dev/sdg', '/dev/sdi', '/dev/sdj']
+
+    assert create_volume.call_count == 2
+    assert attach_volume.call_count == 3
+
+
+def test_main_volume_set_present(mocker, gen_volume_id, run_main, main_args,
+                                 instance_id):
+    volumes = [
+        Volume(gen_volume_id(),
+               attachments=(Attachment(instance_id, device, 'attached'),))
+        for device in ('/dev/sdf', '/dev/sdg', '/dev/sdh')]
+
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=(volumes, [], []))
+    create_volume = mocker.patch('ebs_snatcher.ebs.create_volume')
+    attach_volume = mocker.patch('ebs_snatcher.ebs.attach_volume')
+
+    main_args.volume_count = 2
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'present'
+    assert len(json_out['volumes']) == 2
+
+    assert not create_volume.called
+    assert not attach_volume.called
+
+
+def test_main_volume_set_modify(mocker, gen_volume_id, run_main, main_args,
+                                instance_id):
+    volumes = [
+        Volume(gen_volume_id(), size=size, volume_type='gp2',
+               attachments=(Attachment(instance_id, device, 'attached'),))
+        for size, device in ((10, '/dev/sdf'), (20, '/dev/sdg'))]
+
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=(volumes, [], []))
+    modify_volume = mocker.patch('ebs_snatcher.ebs.modify_volume')
+
+    main_args.volume_count = 2
+    exit_status, json_out, err = run_main(
+        modify_attached=True, volume_size=20, volume_type='gp2',
+        volume_iops=None)
+    assert exit_status == 0
+    assert json_out['result'] == 'modified'
+    assert [m['result'] for m in json_out['volumes']] == \
+        ['modified', 'present']
+
+    modify_volume.assert_called_once_with(volumes[0].volume_id,
+                                          waiter=mocker.ANY, size=20)
+
+
+def test_main_volume_set_taken(mocker, gen_volume_id, snapshot_id, run_main,
+                               main_args, mock_claim_volume):
+    mocker.patch('ebs_snatcher.ebs.find_volumes',
+                 return_value=([], [Volume(gen_volume_id())], []))
+    find_existing_snapshot = mocker.patch(
+        'ebs_snatcher.ebs.find_existing_snapshot',
+        return_value=Snapshot(snapshot_id))
+    mock_claim_volume.return_value = None
+    new_volume_ids = [gen_volume_id(), gen_volume_id()]
+    create_volume = mocker.patch(
+        'ebs_snatcher.ebs.create_volume',
+        side_effect=[Volume(v) for v in new_volume_ids])
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value='/dev/sdf')
+
+    main_args.volume_count = 2
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert [m['result'] for m in json_out['volumes']] == \
+        ['created', 'created']
+
+    # Members that lose their volume are created empty, as the others
+    assert not find_existing_snapshot.called
+    assert [c[1]['src_snapshot_id'] for c in create_volume.call_args_list] \
+        == [None, None]
+
+
+@pytest.mark.parametrize('snapshot', [True, False])
+def test_main_hydrate(mocker, snapshot_id, volume_id, attach_device, run_main,
+                      main_args, snapshot):
+    mocker.patch('ebs_snatcher.ebs.find_volumes', return_value=([], [], []))
+    mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                 return_value=snapshot and Snapshot(snapshot_id))
+    mocker.patch('ebs_snatcher.ebs.create_volume', autospec=True,
+                 return_value=Volume(volume_id))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+
+    stats = {'bytes': 1024, 'seconds': 1.0, 'throughput': 1024.0}
+    hydrate = mocker.patch('ebs_snatcher.hydrate.hydrate',
+                           return_value=stats)
+
+    main_args.hydrate = True
+    main_args.hydrate_rate_limit = 2.0
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+
+    if snapshot:
+        assert json_out['hydration'] == stats
+        hydrate.assert_called_once_with(attach_device, readers=8,
+                                        block_size=1024 * 1024,
+                                        rate_limit=2 * 1024 * 1024)
+    else:
+        assert json_out['hydration'] is None
+        assert not hydrate.called
+
+
+def test_main_hydrate_device_not_found(mocker, snapshot_id, volume_id,
+                                       attach_device, run_main, main_args,
+                                       mock_find_system_block_device):
+    mocker.patch('ebs_snatcher.ebs.find_volumes', return_value=([], [], []))
+    mocker.patch('ebs_snatcher.ebs.find_existing_snapshot',
+                 return_value=Snapshot(snapshot_id))
+    mocker.patch('ebs_snatcher.ebs.create_volume', autospec=True,
+                 return_value=Volume(volume_id))
+    mocker.patch('ebs_snatcher.ebs.attach_volume', return_value=attach_device)
+    # Discovery timed out
+    mock_find_system_block_device.side_effect = None
+    mock_find_system_block_device.return_value = None
+    hydrate = mocker.patch('ebs_snatcher.hydrate.hydrate')
+
+    main_args.hydrate = True
+    exit_status, json_out, err = run_main()
+    assert exit_status == 0
+    assert json_out['result'] == 'created'
+    assert json_out['attached_device'] == attach_device
+    assert json_out['hydration'] is None
+    assert not hydrate.called
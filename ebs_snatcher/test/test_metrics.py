@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+
+from ..metrics import Counter, Histogram, RunMetrics
+from ..timing import Timings
+
+
+class FakeState(object):
+    def __init__(self, state, phases=(), waits=None, members=()):
+        self.state = state
+        self.timings = Timings()
+        for phase in phases:
+            with self.timings.phase(phase):
+                pass
+
+        if waits is not None:
+            self.waiter = FakeWaiter(waits)
+        if members:
+            self.members = list(members)
+
+
+class FakeWaiter(object):
+    def __init__(self, timings):
+        self.timings = timings
+
+
+def test_counter():
+    counter = Counter('things_total', 'Things', ['kind'])
+    counter.inc(kind='a "quoted"\nvalue')
+    counter.inc(2, kind='b')
+
+    assert list(counter.samples()) == [
+        ('things_total', [('kind', 'a "quoted"\nvalue')], 1),
+        ('things_total', [('kind', 'b')], 2)
+    ]
+
+
+def test_histogram():
+    histogram = Histogram('latency_seconds', 'Latency', ['phase'],
+                          buckets=(1.0, 5.0))
+    for value in (0.5, 2.0, 10.0):
+        histogram.observe(value, phase='attach')
+
+    assert list(histogram.samples()) == [
+        ('latency_seconds_bucket', [('phase', 'attach'), ('le', '1.0')], 1),
+        ('latency_seconds_bucket', [('phase', 'attach'), ('le', '5.0')], 2),
+        ('latency_seconds_bucket', [('phase', 'attach'), ('le', '+Inf')], 3),
+        ('latency_seconds_sum', [('phase', 'attach')], 12.5),
+        ('latency_seconds_count', [('phase', 'attach')], 3)
+    ]
+
+
+def test_render():
+    metrics = RunMetrics(clock=lambda: 1500000000.0)
+    metrics.runs.inc(result='a"b\\c')
+
+    lines = metrics.render().splitlines()
+    assert lines[:3] == [
+        '# HELP ebs_snatcher_runs_total Provisioning runs, by result '
+        '(present, modified, attached, created or error)',
+        '# TYPE ebs_snatcher_runs_total counter',
+        'ebs_snatcher_runs_total{result="a\\"b\\\\c"} 1'
+    ]
+    assert '# TYPE ebs_snatcher_phase_duration_seconds histogram' in lines
+
+
+def test_observe_run():
+    metrics = RunMetrics(clock=lambda: 1500000000.0)
+    members = [FakeState('created', ['create', 'attach', 'device'],
+                         {'create': 2.0, 'attach': 1.0}),
+               FakeState('present', ['device'], {})]
+    metrics.observe_run(FakeState('created', ['survey'], members=members),
+                        {'mutate': {'calls': 4, 'retried': 2,
+                                    'throttled': 1, 'wait_time': 0.1}})
+    metrics.observe_run(None)
+
+    lines = metrics.render().splitlines()
+    for line in [
+            'ebs_snatcher_runs_total{result="created"} 1',
+            'ebs_snatcher_runs_total{result="error"} 1',
+            'ebs_snatcher_last_run_timestamp_seconds 1500000000.0',
+            'ebs_snatcher_last_run_success 0',
+            'ebs_snatcher_phase_duration_seconds_count{phase="survey"} 1',
+            'ebs_snatcher_phase_duration_seconds_count{phase="device"} 2',
+            'ebs_snatcher_wait_duration_seconds_sum{stage="create"} 2.0',
+            'ebs_snatcher_api_calls_total{kind="mutate"} 4',
+            'ebs_snatcher_api_retried_total{kind="mutate"} 2',
+            'ebs_snatcher_api_throttled_total{kind="mutate"} 1']:
+        assert line in lines
+
+
+def test_write(tmpdir):
+    path = tmpdir.join('ebs-snatcher.prom')
+    path.write('old')
+
+    metrics = RunMetrics()
+    metrics.observe_run(FakeState('present', ['survey'], {}))
+    metrics.write(str(path))
+
+    # Replaced, without leaving temporary files behind
+    assert path.read() == metrics.render()
+    assert tmpdir.listdir() == [path]
@@ -0,0 +1,215 @@
+from __future__ import unicode_literals
+
+import argparse
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import plan
+
+
+@pytest.fixture
+def plan_args():
+    return argparse.Namespace(
+        volume_id_tag=[('a', 'b')],
+        volume_size=10,
+        snapshot_search_tag=[('c', 'd')],
+        attach_device='/dev/sdf',
+        volume_extra_tag=None,
+        encrypt_kms_key_id=None,
+        volume_type='gp2',
+        volume_iops=None,
+        move_to_current_az=False,
+        parallel_survey=True,
+        snapshot_page_size=None,
+        instance_metadata=False,
+        device_timeout=100.0,
+        device_poll_interval=0.5,
+        wait_initial_delay=1.0,
+        wait_max_delay=15.0,
+        wait_timeout=600.0,
+        cache_dir=None,
+        cache_ttl=300.0,
+        volume_count=1,
+        hydrate=False,
+        hydrate_readers=8,
+        hydrate_block_size=1024,
+        hydrate_rate_limit=None,
+        snapshot_weight=None,
+        snapshot_prefer_tag=None,
+        snapshot_region=None,
+        modify_attached=False)
+
+
+@pytest.mark.parametrize('value,result', [
+    ('2017-01-01T00:00:00Z', datetime(2017, 1, 1, tzinfo=timezone.utc)),
+    ('2017-01-01T00:00:00.5Z',
+     datetime(2017, 1, 1, 0, 0, 0, 500000, tzinfo=timezone.utc)),
+    ('2017-01-01T02:00:00+02:00', datetime(2017, 1, 1, tzinfo=timezone.utc)),
+    ('2016-12-31T21:30:00-0230', datetime(2017, 1, 1, tzinfo=timezone.utc)),
+    ('2017-01-01T00:00:00', datetime(2017, 1, 1, tzinfo=timezone.utc)),
+    ('2017-01-01', ValueError)
+])
+def test_parse_timestamp(value, result):
+    if isinstance(result, type):
+        with pytest.raises(result):
+            plan.parse_timestamp(value)
+    else:
+        assert plan.parse_timestamp(value) == result
+
+
+def tags(*pairs):
+    return [{'Key': k, 'Value': v} for k, v in pairs]
+
+
+def instance(instance_id, az):
+    return {'InstanceId': instance_id, 'Placement': {'AvailabilityZone': az}}
+
+
+def volume(volume_id, az, instance_id=None):
+    attachments = []
+    if instance_id:
+        attachments.append({'InstanceId': instance_id, 'State': 'attached',
+                            'Device': '/dev/sdg'})
+
+    return {'VolumeId': volume_id,
+            'State': 'in-use' if instance_id else 'available',
+            'AvailabilityZone': az,
+            'Attachments': attachments,
+            'Tags': tags(('a', 'b'))}
+
+
+def snapshot(snapshot_id, volume_id, start_time, state='completed'):
+    return {'SnapshotId': snapshot_id,
+            'VolumeId': volume_id,
+            'State': state,
+            'StartTime': start_time,
+            'Tags': tags(('c', 'd'))}
+
+
+def load(**data):
+    return plan.load_inventory([io.StringIO(json.dumps(data))])
+
+
+def test_load_inventory():
+    instances, inventory = plan.load_inventory([
+        io.StringIO(json.dumps({
+            'Reservations': [{'Instances': [instance('i-1', 'us-east-1a')]}],
+            'Volumes': [volume('vol-1', 'us-east-1a')]
+        })),
+        io.StringIO(json.dumps({
+            'Snapshots': [
+                snapshot('snap-1', 'vol-1', '2017-01-01T00:00:00.000Z'),
+                snapshot('snap-2', 'vol-1', '2017-01-02T00:00:00.000Z',
+                         state='pending')
+            ],
+            'FastSnapshotRestores': [
+                {'SnapshotId': 'snap-1', 'AvailabilityZone': 'us-east-1a',
+                 'State': 'enabled'},
+                {'SnapshotId': 'snap-1', 'AvailabilityZone': 'us-east-1b',
+                 'State': 'disabling'}
+            ]
+        }))
+    ])
+
+    assert instances == {'i-1': instance('i-1', 'us-east-1a')}
+    assert inventory.offline
+    assert [v.volume_id for v in inventory.volumes] == ['vol-1']
+    # Incomplete snapshots are skipped
+    assert [s.snapshot_id for s in inventory.snapshots] == ['snap-1']
+    assert inventory.snapshots[0].start_time == \
+        datetime(2017, 1, 1, tzinfo=timezone.utc)
+    assert inventory.fast_restore_ids == {'us-east-1a': set(['snap-1'])}
+
+
+def run(plan_args, entries, instances, inventory):
+    out = io.StringIO()
+    failures = plan.run_plan(plan_args, entries, instances, inventory, out)
+    return failures, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_run_plan(plan_args):
+    instances, inventory = load(
+        Instances=[instance('i-1', 'us-east-1a'),
+                   instance('i-2', 'us-east-1a'),
+                   instance('i-3', 'us-east-1a')],
+        Volumes=[volume('vol-1', 'us-east-1a', 'i-1'),
+                 volume('vol-2', 'us-east-1a'),
+                 volume('vol-3', 'us-east-1b')],
+        Snapshots=[snapshot('snap-1', 'vol-1', '2017-01-01T00:00:00Z'),
+                   snapshot('snap-2', 'vol-1', '2017-02-01T00:00:00Z')])
+
+    entries = [{'instance_id': 'i-1'}, {'instance_id': 'i-2'},
+               {'instance_id': 'i-3', 'attach_device': '/dev/sdh'},
+               {'instance_id': 'i-4'}]
+    failures, results = run(plan_args, entries, instances, inventory)
+
+    assert failures == 1
+    assert [r['instance_id'] for r in results] == \
+        ['i-1', 'i-2', 'i-3', 'i-4']
+
+    assert results[0]['result'] == 'present'
+    assert results[0]['volume_id'] == 'vol-1'
+    assert results[0]['attach_device'] == '/dev/sdg'
+
+    assert results[1]['result'] == 'attached'
+    assert results[1]['volume_id'] == 'vol-2'
+    assert results[1]['attach_device'] == '/dev/sdf'
+
+    # The only available volume in the AZ was claimed by the previous
+    # instance, so a new one must be created
+    assert results[2]['result'] == 'created'
+    assert results[2]['volume_id'] is None
+    assert results[2]['src_snapshot_id'] == 'snap-2'
+    assert results[2]['attach_device'] == '/dev/sdh'
+
+    assert results[3]['status'] == 'error'
+    assert results[3]['error_type'] == 'ValueError'
+
+
+def test_run_plan_move_to_current_az(plan_args):
+    instances, inventory = load(
+        Instances=[instance('i-1', 'us-east-1a'),
+                   instance('i-2', 'us-east-1a')],
+        Volumes=[volume('vol-1', 'us-east-1b')],
+        Snapshots=[snapshot('snap-1', 'vol-1', '2017-01-01T00:00:00Z'),
+                   snapshot('snap-2', 'vol-2', '2017-02-01T00:00:00Z')])
+
+    plan_args.move_to_current_az = True
+    failures, results = run(plan_args, [{'instance_id': 'i-1'},
+                                        {'instance_id': 'i-2'}],
+                            instances, inventory)
+
+    assert failures == 0
+    assert results[0]['result'] == 'created'
+    assert results[0]['old_volume_id'] == 'vol-1'
+    assert results[0]['src_snapshot_id'] == 'snap-1'
+    # The volume is already being moved by the first instance
+    assert results[1]['result'] == 'created'
+    assert results[1]['old_volume_id'] is None
+    assert results[1]['src_snapshot_id'] is None
+
+
+def test_run_plan_volume_set(plan_args):
+    instance_info = dict(instance('i-1', 'us-east-1a'),
+                         BlockDeviceMappings=[{'DeviceName': '/dev/sdg'}])
+    instances, inventory = load(
+        Instances=[instance_info],
+        Volumes=[volume('vol-1', 'us-east-1a', 'i-1'),
+                 volume('vol-2', 'us-east-1a')])
+
+    plan_args.volume_count = 3
+    failures, results = run(plan_args, [{'instance_id': 'i-1'}], instances,
+                            inventory)
+
+    assert failures == 0
+    result = results[0]
+    assert result['result'] == 'created'
+    assert [(v['result'], v['volume_id'], v['attach_device'])
+            for v in result['volumes']] == [
+        ('present', 'vol-1', '/dev/sdg'),
+        ('attached', 'vol-2', '/dev/sdf'),
+        ('created', None, '/dev/sdh')
+    ]
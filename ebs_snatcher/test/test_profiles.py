@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+
+import argparse
+import io
+
+import pytest
+
+from .. import profiles
+
+
+@pytest.fixture
+def profiles_args(instance_id, attach_device):
+    return argparse.Namespace(
+        instance_id=instance_id,
+        volume_id_tag=None,
+        volume_size=10,
+        snapshot_search_tag=None,
+        attach_device=attach_device,
+        snapshot_page_size=None,
+        snapshot_weight=None,
+        snapshot_prefer_tag=None)
+
+
+def test_read_profiles():
+    f = io.StringIO('[{"name": "data", "volume_size": 20}, {"name": "log"}]')
+    assert profiles.read_profiles(f) == [{'name': 'data', 'volume_size': 20},
+                                         {'name': 'log'}]
+
+
+@pytest.mark.parametrize('content', [
+    '{"name": "data"}',
+    '[{"volume_size": 20}]',
+    '[{"name": "data"}, {"name": "data"}]'
+])
+def test_read_profiles_invalid(content):
+    with pytest.raises(ValueError):
+        profiles.read_profiles(io.StringIO(content))
+
+
+def test_profile_args(profiles_args):
+    name, args = profiles.profile_args(
+        profiles_args, {'name': 'data', 'volume_id_tag': ['a=b'],
+                        'snapshot_search_tag': ['c=d']})
+    assert name == 'data'
+    assert args.volume_id_tag == [('a', 'b')]
+    assert args.snapshot_search_tag == [('c', 'd')]
+    assert not hasattr(args, 'name')
+
+    with pytest.raises(ValueError):
+        profiles.profile_args(profiles_args,
+                              {'name': 'data', 'volume_id_tag': ['a=b']})
+
+
+def test_run_profiles(mocker, profiles_args, instance_info):
+    mocker.patch('ebs_snatcher.profiles.get_instance_info',
+                 return_value=instance_info)
+    inventory = mocker.Mock()
+    fetch = mocker.patch('ebs_snatcher.profiles.Inventory.fetch',
+                         return_value=inventory)
+
+    def provision(args, instance_info, inventory):
+        if args.volume_size > 100:
+            raise RuntimeError('too large')
+
+        resource_state = mocker.Mock()
+        resource_state.to_json.return_value = {
+            'volume_id': 'vol-' + args.volume_id_tag[0][1],
+            'result': 'created'}
+        return resource_state
+
+    provision = mocker.patch('ebs_snatcher.profiles.provision',
+                             side_effect=provision)
+
+    metrics = mocker.Mock()
+    results = profiles.run_profiles(profiles_args, [
+        {'name': 'data', 'volume_id_tag': ['role=data'],
+         'snapshot_search_tag': ['role=data']},
+        {'name': 'log', 'volume_id_tag': ['role=log'],
+         'snapshot_search_tag': ['role=log'], 'volume_size': 200}
+    ], metrics=metrics)
+
+    assert results == {
+        'data': {'status': 'ok', 'volume_id': 'vol-data',
+                 'result': 'created'},
+        'log': {'status': 'error', 'error_type': 'RuntimeError',
+                'error': 'too large'}
+    }
+
+    # A single inventory is fetched and shared by all profiles
+    fetch.assert_called_once_with([[('role', 'data')], [('role', 'log')]],
+                                  [[('role', 'data')], [('role', 'log')]],
+                                  page_size=None, scorers=mocker.ANY)
+    # Snapshots are scored as each profile would
+    scorers = fetch.call_args[1]['scorers']
+    assert [scorer.min_size for scorer in scorers] == [10, 200]
+    for call in provision.call_args_list:
+        assert call[0][1] is instance_info
+        assert call[0][2] is inventory
+
+    # Each profile is a separate run, failed ones without a state
+    states = [c[0][0] for c in metrics.observe_run.call_args_list]
+    assert len(states) == 2
+    assert states[0] is not None
+    assert states[1] is None
+
+
+def test_run_profiles_empty(profiles_args):
+    assert profiles.run_profiles(profiles_args, []) == {}
@@ -0,0 +1,163 @@
+from __future__ import unicode_literals
+
+import multiprocessing
+import time
+
+import boto3
+import pytest
+from botocore import UNSIGNED
+from botocore.awsrequest import AWSResponse
+from botocore.client import Config
+
+from ..ratelimit import ApiRateLimiter, FileTokenBucket, TokenBucket, \
+    operation_kind
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.mark.parametrize('operation,kind', [
+    ('DescribeVolumes', 'describe'),
+    ('GetCallerIdentity', 'describe'),
+    ('AttachVolume', 'mutate'),
+    ('CreateTags', 'mutate'),
+])
+def test_operation_kind(operation, kind):
+    assert operation_kind(operation) == kind
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(2.0, capacity=2, clock=clock, sleep=clock.sleep)
+
+    # The burst is free, then callers are spaced out in order
+    assert [bucket.acquire() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    assert clock.sleeps == [0.5, 1.0]
+
+    # Tokens refill over time, up to the capacity
+    clock.now += 10.0
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.5]
+
+
+def test_token_bucket_adaptive(clock):
+    bucket = TokenBucket(10.0, recovery=0.1, min_rate=2.0, clock=clock,
+                         sleep=clock.sleep)
+
+    bucket.throttled()
+    assert bucket.rate == 5.0
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 2.0
+
+    bucket.succeeded()
+    assert bucket.rate == 3.0
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 10.0
+
+
+def test_file_token_bucket_shared(tmpdir, clock):
+    path = str(tmpdir.join('rate'))
+    buckets = [FileTokenBucket(path, 'describe', 1.0, clock=clock,
+                               sleep=clock.sleep) for _ in range(2)]
+    other = FileTokenBucket(path, 'mutate', 1.0, clock=clock,
+                            sleep=clock.sleep)
+
+    # Separate instances (as in separate processes) share the same budget
+    assert buckets[0].acquire() == 0.0
+    assert buckets[1].acquire() == 1.0
+    buckets[0].throttled()
+    assert buckets[1].rate == 0.5
+
+    # Other names are independent
+    assert other.acquire() == 0.0
+
+
+def test_file_token_bucket_corrupt(tmpdir, clock):
+    path = tmpdir.join('rate')
+    path.write('garbage')
+
+    bucket = FileTokenBucket(str(path), 'describe', 1.0, clock=clock)
+    assert bucket.acquire() == 0.0
+
+
+def _acquire_many(path, count):
+    bucket = FileTokenBucket(path, 'describe', 50.0, capacity=1)
+    for _ in range(count):
+        bucket.acquire()
+
+
+def test_file_token_bucket_processes(tmpdir):
+    path = str(tmpdir.join('rate'))
+    processes = [multiprocessing.Process(target=_acquire_many,
+                                         args=(path, 10))
+                 for _ in range(2)]
+
+    start = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # 20 calls at 50/s, after the first one, can't take less than 0.38s
+    assert all(process.exitcode == 0 for process in processes)
+    assert time.time() - start >= 0.36
+
+
+def make_response(status, body):
+    class Raw(object):
+        def stream(self):
+            yield body
+
+    return AWSResponse('https://ec2.us-east-1.amazonaws.com/', status, {},
+                       Raw())
+
+
+THROTTLED = (b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             b'<Message>Request limit exceeded.</Message></Error></Errors>'
+             b'<RequestID>1</RequestID></Response>')
+VOLUMES = (b'<DescribeVolumesResponse '
+           b'xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+           b'<requestId>2</requestId><volumeSet/></DescribeVolumesResponse>')
+
+
+def test_api_rate_limiter(mocker, clock):
+    # No actual sleeping between retries
+    mocker.patch('botocore.endpoint.time')
+
+    limiter = ApiRateLimiter.create(10.0, 1.0, clock=clock,
+                                    sleep=clock.sleep)
+    client = boto3.client(
+        'ec2', region_name='us-east-1',
+        config=Config(signature_version=UNSIGNED,
+                      retries={'mode': 'standard', 'max_attempts': 3}))
+    limiter.register(client)
+
+    responses = iter([make_response(503, THROTTLED),
+                      make_response(200, VOLUMES)])
+    client.meta.events.register('before-send',
+                                lambda **kwargs: next(responses))
+
+    assert client.describe_volumes()['Volumes'] == []
+    assert limiter.stats() == {
+        'describe': {'calls': 1, 'retried': 1, 'throttled': 1,
+                     'wait_time': 0.0},
+        'mutate': {'calls': 0, 'retried': 0, 'throttled': 0,
+                   'wait_time': 0.0}
+    }
+    # Halved by the throttle, then partially recovered
+    assert limiter.buckets['describe'].rate == 5.5
+    assert limiter.buckets['mutate'].rate == 1.0
@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import cache
+from ..records import Attachment, Snapshot, Volume
+
+
+@pytest.fixture
+def boto_volume(instance_id):
+    return {
+        'VolumeId': 'vol-11111111',
+        'State': 'in-use',
+        'AvailabilityZone': 'us-east-1a',
+        'Size': 10,
+        'VolumeType': 'gp2',
+        'Iops': 100,
+        'CreateTime': datetime(2017, 1, 1, tzinfo=timezone.utc),
+        'Attachments': [{
+            'InstanceId': instance_id,
+            'Device': '/dev/sdf',
+            'State': 'attached',
+            'DeleteOnTermination': False
+        }],
+        'Tags': [{'Key': 'a', 'Value': 'b'}]
+    }
+
+
+@pytest.fixture
+def boto_snapshot():
+    return {
+        'SnapshotId': 'snap-11111111',
+        'VolumeId': 'vol-11111111',
+        'VolumeSize': 10,
+        'StartTime': datetime(2017, 1, 1, tzinfo=timezone.utc),
+        'Description': 'unused',
+        'Tags': [{'Key': 'a', 'Value': 'b'}]
+    }
+
+
+def test_volume_from_boto(boto_volume, instance_id):
+    volume = Volume.from_boto(boto_volume)
+    assert volume == Volume(
+        'vol-11111111', 'in-use', 'us-east-1a', 10,
+        (Attachment(instance_id, '/dev/sdf', 'attached'),),
+        (('a', 'b'),), 'gp2', 100)
+    assert volume.attachments[0].device == '/dev/sdf'
+
+
+def test_snapshot_from_boto(boto_snapshot):
+    snapshot = Snapshot.from_boto(boto_snapshot)
+    assert snapshot == Snapshot(
+        'snap-11111111', 'vol-11111111', 10,
+        datetime(2017, 1, 1, tzinfo=timezone.utc), (('a', 'b'),), None)
+
+
+def test_slots(boto_volume, boto_snapshot):
+    for record in (Volume.from_boto(boto_volume),
+                   Snapshot.from_boto(boto_snapshot),
+                   Attachment('i-11111111')):
+        assert not hasattr(record, '__dict__')
+
+
+def test_from_row(boto_volume, boto_snapshot):
+    # Records survive being stored as JSON arrays in the cache
+    volume = Volume.from_boto(boto_volume)
+    snapshot = Snapshot.from_boto(boto_snapshot)._replace(score_reason='why')
+
+    volume_row, snapshot_row = cache.loads(cache.dumps([volume, snapshot]))
+    assert isinstance(volume_row, list)
+    assert Volume.from_row(volume_row) == volume
+    assert Snapshot.from_row(snapshot_row) == snapshot
+    assert Snapshot.from_row(None) is None
@@ -0,0 +1,82 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timezone
+
+import pytest
+
+from ..records import Snapshot
+from ..scoring import SnapshotScorer
+
+
+NOW = datetime(2017, 1, 11, tzinfo=timezone.utc)
+
+
+def snapshot(snapshot_id, day, size=100, tags=()):
+    return Snapshot(snapshot_id, volume_size=size,
+                    start_time=datetime(2017, 1, day, tzinfo=timezone.utc),
+                    tags=tuple(tags))
+
+
+def best(scorer, snapshots):
+    scorer.prepare()
+    return max(snapshots, key=scorer.score).snapshot_id
+
+
+def test_default_newest():
+    scorer = SnapshotScorer(now=NOW)
+    snapshots = [snapshot('snap-1', 1), snapshot('snap-2', 5),
+                 snapshot('snap-3', 3)]
+
+    assert best(scorer, snapshots) == 'snap-2'
+    assert scorer.explain(snapshots[1]) == 'score -6.00: 6.0 days old'
+
+
+def test_naive_start_time():
+    scorer = SnapshotScorer(now=NOW)
+    snap = Snapshot('snap-1', start_time=datetime(2017, 1, 10))
+
+    assert scorer.score(snap) == -1.0
+
+
+def test_fsr(mocker):
+    find_fast_restore = mocker.patch(
+        'ebs_snatcher.ebs.find_fast_restore_snapshots',
+        return_value=set(['snap-1']))
+
+    scorer = SnapshotScorer(weights={'fsr': 100}, availability_zone='az-a',
+                            now=NOW)
+    snapshots = [snapshot('snap-1', 1), snapshot('snap-2', 5)]
+
+    assert best(scorer, snapshots) == 'snap-1'
+    assert 'fast restore enabled in az-a' in scorer.explain(snapshots[0])
+
+    # Fast restore state is only retrieved once
+    scorer.prepare()
+    find_fast_restore.assert_called_once_with('az-a')
+
+
+def test_fsr_disabled_not_fetched(mocker):
+    find_fast_restore = mocker.patch(
+        'ebs_snatcher.ebs.find_fast_restore_snapshots')
+
+    SnapshotScorer(weights={'fsr': 0}).prepare()
+    assert not find_fast_restore.called
+
+
+def test_size_and_tags():
+    scorer = SnapshotScorer(weights={'size': 100, 'tag': 10},
+                            min_size=50,
+                            preferred_tags=[('kind', 'full')],
+                            now=NOW)
+    snapshots = [
+        snapshot('snap-1', 10, size=20, tags=[('kind', 'full')]),
+        snapshot('snap-2', 1, size=60),
+        snapshot('snap-3', 2, size=60, tags=[('kind', 'full')])
+    ]
+
+    assert best(scorer, snapshots) == 'snap-3'
+
+
+def test_unknown_factor():
+    with pytest.raises(ValueError):
+        SnapshotScorer(weights={'bogus': 1})
@@ -0,0 +1,58 @@
+from __future__ import unicode_literals
+
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+
+# Seconds to import each entry point, with a wide margin for slow machines.
+# The modules that make up most of the time are checked separately, such that
+# regressions are caught regardless of the speed of the machine.
+IMPORT_BUDGET = 0.5
+
+# Only needed when making API calls or reaching instance metadata
+DEFERRED_MODULES = ['boto3', 'botocore.session', 'botocore.client',
+                    'urllib.request', 'future', 'past']
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+                                reason='-X importtime requires Python 3.7')
+
+
+def import_times(module):
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT_DIR)
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    times = {}
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+
+    return times
+
+
+@pytest.mark.parametrize('module', [
+    'ebs_snatcher.main',
+    'ebs_snatcher.fleet',
+    'ebs_snatcher.daemon',
+    'ebs_snatcher.plan',
+    'ebs_snatcher.profiles'
+])
+def test_import_budget(module):
+    times = import_times(module)
+
+    assert [name for name in DEFERRED_MODULES if name in times] == []
+    # Retry once, in case the machine was momentarily busy
+    if times[module] > IMPORT_BUDGET:
+        times = import_times(module)
+    assert times[module] <= IMPORT_BUDGET
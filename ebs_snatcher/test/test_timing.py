@@ -0,0 +1,96 @@
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore import UNSIGNED
+from botocore.client import Config
+from botocore.stub import Stubber
+
+from .. import timing
+from ..timing import Timings
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+@pytest.fixture
+def timings():
+    return Timings(clock=FakeClock())
+
+
+@pytest.fixture
+def stub():
+    client = boto3.client('ec2', config=Config(signature_version=UNSIGNED),
+                          region_name='us-east-1')
+    timing.register(client)
+
+    stub = Stubber(client)
+    stub.activate()
+
+    yield stub
+
+    stub.deactivate()
+
+
+def test_phases(timings):
+    with timings.phase('survey'):
+        pass
+    with timings.phase('attach'):
+        pass
+    with timings.phase('survey'):
+        pass
+
+    assert timings.to_json() == {
+        'survey': {'seconds': 1.0, 'calls': {}},
+        'attach': {'seconds': 0.5, 'calls': {}}
+    }
+
+
+def test_calls(timings, stub):
+    client = stub.client
+    stub.add_response('describe_volumes', {'Volumes': [],
+                                           'NextToken': 'next'})
+    stub.add_response('describe_volumes', {'Volumes': []})
+    stub.add_client_error('attach_volume', 'VolumeInUse')
+    stub.add_response('describe_volumes', {'Volumes': []})
+
+    with timings.phase('survey'):
+        client.describe_volumes()
+        client.describe_volumes(NextToken='next')
+
+    with timings.phase('attach'):
+        with pytest.raises(client.exceptions.ClientError):
+            client.attach_volume(Device='/dev/sdf', InstanceId='i-1',
+                                 VolumeId='vol-1')
+
+    # Calls outside of any phase are not recorded
+    client.describe_volumes()
+
+    result = timings.to_json()
+    assert result['survey']['calls'] == {
+        'DescribeVolumes': {'calls': 2, 'retries': 0, 'seconds': 1.0}
+    }
+    assert result['attach']['calls'] == {
+        'AttachVolume': {'calls': 1, 'retries': 0, 'seconds': 0.5}
+    }
+    stub.assert_no_pending_responses()
+
+
+def test_bind(timings, stub):
+    stub.add_response('describe_volumes', {'Volumes': []})
+
+    with timings.phase('survey'):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(timings.bind(stub.client.describe_volumes)) \
+                .result()
+
+    assert timings.to_json()['survey']['calls']['DescribeVolumes'][
+        'calls'] == 1
@@ -0,0 +1,97 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from ..waiters import Waiter, WaiterError
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_waiter(clock, **kwargs):
+    return Waiter(sleep=clock.sleep, clock=clock.time, **kwargs)
+
+
+def test_delays_backoff(clock):
+    waiter = make_waiter(clock, initial_delay=1.0, max_delay=4.0, backoff=2.0,
+                         jitter=0)
+
+    delays = waiter.delays()
+    assert [next(delays) for _ in range(5)] == [1.0, 2.0, 4.0, 4.0, 4.0]
+
+
+def test_delays_jitter(clock):
+    waiter = make_waiter(clock, initial_delay=1.0, jitter=0.2)
+
+    delays = waiter.delays()
+    delay = next(delays)
+    assert 0.8 <= delay <= 1.2
+
+
+def test_wait(clock):
+    waiter = make_waiter(clock, initial_delay=0.5, backoff=2.0, jitter=0)
+    results = iter([False, False, True])
+
+    waiter.wait('thing', lambda: next(results))
+
+    assert clock.sleeps == [0.5, 1.0]
+    assert waiter.timings == {'thing': 1.5}
+
+
+def test_wait_accumulates_timings(clock):
+    waiter = make_waiter(clock, initial_delay=1.0, jitter=0)
+    results = iter([False, True, False, True])
+
+    waiter.wait('thing', lambda: next(results))
+    waiter.wait('thing', lambda: next(results))
+
+    assert waiter.timings == {'thing': 2.0}
+
+
+def test_wait_timeout(clock):
+    waiter = make_waiter(clock, initial_delay=1.0, backoff=2.0, jitter=0,
+                         timeout=5.0)
+
+    with pytest.raises(WaiterError):
+        waiter.wait('thing', lambda: False)
+
+    # The last sleep is cut short by the deadline
+    assert clock.sleeps == [1.0, 2.0, 2.0]
+    assert waiter.timings == {'thing': 5.0}
+
+
+def test_wait_timeout_override(clock):
+    waiter = make_waiter(clock, initial_delay=1.0, backoff=1.0, jitter=0,
+                         timeout=5.0)
+
+    with pytest.raises(WaiterError, match='8.0s'):
+        waiter.wait('thing', lambda: False, timeout=8.0)
+
+    assert waiter.timings == {'thing': 8.0}
+
+
+def test_wait_check_error(clock):
+    waiter = make_waiter(clock)
+
+    def check():
+        raise WaiterError('failed')
+
+    with pytest.raises(WaiterError):
+        waiter.wait('thing', check)
+
+    assert waiter.timings == {'thing': 0}
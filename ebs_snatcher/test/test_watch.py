@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+
+import pytest
+
+from .. import ebs, watch
+
+
+def inotify_available():
+    try:
+        watch.InotifyWatcher([os.getcwd()]).close()
+    except OSError:
+        return False
+
+    return True
+
+
+requires_inotify = pytest.mark.skipif(not inotify_available(),
+                                      reason='inotify is not available')
+
+
+@requires_inotify
+def test_open_watcher_inotify(tmpdir):
+    path = str(tmpdir.join('by-id', 'device'))
+
+    with watch.open_watcher([path]) as watcher:
+        assert isinstance(watcher, watch.InotifyWatcher)
+
+
+def test_open_watcher_fallback(mocker, tmpdir):
+    mocker.patch.object(watch.InotifyWatcher, '__init__',
+                        side_effect=OSError(28, 'No space left on device'))
+    sleep = mocker.Mock()
+
+    with watch.open_watcher([str(tmpdir.join('device'))], sleep) as watcher:
+        assert isinstance(watcher, watch.PollingWatcher)
+        watcher.wait(1.0)
+
+    sleep.assert_called_once_with(1.0)
+
+
+@requires_inotify
+def test_inotify_wakes_up_on_create(tmpdir):
+    path = str(tmpdir.join('device'))
+
+    with watch.open_watcher([path]) as watcher:
+        timer = threading.Timer(0.05, lambda: open(path, 'w').close())
+        timer.start()
+
+        start = time.time()
+        watcher.wait(5.0)
+        elapsed = time.time() - start
+        timer.join()
+
+    assert elapsed < 2.0
+
+
+@requires_inotify
+def test_find_system_block_device_inotify(tmpdir):
+    ebs_path = str(tmpdir.join('sdf'))
+    xen_path = str(tmpdir.join('xvdf'))
+
+    timer = threading.Timer(0.05, lambda: open(xen_path, 'w').close())
+    timer.start()
+
+    start = time.time()
+    # Use a long poll interval, such that only the notification can make
+    # the device be found quickly
+    path = ebs.find_system_block_device('vol-12345678', ebs_path,
+                                        timeout=10.0, poll_interval=5.0)
+    elapsed = time.time() - start
+    timer.join()
+
+    assert path == xen_path
+    assert elapsed < 2.0
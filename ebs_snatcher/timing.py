@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Key of the timing state in the botocore request context
+CONTEXT_KEY = 'ebs_snatcher_timing'
+
+# Phase being timed in the current thread, as a (timings, name) pair
+_local = threading.local()
+
+
+def _current():
+    return getattr(_local, 'current', None)
+
+
+class Timings(object):
+    # Wall time spent in each provisioning phase, along with the count,
+    # retries and time of the AWS API calls made during it. Calls are
+    # attributed to the phase active in the thread making them.
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._phases = {}
+
+    def _phase_entry(self, name):
+        return self._phases.setdefault(name, {'seconds': 0.0, 'calls': {}})
+
+    @contextmanager
+    def phase(self, name):
+        previous = _current()
+        _local.current = (self, name)
+        start = self.clock()
+        try:
+            yield
+        finally:
+            _local.current = previous
+            with self._lock:
+                self._phase_entry(name)['seconds'] += self.clock() - start
+
+    def bind(self, fn):
+        # Wrap `fn` such that calls it makes from other threads are
+        # attributed to the current phase
+        current = _current()
+
+        def wrapper(*args, **kwargs):
+            previous = _current()
+            _local.current = current
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.current = previous
+
+        return wrapper
+
+    def record_call(self, phase, operation, seconds, retries=0):
+        with self._lock:
+            calls = self._phase_entry(phase)['calls']
+            entry = calls.setdefault(
+                operation, {'calls': 0, 'retries': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['retries'] += retries
+            entry['seconds'] += seconds
+
+    def to_json(self):
+        with self._lock:
+            result = {}
+            for name, phase in self._phases.items():
+                calls = dict(
+                    (operation, dict(entry, seconds=round(entry['seconds'],
+                                                          3)))
+                    for operation, entry in phase['calls'].items())
+                result[name] = {'seconds': round(phase['seconds'], 3),
+                                'calls': calls}
+
+            return result
+
+
+def _start_call(model, context, **kwargs):
+    current = _current()
+    if current:
+        timings, phase = current
+        context[CONTEXT_KEY] = (timings, phase, model.name, timings.clock())
+
+
+def _end_call(context, parsed=None, **kwargs):
+    state = context.pop(CONTEXT_KEY, None)
+    if not state:
+        return
+
+    timings, phase, operation, start = state
+    retries = (parsed or {}).get('ResponseMetadata', {}).get(
+        'RetryAttempts', 0)
+    timings.record_call(phase, operation, timings.clock() - start, retries)
+
+
+def register(client):
+    # Time every call made by the client. Calls made outside of any phase are
+    # not recorded. Paginated lookups make one call per page.
+    events = client.meta.events
+    events.register('provide-client-params', _start_call)
+    events.register('after-call', _end_call)
+    events.register('after-call-error', _end_call)
@@ -1,15 +1,20 @@
 from __future__ import unicode_literals
 
+import threading
 from functools import wraps
 
 
 def memoize(f):
     sentinel = object()
+    lock = threading.Lock()
 
     @wraps(f)
     def memo(*args, **kwargs):
         if memo.value is sentinel:
-            memo.value = f(*args, **kwargs)
+            # Make sure concurrent first calls only compute the value once
+            with lock:
+                if memo.value is sentinel:
+                    memo.value = f(*args, **kwargs)
 
         return memo.value
 
@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+import logging
+import random
+import time
+
+
+logger = logging.getLogger('ebs-snatcher.waiters')
+
+
+class WaiterError(Exception):
+    pass
+
+
+class Waiter(object):
+    sleep = staticmethod(time.sleep)
+    clock = staticmethod(time.time)
+
+    def __init__(self, initial_delay=1.0, max_delay=15.0, backoff=1.5,
+                 jitter=0.2, timeout=600.0, sleep=None, clock=None):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        if sleep:
+            self.sleep = sleep
+        if clock:
+            self.clock = clock
+
+        self.timings = {}
+
+    def delays(self):
+        delay = self.initial_delay
+        while True:
+            # Randomize delays such that many processes started together do
+            # not poll in lockstep
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def wait(self, name, check, timeout=None):
+        # Call `check` until it returns True, sleeping between calls. Checks
+        # can raise WaiterError to signal a state that will never succeed.
+        timeout = timeout or self.timeout
+        start = self.clock()
+        deadline = start + timeout
+
+        try:
+            for delay in self.delays():
+                if check():
+                    return
+
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    raise WaiterError(
+                        'Timed out after {:.1f}s waiting for {}'.format(
+                            timeout, name))
+
+                self.sleep(min(delay, remaining))
+        finally:
+            elapsed = self.clock() - start
+            self.timings[name] = self.timings.get(name, 0) + elapsed
+            logger.debug('Waited %.2fs for %s', elapsed, name)
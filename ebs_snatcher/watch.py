@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import time
+
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+
+logger = logging.getLogger('ebs-snatcher.watch')
+
+
+class PollingWatcher(object):
+    def __init__(self, sleep=time.sleep):
+        self.sleep = sleep
+
+    def wait(self, timeout):
+        self.sleep(timeout)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InotifyWatcher(PollingWatcher):
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            libc_name = ctypes.util.find_library('c')
+            if not libc_name:
+                raise OSError(errno.ENOSYS, 'libc not found')
+
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            if not hasattr(libc, 'inotify_init1'):
+                raise OSError(errno.ENOSYS, 'inotify is not supported')
+
+            cls._libc = libc
+
+        return cls._libc
+
+    def __init__(self, dirs):
+        super(InotifyWatcher, self).__init__()
+
+        libc = self._get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        try:
+            for path in dirs:
+                wd = libc.inotify_add_watch(self.fd, path.encode('utf-8'),
+                                            WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err), path)
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        # The contents of the events are not important, as paths are always
+        # checked again after waking up. Just drain the queue.
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _existing_parent(path):
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def open_watcher(paths, sleep=time.sleep):
+    # Watch the closest existing directory containing each path, such that
+    # creation of intermediate directories (such as /dev/disk/by-id) also
+    # wakes us up
+    dirs = sorted(set(_existing_parent(path) for path in paths))
+    try:
+        return InotifyWatcher(dirs)
+    except OSError as e:
+        logger.debug('Failed to watch %s with inotify, falling back to '
+                     'polling: %s', ', '.join(dirs), e)
+        return PollingWatcher(sleep)
@@ -13,11 +13,17 @@ setup(
     author='Daniel Miranda',
     author_email='daniel@cobli.co',
     license='MIT',
+    python_requires='>=3.4',
     install_requires=[
-        'boto3',
-        'future'
+        'boto3'
     ],
     entry_points={
-        'console_scripts': ['ebs-snatcher=ebs_snatcher.main:main']
+        'console_scripts': [
+            'ebs-snatcher=ebs_snatcher.main:main',
+            'ebs-snatcher-fleet=ebs_snatcher.fleet:main',
+            'ebs-snatcher-daemon=ebs_snatcher.daemon:main',
+            'ebs-snatcher-profiles=ebs_snatcher.profiles:main',
+            'ebs-snatcher-plan=ebs_snatcher.plan:main'
+        ]
     },
     keywords='aws ebs')